@@ -167,7 +167,9 @@ def app_uninstall(fn, prefix=config.root_dir):
 def get_package_versions(package, offline=False):
     index = get_index(offline=offline)
     r = Resolve(index)
-    if package in r.groups:
+    r.load_full()
+    r.load_names([package])
+    if r.groups.get(package):
         return r.get_pkgs(MatchSpec(package))
     else:
         return []
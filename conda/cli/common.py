@@ -252,6 +252,33 @@ def add_parser_install(p):
         help="Don't update dependencies (default: %(default)s).",
     )
     add_parser_show_channel_urls(p)
+    p.add_argument(
+        "--solver-time-budget",
+        action="store",
+        type=float,
+        default=config.solver_time_budget,
+        metavar="SECONDS",
+        help="Stop searching for the optimal package resolution after this "
+             "many seconds, and use the best one found so far "
+             "(default: %(default)s).",
+    )
+    p.add_argument(
+        "--neighborhood-solve",
+        action="store_true",
+        dest="neighborhood",
+        default=config.neighborhood_solve,
+        help="First try to keep the installed packages which are not "
+             "dependencies of (or conflicting with) the requested packages "
+             "fixed (default: %(default)s).",
+    )
+    p.add_argument(
+        "--no-neighborhood-solve",
+        action="store_false",
+        dest="neighborhood",
+        default=not config.neighborhood_solve,
+        help="Don't try to keep installed packages fixed (default: "
+             "%(default)s).",
+    )
 
     if 'update' in p.prog:
         # I don't know if p.prog is the correct thing to use here but it's the
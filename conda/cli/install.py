@@ -334,7 +334,11 @@ def install(args, parser, command='install'):
                                                only_names=only_names,
                                                pinned=args.pinned,
                                                minimal_hint=args.alt_hint,
-                                               update_deps=args.update_deps)
+                                               update_deps=args.update_deps,
+                                               time_budget=args.solver_time_budget,
+                                               neighborhood=args.neighborhood,
+                                               partition=(command == 'update'
+                                                          and args.all))
             if args.copy:
                 new_link = []
                 for pkg in actions["LINK"]:
@@ -364,7 +368,12 @@ def install(args, parser, command='install'):
 
             return install(args, parser, command=command)
         else:
-            packages = {index[fn]['name'] for fn in index}
+            if hasattr(index, 'names'):
+                # (without loading the packages of a PackageIndex, nor the
+                # shards of its sharded channels)
+                packages = index.names()
+            else:
+                packages = {index[fn]['name'] for fn in index}
 
             for pkg in e.pkgs:
                 close = get_close_matches(pkg, packages, cutoff=0.7)
@@ -7,6 +7,7 @@
 
 import os
 import sys
+from glob import glob
 
 from os.path import join, getsize, isdir
 from os import lstat, walk, listdir
@@ -104,7 +105,7 @@ def find_tarballs():
 
     rmlist = []
     for fn in os.listdir(pkgs_dir):
-        if fn.endswith('.tar.bz2') or fn.endswith('.tar.bz2.part'):
+        if fn.endswith(('.tar.bz2', '.tar.bz2.part', '.tar.bz2.part.json')):
             rmlist.append(fn)
 
     if not rmlist:
@@ -160,7 +161,7 @@ def find_pkgs():
     rmlist = []
     pkgs = [i for i in listdir(pkgs_dir) if isdir(join(pkgs_dir, i)) and
         # Only include actual packages
-        isdir(join(pkgs_dir, i, 'info'))]
+        not i.startswith('.') and isdir(join(pkgs_dir, i, 'info'))]
     for pkg in pkgs:
         breakit = False
         for root, dir, files in walk(join(pkgs_dir, pkg)):
@@ -179,6 +180,14 @@ def find_pkgs():
         else:
             rmlist.append(pkg)
 
+    # The temporary directories of the extractions which were interrupted
+    # (while the packages directory is locked, they may still be in use)
+    from conda.lock import LOCKFN
+    if not glob(join(pkgs_dir, LOCKFN + '-*')):
+        rmlist.extend(sorted(i for i in listdir(pkgs_dir)
+                             if i.startswith('.extract-') and
+                             isdir(join(pkgs_dir, i))))
+
     if not rmlist:
         return pkgs_dir, rmlist, warnings, 0, []
 
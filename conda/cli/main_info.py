@@ -80,8 +80,10 @@ def show_pkg_info(name):
 
     index = get_index()
     r = Resolve(index)
+    r.load_full()
+    r.load_names([name])
     print(name)
-    if name in r.groups:
+    if r.groups.get(name):
         for pkg in sorted(r.get_pkgs(MatchSpec(name))):
             print('    %-15s %15s  %s' % (
                     pkg.version,
@@ -110,6 +112,33 @@ def get_user_site():
     return site_dirs
 
 
+def channel_cache_ages(channel_urls):
+    """
+    Return the age (in seconds) of the cached repodata of each channel URL,
+    or None for the channels which are not cached.
+    """
+    import conda.config as config
+    try:
+        from conda.fetch import cache_age, cache_fn_url
+    except ImportError:
+        return [None] * len(channel_urls)
+    cache_dir = join(config.pkgs_dirs[0], 'cache')
+    return [cache_age(join(cache_dir, cache_fn_url(url)))
+            for url in channel_urls]
+
+
+def pretty_age(age):
+    if age is None:
+        return 'not cached'
+    for unit, n in ('day', 86400), ('hour', 3600), ('minute', 60):
+        if age >= n:
+            break
+    else:
+        unit, n = 'second', 1
+    return 'cached %d %s%s ago' % (age // n, unit,
+                                   '' if age // n == 1 else 's')
+
+
 def pretty_package(pkg):
     import conda.config as config
     from conda.utils import human_bytes
@@ -216,6 +245,8 @@ def execute(args, parser):
                      requests_version=requests_version,
     )
 
+    info_dict['channel_cache_ages'] = channel_cache_ages(info_dict['channels'])
+
     if args.unsafe_channels:
         if not args.json:
             print("\n".join(info_dict["channels"]))
@@ -230,8 +261,11 @@ def execute(args, parser):
             setattr(args, option, True)
 
     if args.all or all(not getattr(args, opt) for opt in options):
-        for key in 'pkgs_dirs', 'envs_dirs', 'channels':
+        for key in 'pkgs_dirs', 'envs_dirs':
             info_dict['_' + key] = ('\n' + 24 * ' ').join(info_dict[key])
+        info_dict['_channels'] = ('\n' + 24 * ' ').join(
+            '%s  (%s)' % (url, pretty_age(age)) for url, age in
+            zip(info_dict['channels'], info_dict['channel_cache_ages']))
         info_dict['_rtwro'] = ('writable' if info_dict['root_writable'] else
                                'read only')
         print("""\
@@ -193,6 +193,7 @@ def execute_search(args, parser):
                                       unknown=args.unknown, json=args.json, offline=args.offline)
 
     r = Resolve(index)
+    r.load_all()
 
     if args.canonical:
         json = []
@@ -33,6 +33,8 @@ def lchmod(path, mode):
     from math import log2, ceil
     from shlex import quote
     from tempfile import TemporaryDirectory
+    from collections.abc import Mapping, MutableMapping
+    import queue
     range = range
     zip = zip
 else:
@@ -62,6 +64,8 @@ def ceil(x):
         from math import ceil
         return int(ceil(x))
     from pipes import quote
+    from collections import Mapping, MutableMapping
+    import Queue as queue
 
     # Modified from http://hg.python.org/cpython/file/3.3/Lib/tempfile.py. Don't
     # use the 3.4 one. It uses the new weakref.finalize feature.
@@ -81,17 +81,32 @@
     'show_channel_urls',
     'allow_other_channels',
     'update_dependencies',
+    'neighborhood_solve',
+    'incremental_repodata',
+    'background_repodata_refresh',
+    'sharded_repodata',
+    'use_current_repodata',
+    'stream_extract',
+    'keep_tarballs',
 ]
 
 rc_string_keys = [
     'ssl_verify',
     'channel_alias',
     'root_dir',
+    'solver_time_budget',
+    'local_repodata_ttl',
+    'remote_max_connections',
+    'remote_max_connections_per_host',
+    'fetch_threads',
+    'extract_processes',
+    'extract_engine',
 ]
 
 # Not supported by conda config yet
 rc_other = [
     'proxy_servers',
+    'channel_mirrors',
 ]
 
 user_rc_path = abspath(expanduser('~/.condarc'))
@@ -265,6 +280,41 @@ def normalize_urls(urls, platform=None):
     return newurls
 
 offline = bool(rc.get('offline', False))
+# update the cached repodata with the patches in repodata.jlap if the channel
+# has one, instead of downloading all of repodata.json.bz2
+incremental_repodata = bool(rc.get('incremental_repodata', False))
+# number of seconds the cached repodata of a channel is used without asking
+# the server whether it changed (1: as long as the Cache-Control max-age of
+# the server allows, 0: always ask)
+local_repodata_ttl = int(rc.get('local_repodata_ttl', 1))
+# use the cached repodata of the channels right away, and refresh it in the
+# background (for the next time, or for this one if it is done before the
+# solver starts)
+background_repodata_refresh = bool(rc.get('background_repodata_refresh',
+                                          False))
+# maximum number of concurrent downloads of repodata, in all and from the
+# same host
+remote_max_connections = int(rc.get('remote_max_connections', 10))
+remote_max_connections_per_host = int(rc.get(
+    'remote_max_connections_per_host', 6))
+# fetch the repodata of the packages from the per-name shards of the channels
+# which have them, only for the names the solver needs
+sharded_repodata = bool(rc.get('sharded_repodata', False))
+# first use the current_repodata.json of the channels which have one (only
+# the latest versions), and the full repodata only if the solver needs it
+use_current_repodata = bool(rc.get('use_current_repodata', False))
+# number of packages downloaded at the same time
+fetch_threads = int(rc.get('fetch_threads', 5))
+# number of packages extracted at the same time (0: as many as CPUs)
+extract_processes = int(rc.get('extract_processes', 0))
+# program used to extract the packages: tar, tarfile (the Python module),
+# or auto (the fastest one available)
+extract_engine = rc.get('extract_engine', 'auto')
+# extract the packages while downloading them (from the stream of the
+# download)
+stream_extract = bool(rc.get('stream_extract', False))
+# keep the tarballs of the packages extracted while downloading them
+keep_tarballs = bool(rc.get('keep_tarballs', True))
 
 def get_channel_urls(platform=None):
     if os.getenv('CIO_TEST'):
@@ -328,6 +378,18 @@ def get_proxy_servers():
         return res
     sys.exit("Error: proxy_servers setting not a mapping")
 
+def get_channel_mirrors():
+    """
+    Return the mirrors of the channels, {base url: [mirror base url, ...]}
+    (see conda.mirrors).
+    """
+    res = rc.get('channel_mirrors') or {}
+    if not isinstance(res, dict):
+        sys.exit("Error: channel_mirrors setting not a mapping")
+    return dict((url.rstrip('/') + '/',
+                 [mirror.rstrip('/') + '/' for mirror in mirrors or []])
+                for url, mirrors in res.items())
+
 # ----- foreign -----
 
 try:
@@ -353,6 +415,13 @@ def get_proxy_servers():
 # packages which are added to a newly created environment by default
 create_default_packages = list(rc.get('create_default_packages', []))
 update_dependencies = bool(rc.get('update_dependencies', True))
+# first try to solve changing only the installed packages near the new specs
+neighborhood_solve = bool(rc.get('neighborhood_solve', False))
+# maximum number of seconds the solver may spend looking for an optimal
+# solution before settling for the best one found so far (None: no limit)
+solver_time_budget = rc.get('solver_time_budget')
+if solver_time_budget is not None:
+    solver_time_budget = float(solver_time_budget)
 
 # ssl_verify can be a boolean value or a filename string
 ssl_verify = rc.get('ssl_verify', True)
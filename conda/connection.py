@@ -19,7 +19,8 @@
 
 import conda
 from conda.compat import urlparse, StringIO
-from conda.config import get_proxy_servers, ssl_verify
+from conda.config import get_channel_mirrors, get_proxy_servers, ssl_verify
+from conda.mirrors import MirrorAdapter
 
 import requests
 
@@ -57,6 +58,10 @@ class CondaSession(requests.Session):
 
     def __init__(self, *args, **kwargs):
         retries = kwargs.pop('retries', RETRIES)
+        # The number of connections kept alive to each host, and the number
+        # of hosts for which they are kept
+        pool_maxsize = kwargs.pop('pool_maxsize', None)
+        pool_connections = kwargs.pop('pool_connections', None)
 
         super(CondaSession, self).__init__(*args, **kwargs)
 
@@ -64,9 +69,14 @@ def __init__(self, *args, **kwargs):
         if proxies:
             self.proxies = proxies
 
-        # Configure retries
-        if retries:
-            http_adapter = requests.adapters.HTTPAdapter(max_retries=retries)
+        # Configure retries and the connection pools
+        if retries or pool_maxsize or pool_connections:
+            adapter_kwargs = {'max_retries': retries or 0}
+            if pool_maxsize:
+                adapter_kwargs['pool_maxsize'] = pool_maxsize
+            if pool_connections:
+                adapter_kwargs['pool_connections'] = pool_connections
+            http_adapter = requests.adapters.HTTPAdapter(**adapter_kwargs)
             self.mount("http://", http_adapter)
             self.mount("https://", http_adapter)
 
@@ -79,6 +89,10 @@ def __init__(self, *args, **kwargs):
         # Enable s3:// urls
         self.mount("s3://", S3Adapter())
 
+        # Send the requests for channels with mirrors to the best mirror
+        for base, mirrors in get_channel_mirrors().items():
+            self.mount(base, MirrorAdapter(self, base, mirrors))
+
         self.headers['User-Agent'] = "conda/%s %s" % (
                           conda.__version__, self.headers['User-Agent'])
 
@@ -7,22 +7,29 @@
 from __future__ import print_function, division, absolute_import
 
 import os
+import re
 import bz2
+import codecs
 import json
 import shutil
+import mmap
 import hashlib
+import pickle
 import tempfile
+import time
+import threading
 from logging import getLogger
-from os.path import basename, dirname, isdir, join
+from os.path import basename, dirname, isdir, isfile, join
 import sys
 import getpass
 import warnings
 from functools import wraps
 
-from conda import config
+from conda import config, install, jlap, mirrors
 from conda.utils import memoized
 from conda.connection import CondaSession, unparse_url, RETRIES
-from conda.compat import itervalues, input, urllib_quote
+from conda.compat import (iteritems, itervalues, input, urllib_quote,
+                          urlparse, string_types, Mapping, MutableMapping)
 from conda.lock import Locked
 
 import requests
@@ -44,9 +51,212 @@ def create_cache_dir():
     return cache_dir
 
 
-def cache_fn_url(url):
+def cache_fn_url(url, ext='json'):
     md5 = hashlib.md5(url.encode('utf-8')).hexdigest()
-    return '%s.json' % (md5[:8],)
+    return '%s.%s' % (md5[:8], ext)
+
+
+# The repodata cache files start with a line with this magic string, the
+# format version and the Python version (pickles are not portable between
+# them), then a line with the JSON encoded metadata (the keys starting with
+# '_', like '_etag' and '_mod'), and a line with the offset of the table.
+# The package info dicts follow, pickled one by one, and then the pickled
+# table: the rest of the repodata, and a map from each package filename to
+# the offset and size of its info dict and the package name.  This way the
+# packages can be loaded only when they are used (see LazyPackages).
+CACHE_MAGIC = b'conda-repodata-cache'
+CACHE_FORMAT = 2
+
+
+def binary_cache_path(cache_path):
+    return cache_path[:-len('.json')] + '.q'
+
+
+def read_cache_header(cache_path):
+    """
+    Return the metadata of the binary repodata cache file for cache_path,
+    without loading the repodata itself.  Raises IOError or ValueError if
+    there is no (usable) cache file.
+    """
+    with open(binary_cache_path(cache_path), 'rb') as fi:
+        return _read_cache_header(fi)
+
+
+def _cache_magic():
+    return b' '.join([CACHE_MAGIC, str(CACHE_FORMAT).encode('ascii'),
+                      ('%d.%d' % sys.version_info[:2]).encode('ascii')])
+
+
+def _read_cache_header(fi):
+    if fi.readline().rstrip(b'\n') != _cache_magic():
+        raise ValueError("Not a repodata cache file (or an incompatible "
+                         "one): %s" % fi.name)
+    return json.loads(fi.readline().decode('utf-8'))
+
+
+class LazyPackages(Mapping):
+    """
+    The packages of a binary repodata cache file (filename -> info dict),
+    which are only loaded (from the memory mapped file, or its contents on
+    Windows) when accessed.
+    """
+    def __init__(self, mm, table):
+        self._mm = mm
+        self._table = table
+        self._keys = {}
+
+    def name(self, fn):
+        return self._table[fn][2]
+
+    def __getitem__(self, fn):
+        offset, size, name = self._table[fn]
+        info = pickle.loads(self._mm[offset:offset + size])
+        # Share the keys of the info dicts, like json.loads does
+        return {self._keys.setdefault(k, k): v for k, v in iteritems(info)}
+
+    def __contains__(self, fn):
+        return fn in self._table
+
+    def __iter__(self):
+        return iter(self._table)
+
+    def __len__(self):
+        return len(self._table)
+
+
+def read_cache(cache_path, lazy=False):
+    """
+    Return the cached repodata for cache_path, from the binary cache file or
+    else from the JSON file of older versions of conda.  If lazy is True, the
+    packages of a binary cache are a LazyPackages mapping instead of a dict.
+    Raises IOError or ValueError if there is no (usable) cache file.
+    """
+    try:
+        with open(binary_cache_path(cache_path), 'rb') as fi:
+            meta = _read_cache_header(fi)
+            try:
+                fi.seek(int(fi.readline()))
+                table = pickle.load(fi)
+                if lazy and install.on_win:
+                    # A file which is memory mapped can't be replaced on
+                    # Windows (see write_cache), so read it instead
+                    fi.seek(0)
+                    mm = fi.read()
+                else:
+                    mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+            except Exception as e:
+                raise ValueError("Corrupt repodata cache file: %s: %s" %
+                                 (fi.name, e))
+    except (IOError, ValueError) as e:
+        log.debug("Using %s: %s" % (cache_path, e))
+        with open(cache_path) as f:
+            return json.load(f)
+    cache = table['repodata']
+    cache['packages'] = LazyPackages(mm, table['packages'])
+    if not lazy:
+        try:
+            cache['packages'] = dict(iteritems(cache['packages']))
+        except Exception as e:
+            raise ValueError("Corrupt repodata cache file: %s: %s" %
+                             (cache_path, e))
+        finally:
+            mm.close()
+    cache.update(meta)
+    return cache
+
+
+def write_cache(cache_path, cache):
+    meta = {key: value for key, value in iteritems(cache)
+            if key.startswith('_')}
+    repodata = {key: value for key, value in iteritems(cache)
+                if not key.startswith('_') and key != 'packages'}
+    table = {}
+    # Write to a temporary file which then replaces the cache file, so that
+    # a reader never sees a half written cache file (and a memory mapped one
+    # is left alone)
+    path = binary_cache_path(cache_path)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname(path),
+                                    prefix=basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as fo:
+            fo.write(_cache_magic() + b'\n')
+            fo.write(json.dumps(meta, sort_keys=True).encode('utf-8') + b'\n')
+            pos = fo.tell()
+            fo.write(b'0' * 16 + b'\n')
+            for fn, info in iteritems(cache.get('packages', {})):
+                data = pickle.dumps(info, pickle.HIGHEST_PROTOCOL)
+                table[fn] = (fo.tell(), len(data), info.get('name'))
+                fo.write(data)
+            offset = fo.tell()
+            pickle.dump({'repodata': repodata, 'packages': table}, fo,
+                        pickle.HIGHEST_PROTOCOL)
+            fo.seek(pos)
+            fo.write(('%016d\n' % offset).encode('ascii'))
+        _replace(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+    if os.path.exists(cache_path):
+        # The JSON cache of older versions of conda is not needed anymore
+        os.unlink(cache_path)
+
+
+def _replace(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        try:
+            os.rename(src, dst)
+        except OSError:
+            # Python 2 on Windows can't rename over an existing file
+            os.unlink(dst)
+            os.rename(src, dst)
+
+
+def cache_age(cache_path):
+    """
+    Return the number of seconds since the repodata in the cache for
+    cache_path was last fetched or revalidated (the modification time of the
+    cache file records it), or None if there is no cache.
+    """
+    for path in binary_cache_path(cache_path), cache_path:
+        try:
+            return max(time.time() - os.path.getmtime(path), 0)
+        except OSError:
+            pass
+    return None
+
+
+def cache_ttl(meta):
+    """
+    Return the number of seconds the cached repodata with the metadata meta
+    can be used for without revalidating it (see local_repodata_ttl).
+    """
+    if config.local_repodata_ttl == 1:
+        return meta.get('_max_age', 0)
+    return config.local_repodata_ttl
+
+
+def get_max_age(resp):
+    """
+    Return the max-age of the Cache-Control header of the response, or None
+    if it has none.
+    """
+    cache_control = resp.headers.get('Cache-Control', '')
+    if re.search(r'\b(no-cache|no-store)\b', cache_control):
+        return 0
+    m = re.search(r'\bmax-age=(\d+)', cache_control)
+    return int(m.group(1)) if m else None
+
+
+def touch_cache(cache_path):
+    """
+    Record that the repodata in the cache for cache_path is up to date.
+    """
+    try:
+        os.utime(binary_cache_path(cache_path), None)
+    except OSError:
+        pass
 
 
 def add_http_value_to_dict(resp, http_key, d, dict_key):
@@ -63,12 +273,28 @@ def __call__(self, f):
         @wraps(f)
         def func(*args, **kwargs):
             res = f(*args, **kwargs)
-            dotlog.debug("%s args %s kwargs %s" % (self.msg, args, kwargs))
+            if kwargs.get('interactive', True):
+                dotlog.debug("%s args %s kwargs %s" %
+                             (self.msg, args, kwargs))
             return res
         return func
 
+# The repodata with only the latest version of each package (and the packages
+# they depend on) which some channels have, see PackageIndex.load_full
+CURRENT_REPODATA = 'current_repodata.json'
+
 @dotlog_on_return("fetching repodata:")
-def fetch_repodata(url, cache_dir=None, use_cache=False, session=None):
+def fetch_repodata(url, cache_dir=None, use_cache=False, session=None,
+                   current=False, interactive=True):
+    """
+    Return the repodata of the channel url, from the cache if it is still
+    up to date.  If current is True, the channel's current_repodata.json
+    (only the latest version of each package, and what they depend on) is
+    fetched instead, and None is returned if the channel has none.  If
+    interactive is False, nothing is printed (but logged) and None is
+    returned if the proxy needs a password instead of asking for it.
+    """
+    report = stderrlog.info if interactive else log.debug
     if not config.ssl_verify:
         try:
             from requests.packages.urllib3.connectionpool import InsecureRequestWarning
@@ -79,41 +305,93 @@ def fetch_repodata(url, cache_dir=None, use_cache=False, session=None):
 
     session = session or CondaSession()
 
-    cache_path = join(cache_dir or create_cache_dir(), cache_fn_url(url))
+    filename = CURRENT_REPODATA if current else 'repodata.json.bz2'
+    cache_path = join(cache_dir or create_cache_dir(),
+                      cache_fn_url(url + CURRENT_REPODATA if current else url))
+    if use_cache:
+        try:
+            return read_cache(cache_path, lazy=True)
+        except (IOError, ValueError):
+            return None if current else {'packages': {}}
+
+    # Only the metadata is needed to revalidate the cache, the repodata is
+    # only loaded if it is still up to date.
+    cache = None
     try:
-        with open(cache_path) as f:
-            cache = json.load(f)
+        meta = read_cache_header(cache_path)
     except (IOError, ValueError):
-        cache = {'packages': {}}
+        try:
+            meta = cache = read_cache(cache_path)
+        except (IOError, ValueError):
+            meta = cache = {'packages': {}}
+
+    age = cache_age(cache_path)
+    if age is not None and age < cache_ttl(meta):
+        log.debug("Using the cached repodata of %s (%d seconds old)" %
+                  (config.remove_binstar_tokens(url), age))
+        if cache is not None:
+            return cache
+        try:
+            return read_cache(cache_path, lazy=True)
+        except (IOError, ValueError):
+            pass
 
-    if use_cache:
-        return cache
+    if (config.incremental_repodata and not current and cache is None and
+            '_hash' in meta):
+        cache = update_repodata(url, cache_path, session)
+        if cache is not None:
+            return cache
 
     headers = {}
-    if "_etag" in cache:
-        headers["If-None-Match"] = cache["_etag"]
-    if "_mod" in cache:
-        headers["If-Modified-Since"] = cache["_mod"]
+    if "_etag" in meta:
+        headers["If-None-Match"] = meta["_etag"]
+    if "_mod" in meta:
+        headers["If-Modified-Since"] = meta["_mod"]
 
     try:
-        resp = session.get(url + 'repodata.json.bz2',
-                           headers=headers, proxies=session.proxies)
+        resp = session.get(url + filename, headers=headers,
+                           proxies=session.proxies, stream=True)
         resp.raise_for_status()
+        max_age = get_max_age(resp)
         if resp.status_code != 304:
-            cache = json.loads(bz2.decompress(resp.content).decode('utf-8'))
+            cache = stream_repodata(resp, compressed=not current)
             add_http_value_to_dict(resp, 'Etag', cache, '_etag')
             add_http_value_to_dict(resp, 'Last-Modified', cache, '_mod')
+            if max_age is not None:
+                cache['_max_age'] = max_age
+        elif cache is None:
+            if max_age is not None and max_age != meta.get('_max_age'):
+                # Record the new max-age
+                try:
+                    cache = read_cache(cache_path)
+                except (IOError, ValueError):
+                    pass
+                else:
+                    cache['_max_age'] = max_age
+            else:
+                touch_cache(cache_path)
 
     except ValueError as e:
-        raise RuntimeError("Invalid index file: %srepodata.json.bz2: %s" %
-                           (config.remove_binstar_tokens(url), e))
+        raise RuntimeError("Invalid index file: %s%s: %s" %
+                           (config.remove_binstar_tokens(url), filename, e))
 
     except requests.exceptions.HTTPError as e:
         if e.response.status_code == 407: # Proxy Authentication Required
+            if not interactive:
+                log.debug("Proxy authentication required for %s" %
+                          config.remove_binstar_tokens(url))
+                return None
             handle_proxy_407(url, session)
             # Try again
             return fetch_repodata(url, cache_dir=cache_dir,
-                                  use_cache=use_cache, session=session)
+                                  use_cache=use_cache, session=session,
+                                  current=current)
+
+        if current:
+            # The full repodata is used instead
+            log.debug("No %s for %s: %s" %
+                      (filename, config.remove_binstar_tokens(url), e))
+            return None
 
         if e.response.status_code == 404:
             if url.startswith(config.DEFAULT_CHANNEL_ALIAS):
@@ -134,10 +412,11 @@ def fetch_repodata(url, cache_dir=None, use_cache=False, session=None):
             msg = ("Warning: you may need to login to anaconda.org again with "
                 "'anaconda login' to access private packages(%s, %s)" %
                 (config.hide_binstar_tokens(url), e))
-            stderrlog.info(msg)
+            report(msg)
             return fetch_repodata(config.remove_binstar_tokens(url),
                                   cache_dir=cache_dir,
-                                  use_cache=use_cache, session=session)
+                                  use_cache=use_cache, session=session,
+                                  current=current, interactive=interactive)
 
         else:
             msg = "HTTPError: %s: %s\n" % (e, config.remove_binstar_tokens(url))
@@ -147,7 +426,7 @@ def fetch_repodata(url, cache_dir=None, use_cache=False, session=None):
 
     except requests.exceptions.SSLError as e:
         msg = "SSL Error: %s\n" % e
-        stderrlog.info("SSL verification error: %s\n" % e)
+        report("SSL verification error: %s\n" % e)
         log.debug(msg)
 
     except requests.exceptions.ConnectionError as e:
@@ -156,25 +435,375 @@ def fetch_repodata(url, cache_dir=None, use_cache=False, session=None):
         # attribute here. We have to just check if it looks like 407.  See
         # https://github.com/kennethreitz/requests/issues/2061.
         if "407" in str(e): # Proxy Authentication Required
+            if not interactive:
+                log.debug("Proxy authentication required for %s" %
+                          config.remove_binstar_tokens(url))
+                return None
             handle_proxy_407(url, session)
             # Try again
             return fetch_repodata(url, cache_dir=cache_dir,
-                                  use_cache=use_cache, session=session)
+                                  use_cache=use_cache, session=session,
+                                  current=current)
 
         msg = "Connection error: %s: %s\n" % (e, config.remove_binstar_tokens(url))
-        stderrlog.info('Could not connect to %s\n' % config.remove_binstar_tokens(url))
+        report('Could not connect to %s\n' % config.remove_binstar_tokens(url))
         log.debug(msg)
         if fail_unknown_host:
             raise RuntimeError(msg)
 
-    cache['_url'] = config.remove_binstar_tokens(url)
+    if cache is None:
+        # The binary cache is up to date (or the server could not be reached)
+        try:
+            cache = read_cache(cache_path, lazy=True)
+        except (IOError, ValueError):
+            cache = None if current else {'packages': {}}
+    else:
+        cache['_url'] = config.remove_binstar_tokens(url)
+        try:
+            write_cache(cache_path, cache)
+            # Free the parsed repodata, the packages are loaded from the
+            # cache file when they are needed
+            cache = read_cache(cache_path, lazy=True)
+        except (IOError, OSError, ValueError):
+            pass
+
+    return cache or None
+
+class JSONStream(object):
+    """
+    Parse JSON text given as an iterable of (unicode) chunks, without
+    needing the whole text at once.  Only the text of the value being parsed
+    is kept in memory, and the members of an object can be parsed one at a
+    time (see members()).
+    """
+    _ws = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def more(self):
+        """
+        Read more text, at least doubling what is left in the buffer (so
+        that parsing a big value doesn't take quadratic time).
+        """
+        if self.eof:
+            raise ValueError("Unexpected end of JSON data")
+        parts = [self.buf[self.pos:]]
+        size = want = max(len(parts[0]), 1)
+        while size <= 2 * want:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.eof = True
+                break
+            parts.append(chunk)
+            size += len(chunk)
+        self.buf = ''.join(parts)
+        self.pos = 0
+
+    def peek(self):
+        """
+        Return the next non-whitespace character ('' at the end).
+        """
+        while True:
+            self.pos = self._ws.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self.more()
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError("Expecting one of %r at %r" %
+                             (chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if self.eof:
+                    raise
+            else:
+                # A number (or literal) could continue in the next chunk
+                if (end < len(self.buf) or self.eof or
+                        isinstance(obj, (dict, list, string_types))):
+                    self.pos = end
+                    return obj
+            self.more()
+
+    def members(self):
+        """
+        Generate the (key, value) pairs of the object starting at the current
+        position.
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key, self.value()
+            if self.expect(',}') == '}':
+                return
+
+
+def stream_repodata(resp, compressed=True):
+    """
+    Decompress and parse the body of a (streamed) repodata.json.bz2
+    response as it is downloaded (or of a repodata.json response if
+    compressed is False).  Neither the compressed nor the decompressed data
+    are ever held in memory as a whole, the packages are parsed one by one.
+    """
+    decompressor = bz2.BZ2Decompressor()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    h = hashlib.new('sha256')
+
+    def chunks():
+        for chunk in resp.iter_content(2**14):
+            data = decompressor.decompress(chunk) if compressed else chunk
+            h.update(data)
+            yield decoder.decode(data)
+        yield decoder.decode(b'', final=True)
+
+    stream = JSONStream(chunks())
+    repodata = {}
+    stream.expect('{')
+    if stream.peek() == '}':
+        stream.pos += 1
+    else:
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if key == 'packages' and stream.peek() == '{':
+                # Share the keys of the package dicts, like json.loads does
+                keys = {}
+                repodata[key] = packages = {}
+                for fn, info in stream.members():
+                    if isinstance(info, dict):
+                        info = {keys.setdefault(k, k): v
+                                for k, v in iteritems(info)}
+                    packages[fn] = info
+            else:
+                repodata[key] = stream.value()
+            if stream.expect(',}') == '}':
+                break
+    if stream.peek():
+        raise ValueError("Extra data after the repodata")
+    # Identifies this version of repodata.json for incremental updates
+    repodata['_hash'] = h.hexdigest()
+    return repodata
+
+
+def fetch_jlap(url, session, state=None):
+    """
+    Fetch the repodata.jlap file of the channel url and return its patches,
+    its metadata and the state to pass to the next call, which is the
+    position of the end of the last patch line and the running checksum
+    there.  Given such a state, only the part of the file appended since is
+    requested (the whole file is fetched if the server doesn't support
+    Range requests, or if the file was rewritten).
+    """
+    resp = None
+    if state:
+        resp = session.get(url + 'repodata.jlap', proxies=session.proxies,
+                           headers={'Range': 'bytes=%d-' % state['offset']},
+                           stream=True)
+        if resp.status_code == 206:
+            try:
+                patches, meta, pos, check = jlap.parse(resp.content,
+                                                       state['check'])
+            except ValueError as e:
+                log.debug("Could not use the end of the jlap file of %s: %s"
+                          % (config.remove_binstar_tokens(url), e))
+                resp = None
+            else:
+                return patches, meta, {'offset': state['offset'] + pos,
+                                       'check': check}
+        elif resp.status_code == 416:
+            # Range Not Satisfiable, the file is shorter than it was
+            resp = None
+    if resp is None:
+        resp = session.get(url + 'repodata.jlap', proxies=session.proxies,
+                           stream=True)
+    resp.raise_for_status()
+    patches, meta, pos, check = jlap.parse(resp.content)
+    return patches, meta, {'offset': pos, 'check': check}
+
+
+def update_repodata(url, cache_path, session):
+    """
+    Update the cached repodata for url with the patches in the repodata.jlap
+    file of the channel.  Returns the updated repodata, or None if that is
+    not possible, in which case the whole repodata has to be downloaded.
+    """
+    try:
+        cache = read_cache(cache_path)
+        patches, meta, state = fetch_jlap(url, session, cache.get('_jlap'))
+        latest = meta['latest']
+        if latest != cache['_hash']:
+            for patch in jlap.find_patches(patches, cache['_hash'], latest):
+                jlap.apply_patch(cache, patch['patch'])
+            if jlap.repodata_hash(cache) != latest:
+                raise ValueError("The patched repodata does not match %s" %
+                                 latest)
+            cache['_hash'] = latest
+        elif state == cache.get('_jlap'):
+            touch_cache(cache_path)
+            return cache
+        cache['_jlap'] = state
+        write_cache(cache_path, cache)
+    except (requests.exceptions.RequestException, IOError, OSError,
+            KeyError, ValueError) as e:
+        log.debug("Could not update the repodata of %s incrementally: %s" %
+                  (config.remove_binstar_tokens(url), e))
+        return None
+    log.debug("Updated the repodata of %s incrementally" %
+              config.remove_binstar_tokens(url))
+    return cache
+
+# A sharded channel has, next to its repodata.json.bz2, a manifest
+# repodata_shards.json, {"info": {...}, "shards": {<name>: <sha256>}}, and
+# for each package name a shard shards/<sha256>.json.bz2 with the repodata
+# {"packages": {...}} of the packages with that name, sha256 being the
+# SHA-256 hex digest of the shard file.  The shards are only fetched when
+# the solver needs them.  As the name of a shard changes with its contents,
+# a cached shard never needs to be revalidated.
+SHARDS_MANIFEST = 'repodata_shards.json'
+
+
+def fetch_shards_manifest(url, cache_dir=None, use_cache=False, session=None):
+    """
+    Return the shards manifest of the channel url, or None if the channel is
+    not sharded.  The manifest is cached (and revalidated) like the repodata.
+    """
+    session = session or CondaSession()
+    cache_path = join(cache_dir or create_cache_dir(),
+                      cache_fn_url(url, 'shards.json'))
     try:
-        with open(cache_path, 'w') as fo:
-            json.dump(cache, fo, indent=2, sort_keys=True)
-    except IOError:
+        with open(cache_path) as fi:
+            cache = json.load(fi)
+    except (IOError, ValueError):
+        cache = None
+    if use_cache:
+        return cache
+
+    headers = {}
+    if cache and "_etag" in cache:
+        headers["If-None-Match"] = cache["_etag"]
+    if cache and "_mod" in cache:
+        headers["If-Modified-Since"] = cache["_mod"]
+    try:
+        resp = session.get(url + SHARDS_MANIFEST, headers=headers,
+                           proxies=session.proxies, stream=True)
+        resp.raise_for_status()
+        if resp.status_code == 304:
+            return cache
+        manifest = json.loads(resp.content.decode('utf-8'))
+        if not isinstance(manifest.get('shards'), dict):
+            raise ValueError("no shards")
+    except requests.exceptions.HTTPError as e:
+        if e.response.status_code in (403, 404):
+            return None
+        log.debug("Could not fetch %s%s: %s" %
+                  (config.remove_binstar_tokens(url), SHARDS_MANIFEST, e))
+        return cache
+    except (requests.exceptions.RequestException, IOError,
+            ValueError) as e:
+        log.debug("Could not fetch %s%s: %s" %
+                  (config.remove_binstar_tokens(url), SHARDS_MANIFEST, e))
+        return cache
+
+    add_http_value_to_dict(resp, 'Etag', manifest, '_etag')
+    add_http_value_to_dict(resp, 'Last-Modified', manifest, '_mod')
+    manifest['_url'] = config.remove_binstar_tokens(url)
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=dirname(cache_path),
+                                        prefix=basename(cache_path) + '.')
+        with os.fdopen(fd, 'w') as fo:
+            json.dump(manifest, fo)
+        _replace(tmp_path, cache_path)
+    except (IOError, OSError):
         pass
+    return manifest
+
+
+class ShardedPackages(Mapping):
+    """
+    The packages of a sharded channel (filename -> info dict) which have
+    been loaded so far (see load).
+    """
+    def __init__(self, url, manifest, fetcher, cache_dir=None):
+        self.url = url
+        self.shards = manifest['shards']
+        self.fetcher = fetcher
+        self.cache_dir = join(cache_dir or create_cache_dir(), 'shards')
+        self.loaded = set()
+        self._packages = {}
+
+    def shard_url(self, name):
+        return '%sshards/%s.json.bz2' % (self.url, self.shards[name])
+
+    def fetch_shard(self, name, session):
+        """
+        Return the packages of the shard of name, from the cache or else
+        from the channel.
+        """
+        digest = self.shards[name]
+        path = join(self.cache_dir, '%s.json.bz2' % digest)
+        try:
+            with open(path, 'rb') as fi:
+                data = fi.read()
+        except IOError:
+            data = None
+        if data is None or hashlib.sha256(data).hexdigest() != digest:
+            url = self.shard_url(name)
+            try:
+                resp = session.get(url, proxies=session.proxies, stream=True)
+                resp.raise_for_status()
+                data = resp.content
+            except (requests.exceptions.RequestException, IOError) as e:
+                raise RuntimeError("Could not fetch %s: %s" %
+                                   (config.remove_binstar_tokens(url), e))
+            if hashlib.sha256(data).hexdigest() != digest:
+                raise RuntimeError("SHA-256 mismatch for %s" %
+                                   config.remove_binstar_tokens(url))
+            try:
+                if not isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+                with os.fdopen(fd, 'wb') as fo:
+                    fo.write(data)
+                _replace(tmp_path, path)
+            except (IOError, OSError):
+                pass
+        try:
+            return json.loads(bz2.decompress(data).decode('utf-8'))['packages']
+        except (IOError, ValueError, KeyError) as e:
+            raise RuntimeError("Invalid repodata shard for %s in %s: %s" %
+                               (name, config.remove_binstar_tokens(self.url),
+                                e))
+
+    def add(self, name, packages):
+        self.loaded.add(name)
+        self._packages.update(packages)
+
+    def __getitem__(self, fn):
+        return self._packages[fn]
+
+    def __iter__(self):
+        return iter(self._packages)
+
+    def __len__(self):
+        return len(self._packages)
 
-    return cache or None
 
 def handle_proxy_407(url, session):
     """
@@ -206,35 +835,324 @@ def get_proxy_username_and_pass(scheme):
 
 def add_unknown(index):
     for pkgs_dir in config.pkgs_dirs:
-        if not isdir(pkgs_dir):
-            continue
-        for dn in os.listdir(pkgs_dir):
-            fn = dn + '.tar.bz2'
-            if fn in index:
-                continue
-            try:
-                with open(join(pkgs_dir, dn, 'info', 'index.json')) as fi:
-                    meta = json.load(fi)
-            except IOError:
+        for dist, entry in iteritems(install.load_manifest(pkgs_dir)):
+            fn = dist + '.tar.bz2'
+            if fn in index or not entry.get('index'):
                 continue
+            meta = dict(entry['index'])
             if 'depends' not in meta:
                 meta['depends'] = []
             log.debug("adding cached pkg to index: %s" % fn)
             index[fn] = meta
 
 def add_pip_dependency(index):
-    for info in itervalues(index):
+    if isinstance(index, PackageIndex):
+        # Don't load all the packages to find the python ones
+        infos = [index[fn] for fn in index.groups.get('python', [])]
+    else:
+        infos = itervalues(index)
+    for info in infos:
         if (info['name'] == 'python' and
                     info['version'].startswith(('2.', '3.'))):
-            info.setdefault('depends', []).append('pip')
+            depends = info.setdefault('depends', [])
+            if 'pip' not in depends:
+                depends.append('pip')
+
+class PackageIndex(MutableMapping):
+    """
+    The index of the packages of several channels (filename -> info dict),
+    as returned by fetch_index.  The info dicts of a channel are only loaded
+    when they are used (see LazyPackages).  groups maps each package name to
+    the filenames of its packages, so that the packages with a given name
+    can be found without loading the others.
+    """
+    def __init__(self):
+        self._channels = []  # [channel url, packages] in the order added
+        self._overlay = {}   # filename -> info dict set directly (or None)
+        self._sources = {}   # filename -> (channel url, packages)
+        self._loaded = {}    # filename -> info dict
+        self._names = {}     # filename -> package name
+        self.groups = {}     # package name -> list of filenames
+        self.pending = []    # BackgroundRefresh of channels
+        # The channels with only their current repodata -> use_cache
+        self.current = {}
+
+    def add_channel(self, url, packages):
+        """
+        Add the packages (a dict, a LazyPackages or a ShardedPackages) of the
+        channel url, replacing the packages with the same filenames.
+        """
+        self._channels.append([url, packages])
+        self._add_channel(url, packages)
+
+    def replace_channel(self, url, packages):
+        """
+        Replace the packages of the channel url (which was added with
+        add_channel).  The info dicts set directly are kept, as are the
+        loaded info dicts of the other channels.
+        """
+        for channel in self._channels:
+            if channel[0] == url:
+                channel[1] = packages
+        sources, loaded = self._sources, self._loaded
+        self._sources, self._loaded, self._names, self.groups = {}, {}, {}, {}
+        for url1, packages1 in self._channels:
+            self._add_channel(url1, packages1)
+        for fn, info in iteritems(self._overlay):
+            if info is not None:
+                self._set(fn, info)
+        for fn, source in iteritems(sources):
+            if fn in loaded and self._sources.get(fn, (None, None))[1] is source[1]:
+                self._loaded[fn] = loaded[fn]
+
+    def load_names(self, names):
+        """
+        Load the packages of names from the shards of the sharded channels
+        (ShardedPackages) which were not loaded yet.  Packages of other
+        channels are all there from the start.
+        """
+        jobs = {}  # shard url -> (rank, channel url, packages, name)
+        for rank, (url, packages) in enumerate(self._channels):
+            if not isinstance(packages, ShardedPackages):
+                continue
+            for name in names:
+                if name in packages.loaded:
+                    continue
+                if name in packages.shards:
+                    jobs[packages.shard_url(name)] = rank, url, packages, name
+                else:
+                    packages.loaded.add(name)
+        if not jobs:
+            return
+        shard_urls = sorted(jobs)
+        fetcher = jobs[shard_urls[0]][2].fetcher
+        log.debug("Fetching %d repodata shards" % len(shard_urls))
+        results = fetcher.map(lambda shard_url, session: jobs[shard_url][2]
+                              .fetch_shard(jobs[shard_url][3], session),
+                              shard_urls)
+
+        ranks = {id(packages): rank for rank, (url, packages) in
+                 enumerate(self._channels)}
+        for shard_url, shard in zip(shard_urls, results):
+            rank, url, packages, name = jobs[shard_url]
+            packages.add(name, shard)
+            for fn, info in iteritems(shard):
+                source = self._sources.get(fn)
+                if fn in self._overlay or (source is not None and
+                                           ranks[id(source[1])] > rank):
+                    continue
+                self._loaded.pop(fn, None)
+                self._sources[fn] = url, packages
+                self._set_name(fn, info['name'])
+        if 'python' in names and config.add_pip_as_python_dependency:
+            add_pip_dependency(self)
+
+    def names(self):
+        """
+        Return the names of all the packages, including the names of the
+        shards of the sharded channels which were not loaded yet.
+        """
+        names = set(self.groups)
+        for url, packages in self._channels:
+            if isinstance(packages, ShardedPackages):
+                names.update(packages.shards)
+        return names
+
+    def load_full(self):
+        """
+        Replace the packages of the channels which have only their current
+        repodata (see CURRENT_REPODATA) by all their packages.
+        """
+        if not self.current:
+            return
+        log.debug("Fetching the full repodata of %s" %
+                  ', '.join(map(config.remove_binstar_tokens, self.current)))
+        fetcher = ChannelFetcher()
+        urls = sorted(self.current)
+        cached = {url for url in urls if self.current[url]}
+        for url, repodata in fetcher.fetch(urls, cached=cached):
+            self.replace_channel(url, repodata['packages'] if repodata else {})
+        self.current = {}
+        if config.add_pip_as_python_dependency:
+            add_pip_dependency(self)
+
+    def refresh(self):
+        """
+        Use the repodata of the channels which was refreshed in the
+        background (see fetch_index), if the refresh is done already.
+        """
+        done = [refresh for refresh in self.pending if not refresh.is_alive()]
+        updated = False
+        for refresh in done:
+            self.pending.remove(refresh)
+            if refresh.repodata is not None:
+                self.replace_channel(refresh.url, refresh.repodata['packages'])
+                self.current.pop(refresh.url, None)
+                updated = True
+        if updated and config.add_pip_as_python_dependency:
+            add_pip_dependency(self)
+
+    def _add_channel(self, url, packages):
+        lazy = isinstance(packages, LazyPackages)
+        for fn in packages:
+            if fn in self._overlay:
+                continue
+            self._loaded.pop(fn, None)
+            self._sources[fn] = url, packages
+            self._set_name(fn, packages.name(fn) if lazy else
+                           packages[fn]['name'])
+
+    def _set(self, fn, info):
+        self._sources.pop(fn, None)
+        self._loaded[fn] = info
+        self._set_name(fn, info['name'])
+
+    def _set_name(self, fn, name):
+        old = self._names.get(fn)
+        if old == name:
+            return
+        if old is not None:
+            self._remove_name(fn, old)
+        self._names[fn] = name
+        self.groups.setdefault(name, []).append(fn)
+
+    def _remove_name(self, fn, name):
+        self.groups[name].remove(fn)
+        if not self.groups[name]:
+            del self.groups[name]
+
+    def __getitem__(self, fn):
+        try:
+            return self._loaded[fn]
+        except KeyError:
+            url, packages = self._sources[fn]
+        info = packages[fn]
+        info['channel'] = url
+        self._loaded[fn] = info
+        return info
+
+    def __setitem__(self, fn, info):
+        self._overlay[fn] = info
+        self._set(fn, info)
+
+    def __delitem__(self, fn):
+        self._remove_name(fn, self._names.pop(fn))
+        self._overlay[fn] = None
+        self._sources.pop(fn, None)
+        self._loaded.pop(fn, None)
+
+    def __contains__(self, fn):
+        return fn in self._names
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+
+class BackgroundRefresh(threading.Thread):
+    """
+    Fetch the repodata of the channel url in a thread, which updates the
+    cache for the next time it is needed.  The repodata is None until the
+    thread is done, or if the fetch failed.  The thread doesn't keep conda
+    from exiting, and the fetch never prompts or prints anything.
+    """
+    def __init__(self, url, session):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = url
+        self.session = session
+        self.repodata = None
+
+    def run(self):
+        try:
+            self.repodata = fetch_repodata(self.url, session=self.session,
+                                           interactive=False)
+        except (Exception, SystemExit) as e:
+            log.debug("Could not refresh the repodata of %s: %s" %
+                      (config.remove_binstar_tokens(self.url), e))
+
+class ChannelFetcher(object):
+    """
+    Fetch the repodata of several channels concurrently (with
+    fetch_repodata), at most max_connections at a time and at most
+    max_per_host at a time from the same host.  The channels of a host
+    share a session, which keeps its connections to the host alive.
+    """
+    def __init__(self, max_connections=None, max_per_host=None):
+        self.max_connections = (max_connections or
+                                config.remote_max_connections)
+        self.max_per_host = (max_per_host or
+                             config.remote_max_connections_per_host)
+        self._slots = threading.BoundedSemaphore(self.max_connections)
+        self._hosts = {}  # (scheme, netloc) -> (session, semaphore)
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        key = urlparse.urlparse(url)[:2]
+        with self._lock:
+            if key not in self._hosts:
+                self._hosts[key] = (
+                    CondaSession(pool_maxsize=self.max_per_host),
+                    threading.BoundedSemaphore(self.max_per_host))
+            return self._hosts[key]
+
+    def session(self, url):
+        """
+        Return the session used for the host of url.
+        """
+        return self._host(url)[0]
+
+    def map(self, func, urls):
+        """
+        Return the list of func(url, session) for the urls, in the same
+        order, session being the session for the host of url.  The calls
+        run concurrently, within the connection limits.  An error of func
+        is raised once all the calls are done.
+        """
+        results = [None] * len(urls)
+        errors = []
+
+        def work(i, url):
+            session, host_slots = self._host(url)
+            try:
+                # Wait for the host first, so that a fetch waiting for its
+                # host doesn't keep a connection slot from the other hosts
+                with host_slots:
+                    with self._slots:
+                        results[i] = func(url, session)
+            except BaseException as e:
+                errors.append((i, e))
+
+        threads = [threading.Thread(target=work, args=(i, url))
+                   for i, url in enumerate(urls)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise min(errors, key=lambda error: error[0])[1]
+        return results
+
+    def fetch(self, urls, use_cache=False, cached=(), current=False):
+        """
+        Return the list of (url, repodata) for the channel urls, in the same
+        order, using only the cache for the urls in cached.
+        """
+        return list(zip(urls, self.map(
+            lambda url, session: fetch_repodata(
+                url, use_cache=use_cache or url in cached, session=session,
+                current=current),
+            urls)))
+
 
 @memoized
 def fetch_index(channel_urls, use_cache=False, unknown=False):
     log.debug('channel_urls=' + repr(channel_urls))
     # pool = ThreadPool(5)
-    index = {}
+    index = PackageIndex()
     stdoutlog.info("Fetching package metadata: ")
-    session = CondaSession()
     for url in reversed(channel_urls):
         if config.allowed_channels and url not in config.allowed_channels:
             sys.exit("""
@@ -244,32 +1162,46 @@ def fetch_index(channel_urls, use_cache=False, unknown=False):
   - %s
 """ % (url, '\n  - '.join(config.allowed_channels)))
 
-    try:
-        import concurrent.futures
-        from collections import OrderedDict
-
-        repodatas = []
-        with concurrent.futures.ThreadPoolExecutor(10) as executor:
-            future_to_url = OrderedDict([(executor.submit(
-                            fetch_repodata, url, use_cache=use_cache,
-                            session=session), url)
-                                         for url in reversed(channel_urls)])
-            for future in future_to_url:
-                url = future_to_url[future]
-                repodatas.append((url, future.result()))
-    except ImportError:
-        # concurrent.futures is only available in Python 3
-        repodatas = map(lambda url: (url, fetch_repodata(url,
-                                     use_cache=use_cache, session=session)),
-                        reversed(channel_urls))
-
-    for url, repodata in repodatas:
+    # The cached repodata is used right away, and refreshed in the background
+    cached = set()
+    if config.background_repodata_refresh and not use_cache:
+        cache_dir = create_cache_dir()
+        cached = {url for url in channel_urls
+                  if cache_age(join(cache_dir, cache_fn_url(url))) is not None}
+
+    fetcher = ChannelFetcher()
+    urls = tuple(reversed(channel_urls))
+    sharded = {}
+    if config.sharded_repodata:
+        manifests = fetcher.map(lambda url, session: fetch_shards_manifest(
+            url, use_cache=use_cache, session=session), urls)
+        sharded = {url: ShardedPackages(url, manifest, fetcher)
+                   for url, manifest in zip(urls, manifests) if manifest}
+    unsharded = [url for url in urls if url not in sharded]
+    current = {}
+    if config.use_current_repodata:
+        # The full repodata is only fetched if the solver needs it
+        current = {url: repodata for url, repodata in fetcher.fetch(
+            unsharded, use_cache=use_cache, current=True) if repodata}
+        index.current = dict.fromkeys(current, use_cache)
+    repodatas = dict(fetcher.fetch([url for url in unsharded
+                                    if url not in current],
+                                   use_cache=use_cache, cached=cached))
+    repodatas.update(current)
+
+    for url in urls:
+        if url in sharded:
+            # The packages are loaded when the solver needs them
+            index.add_channel(url, sharded[url])
+            continue
+        repodata = repodatas[url]
         if repodata is None:
             continue
-        new_index = repodata['packages']
-        for info in itervalues(new_index):
-            info['channel'] = url
-        index.update(new_index)
+        index.add_channel(url, repodata['packages'])
+        if url in cached:
+            refresh = BackgroundRefresh(url, fetcher.session(url))
+            refresh.start()
+            index.pending.append(refresh)
 
     stdoutlog.info('\n')
     if unknown:
@@ -279,9 +1211,13 @@ def fetch_index(channel_urls, use_cache=False, unknown=False):
     return index
 
 
-def fetch_pkg(info, dst_dir=None, session=None):
+def fetch_pkg(info, dst_dir=None, session=None, progress=None,
+              extract=False):
     '''
     fetch a package given by `info` and store it into `dst_dir`
+    (progress is passed to download), also extracting it while it is
+    downloaded if `extract` is true (the tarball is then only kept if the
+    keep_tarballs setting is true)
     '''
     if dst_dir is None:
         dst_dir = config.pkgs_dirs[0]
@@ -293,7 +1229,11 @@ def fetch_pkg(info, dst_dir=None, session=None):
     log.debug("url=%r" % url)
     path = join(dst_dir, fn)
 
-    download(url, path, session=session, md5=info['md5'], urlstxt=True)
+    # (a signed package is only extracted once its signature is checked)
+    assert not (extract and info.get('sig'))
+    digests = download(url, path, session=session, md5=info['md5'],
+                       urlstxt=True, progress=progress, extract=extract,
+                       keep_tarball=config.keep_tarballs)
     if info.get('sig'):
         from conda.signature import verify, SignatureError
 
@@ -301,17 +1241,190 @@ def fetch_pkg(info, dst_dir=None, session=None):
         url = (info['channel'] if info['sig'] == '.' else
                info['sig'].rstrip('/') + '/') + fn2
         log.debug("signature url=%r" % url)
-        download(url, join(dst_dir, fn2), session=session)
+        download(url, join(dst_dir, fn2), session=session,
+                 progress=progress and (lambda n: None))
         try:
-            if verify(path):
+            if verify(path, sha256=digests['sha256']):
                 return
         except SignatureError as e:
             sys.exit(str(e))
         sys.exit("Error: Signature for '%s' is invalid." % (basename(path)))
 
 
+def fetch_pkgs(infos, dst_dir=None, session=None, threads=None,
+               callback=None, extract=()):
+    """
+    Fetch the packages given by the info dicts infos into dst_dir, like
+    fetch_pkg, downloading up to threads of them at the same time (the
+    largest ones first).  The progress is reported as the one of a single
+    download of all the packages.  callback (if given) is called with the
+    info dict of each package as soon as it is fetched, in the thread of
+    the download.  After an error (or an interruption), no other download
+    is started, and the error is raised once the ones which were started
+    are done.  The packages (dists) in extract are also extracted while they are
+    downloaded.
+    """
+    if dst_dir is None:
+        dst_dir = config.pkgs_dirs[0]
+    threads = threads or config.fetch_threads
+    session = session or CondaSession(pool_maxsize=threads)
+
+    # popped from the end, i.e. the largest first
+    queue = sorted(enumerate(infos), key=lambda x: x[1].get('size') or 0)
+    total = sum(info.get('size') or 0 for info in infos)
+    lock = threading.Lock()
+    done = {}  # index in infos -> bytes downloaded
+    state = {'n': 0}
+    errors = []
+    stop = threading.Event()
+
+    def progress(i):
+        def update(n):
+            with lock:
+                state['n'] += n - done.get(i, 0)
+                done[i] = n
+                getLogger('fetch.update').info(min(state['n'], total))
+        return update
+
+    def work():
+        while True:
+            with lock:
+                if stop.is_set() or not queue:
+                    return
+                i, info = queue.pop()
+            try:
+                fetch_pkg(info, dst_dir, session,
+                          progress=progress(i) if total else lambda n: None,
+                          extract=('%(name)s-%(version)s-%(build)s' % info
+                                   in extract))
+                if callback:
+                    callback(info)
+            except BaseException as e:
+                stop.set()
+                with lock:
+                    errors.append((i, e))
+
+    if total:
+        getLogger('fetch.start').info(('%d packages' % len(infos), total))
+    # Lock the directory once for all the downloads, the lock of each
+    # download is then the one of this process, which doesn't wait.
+    with Locked(dst_dir):
+        workers = [threading.Thread(target=work)
+                   for _ in range(min(threads, len(infos)))]
+        for t in workers:
+            # (so that the process can exit when interrupted again)
+            t.daemon = True
+            t.start()
+        try:
+            for t in workers:
+                t.join()
+        except BaseException:
+            # e.g. KeyboardInterrupt, the downloads which were started are
+            # finished before the directory is unlocked
+            stop.set()
+            with lock:
+                del queue[:]
+            for t in workers:
+                t.join()
+            raise
+    if total:
+        getLogger('fetch.stop').info(None)
+    if errors:
+        raise min(errors, key=lambda error: error[0])[1]
+
+
+# urls.txt is appended to by the concurrent downloads of fetch_pkgs
+_urlstxt_lock = threading.Lock()
+
+def read_partial(pp, url):
+    """
+    Return the validator (ETag or Last-Modified) of the file at url recorded
+    for the partial download pp, or None.
+    """
+    try:
+        with open(pp + '.json') as fi:
+            meta = json.load(fi)
+        if meta['url'] == url:
+            return meta['validator']
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def rm_partial(pp):
+    for path in pp, pp + '.json':
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+try:
+    # raised by the reads of a response when the connection is broken
+    from requests.packages.urllib3.exceptions import (
+        HTTPError as ConnectionBroken)
+except ImportError:
+    ConnectionBroken = ()
+
+# seconds to wait before the first retry of a failed download, doubled for
+# each of the following ones
+BACKOFF = 1
+
+class DownloadReader(object):
+    """
+    File object reading the (raw) response raw, which also updates the
+    hashes with the data read, writes it to the file fo (unless None), and
+    calls report with the number of bytes read so far.  The error of the
+    connection or of the file is kept as error (e.g. for tarfile reading
+    from it).
+    """
+    def __init__(self, raw, fo, hashes, report):
+        self.raw = raw
+        self.fo = fo
+        self.hashes = hashes
+        self.report = report
+        self.error = None
+
+    def read(self, size=2**14):
+        try:
+            # Use raw so that requests doesn't decode gz files
+            chunk = self.raw.read(size)
+        except (IOError, ConnectionBroken) as e:
+            self.error = e
+            raise
+        if self.fo is not None:
+            try:
+                self.fo.write(chunk)
+            except IOError:
+                self.error = RuntimeError("Failed to write to %r." %
+                                          self.fo.name)
+                raise self.error
+        for h in itervalues(self.hashes):
+            h.update(chunk)
+        self.report(self.raw.tell())
+        return chunk
+
+
 def download(url, dst_path, session=None, md5=None, urlstxt=False,
-             retries=None):
+             retries=None, progress=None, extract=False, keep_tarball=True):
+    """
+    Download url to dst_path (through dst_path + '.part'), checking the md5
+    if given, and if urlstxt is true recording the url in the urls.txt
+    (and the manifest) of the directory.  The progress is reported to
+    the fetch.* loggers, or if given, by calling progress with the number
+    of bytes downloaded so far.  Return the digests of the file computed
+    while downloading it, {'md5': <hex>, 'sha256': <hex>}.
+
+    A partial download left by a connection error is resumed (with a Range
+    request, if the file on the server didn't change since), and the
+    download is retried, waiting longer after each failure.
+
+    If extract is true, the package dst_path (a .tar.bz2 file) is also
+    extracted into its directory while it is being downloaded, through a
+    temporary directory which is only moved into place if the md5 matches.
+    The tarball is then only kept if keep_tarball is true (a download which
+    isn't kept can't be resumed).
+    """
     pp = dst_path + '.part'
     dst_dir = dirname(dst_path)
     session = session or CondaSession()
@@ -326,16 +1439,35 @@ def download(url, dst_path, session=None, md5=None, urlstxt=False,
 
     if retries is None:
         retries = RETRIES
+
+    def retry(delay=True):
+        if delay:
+            time.sleep(BACKOFF * 2 ** max(0, RETRIES - retries))
+        return download(url, dst_path, session=session, md5=md5,
+                        urlstxt=urlstxt,
+                        retries=retries - 1 if delay else retries,
+                        progress=progress, extract=extract,
+                        keep_tarball=keep_tarball)
+
     with Locked(dst_dir):
+        headers = {}
+        validator = read_partial(pp, url)
+        offset = os.path.getsize(pp) if validator and isfile(pp) else 0
+        if offset:
+            headers = {'Range': 'bytes=%d-' % offset, 'If-Range': validator}
         try:
-            resp = session.get(url, stream=True, proxies=session.proxies)
+            resp = session.get(url, stream=True, proxies=session.proxies,
+                               headers=headers)
             resp.raise_for_status()
         except requests.exceptions.HTTPError as e:
             if e.response.status_code == 407: # Proxy Authentication Required
                 handle_proxy_407(url, session)
                 # Try again
-                return download(url, dst_path, session=session, md5=md5,
-                                urlstxt=urlstxt, retries=retries)
+                return retry(delay=False)
+            if e.response.status_code == 416 and offset:
+                # Range Not Satisfiable, the partial download is too long
+                rm_partial(pp)
+                return retry(delay=False)
             msg = "HTTPError: %s: %s\n" % (e, url)
             log.debug(msg)
             raise RuntimeError(msg)
@@ -349,8 +1481,7 @@ def download(url, dst_path, session=None, md5=None, urlstxt=False,
             if "407" in str(e): # Proxy Authentication Required
                 handle_proxy_407(url, session)
                 # try again
-                return download(url, dst_path, session=session, md5=md5,
-                                urlstxt=urlstxt, retries=retries)
+                return retry(delay=False)
             msg = "Connection error: %s: %s\n" % (e, url)
             stderrlog.info('Could not connect to %s\n' % url)
             log.debug(msg)
@@ -359,66 +1490,141 @@ def download(url, dst_path, session=None, md5=None, urlstxt=False,
         except IOError as e:
             raise RuntimeError("Could not open '%s': %s" % (url, e))
 
+        if offset and (resp.status_code != 206 or
+                       not resp.headers.get('Content-Range', '').startswith(
+                           'bytes %d-' % offset)):
+            # The server sent the whole file, because it doesn't support
+            # ranges or because the file changed
+            log.debug("could not resume the download of %s" % url)
+            offset = 0
+        # All the digests of the file are computed while downloading it
+        hashes = {'md5': hashlib.new('md5'), 'sha256': hashlib.new('sha256')}
+        if offset:
+            log.debug("resuming the download of %s at %d" % (url, offset))
+            with open(pp, 'rb') as fi:
+                for chunk in iter(lambda: fi.read(2**16), b''):
+                    for h in itervalues(hashes):
+                        h.update(chunk)
+        else:
+            rm_partial(pp)
+            validator = (resp.headers.get('ETag') or
+                         resp.headers.get('Last-Modified'))
+            if validator and (keep_tarball or not extract):
+                try:
+                    with open(pp + '.json', 'w') as fo:
+                        json.dump({'url': url, 'validator': validator}, fo)
+                except IOError:
+                    pass
+
+        # The package is extracted from the stream of the download, unless
+        # the download is resumed (it is then extracted from the file)
+        stream = extract and not offset
+        write = keep_tarball or not stream
+
         size = resp.headers.get('Content-Length')
         if size:
-            size = int(size)
+            size = offset + int(size)
             fn = basename(dst_path)
-            getLogger('fetch.start').info((fn[:14], size))
-
-        n = 0
-        if md5:
-            h = hashlib.new('md5')
+            if progress is None:
+                getLogger('fetch.start').info((fn[:14], size))
+
+        def report(nread):
+            n = offset + nread
+            if progress is not None:
+                progress(n)
+            elif size and 0 <= n <= size:
+                getLogger('fetch.update').info(n)
+
+        t0 = time.time()
+        tmp = extract_error = None
         try:
-            with open(pp, 'wb') as fo:
-                more = True
-                while more:
-                    # Use resp.raw so that requests doesn't decode gz files
-                    chunk  = resp.raw.read(2**14)
-                    if not chunk:
-                        more = False
+            fo = open(pp, 'ab' if offset else 'wb') if write else None
+            try:
+                reader = DownloadReader(resp.raw, fo, hashes, report)
+                if stream:
                     try:
-                        fo.write(chunk)
-                    except IOError:
-                        raise RuntimeError("Failed to write to %r." % pp)
-                    if md5:
-                        h.update(chunk)
-                    # update n with actual bytes read
-                    n = resp.raw.tell()
-                    if size and 0 <= n <= size:
-                        getLogger('fetch.update').info(n)
-        except IOError as e:
-            if e.errno == 104 and retries: # Connection reset by pee
-                # try again
+                        tmp = install.extract_tmp(
+                            dst_dir, basename(dst_path)[:-8], fileobj=reader,
+                            engine=config.extract_engine)
+                    except Exception as e:
+                        if reader.error is not None:
+                            raise reader.error
+                        # the md5 tells below if the download is corrupted
+                        extract_error = e
+                # Read the rest of the download (after the end of the
+                # archive, or all of it if it isn't extracted)
+                for chunk in iter(reader.read, b''):
+                    pass
+            except:
+                if tmp:
+                    install.rm_rf(tmp)
+                raise
+            finally:
+                if fo is not None:
+                    fo.close()
+        except (IOError, ConnectionBroken) as e:
+            if retries and (getattr(e, 'errno', None) == 104 or
+                            isinstance(e, ConnectionBroken)):
+                # Connection reset by peer, resume the download (from
+                # another mirror if the channel has some)
                 log.debug("%s, trying again" % e)
-                return download(url, dst_path, session=session, md5=md5,
-                                urlstxt=urlstxt, retries=retries - 1)
+                mirrors.record_failure(resp)
+                return retry()
             raise RuntimeError("Could not open %r for writing (%s)." % (pp, e))
 
-        if size:
+        if size and progress is None:
             getLogger('fetch.stop').info(None)
-
-        if md5 and h.hexdigest() != md5:
+        n = offset + resp.raw.tell()
+        mirrors.record_transfer(resp, n - offset, time.time() - t0)
+
+        digests = dict((name, h.hexdigest()) for name, h in iteritems(hashes))
+        if md5 and digests['md5'] != md5:
+            if tmp:
+                install.rm_rf(tmp)
+            rm_partial(pp)
             if retries:
                 # try again
                 log.debug("MD5 sums mismatch for download: %s (%s != %s), "
-                          "trying again" % (url, h.hexdigest(), md5))
-                return download(url, dst_path, session=session, md5=md5,
-                                urlstxt=urlstxt, retries=retries - 1)
+                          "trying again" % (url, digests['md5'], md5))
+                return retry()
             raise RuntimeError("MD5 sums mismatch for download: %s (%s != %s)"
-                               % (url, h.hexdigest(), md5))
+                               % (url, digests['md5'], md5))
+        if extract_error is not None:
+            rm_partial(pp)
+            raise RuntimeError("Could not extract %s: %s" % (url,
+                                                            extract_error))
 
-        try:
-            os.rename(pp, dst_path)
-        except OSError as e:
-            raise RuntimeError("Could not rename %r to %r: %r" %
-                               (pp, dst_path, e))
+        if write:
+            try:
+                os.rename(pp, dst_path)
+            except OSError as e:
+                if tmp:
+                    install.rm_rf(tmp)
+                raise RuntimeError("Could not rename %r to %r: %r" %
+                                   (pp, dst_path, e))
+            rm_partial(pp)
+
+        if extract:
+            dist = basename(dst_path)[:-8]
+            if tmp is None:
+                tmp = install.extract_tmp(dst_dir, dist,
+                                          engine=config.extract_engine)
+                if not keep_tarball:
+                    os.unlink(dst_path)
+            install.commit_extracted(dst_dir, dist, tmp)
 
         if urlstxt:
-            try:
-                with open(join(dst_dir, 'urls.txt'), 'a') as fa:
-                    fa.write('%s\n' % url)
-            except IOError:
-                pass
+            with _urlstxt_lock:
+                try:
+                    with open(join(dst_dir, 'urls.txt'), 'a') as fa:
+                        fa.write('%s\n' % url)
+                except IOError:
+                    pass
+            if dst_path.endswith('.tar.bz2') and isfile(dst_path):
+                install.update_manifest(
+                    dst_dir, basename(dst_path)[:-8], fetched=True, size=n,
+                    mtime=os.stat(dst_path).st_mtime, **digests)
+        return digests
 
 
 class TmpDownload(object):
@@ -37,6 +37,8 @@
 import subprocess
 import sys
 import tarfile
+import tempfile
+import threading
 import time
 import traceback
 from os.path import abspath, basename, dirname, isdir, isfile, islink, join, relpath
@@ -427,13 +429,243 @@ def try_hard_link(pkgs_dir, prefix, dist):
         rm_rf(dst)
         rm_empty_dir(prefix)
 
+# ------- package cache ----- manifest
+
+# The manifest of a packages directory records, for each dist in it, whether
+# the tarball is fetched (with its md5 and size) and whether the package is
+# extracted (with the part of its index.json used to build an index), so
+# that the package cache can be queried without listing the directory and
+# opening the metadata of every package.  It is valid as long as its mtime
+# is newer than the one of the directory; a change to the directory (e.g.
+# by `conda clean`, or a lock of conda.lock being taken) only causes a
+# rescan, which ignores the locks and reuses the entries of the directories
+# which are still there.  The entry of an extracted package also records the
+# mtime of its info directory, which is checked when the manifest is read,
+# so that a change inside the package directory is noticed as well.
+
+MANIFEST_FN = 'manifest.json'
+MANIFEST_VERSION = 1
+MANIFEST_INDEX_KEYS = ('name', 'version', 'build', 'build_number', 'depends',
+                       'requires', 'features', 'track_features', 'license',
+                       'platform', 'arch', 'md5', 'size')
+
+# pkgs_dir -> (mtime of the directory, mtime of the manifest, dists, whether
+# dists stays valid until the directory changes even if the manifest isn't
+# newer, as when it can't be written, e.g. in a read-only directory)
+_manifests = {}
+# The manifest may be updated by concurrent downloads
+_manifest_lock = threading.RLock()
+
+def _manifest_stamp(pkgs_dir):
+    try:
+        dir_mtime = os.stat(pkgs_dir).st_mtime
+    except OSError:
+        return None
+    try:
+        mtime = os.stat(join(pkgs_dir, MANIFEST_FN)).st_mtime
+    except OSError:
+        mtime = None
+    return dir_mtime, mtime
+
+def _manifest_entry(pkgs_dir, dist):
+    """
+    return the manifest entry of the extracted package dist (without the
+    fetched state), or None if it is not extracted
+    """
+    if not is_extracted(pkgs_dir, dist):
+        return None
+    try:
+        with open(join(pkgs_dir, dist, 'info', 'index.json')) as fi:
+            meta = json.load(fi)
+        info = dict((k, meta[k]) for k in MANIFEST_INDEX_KEYS if k in meta)
+    except (IOError, ValueError):
+        info = None
+    return {'extracted': True, 'index': info,
+            'info_mtime': _info_mtime(pkgs_dir, dist)}
+
+def _info_mtime(pkgs_dir, dist):
+    try:
+        return os.stat(join(pkgs_dir, dist, 'info')).st_mtime
+    except OSError:
+        return None
+
+def _check_extracted(pkgs_dir, dists):
+    """
+    return dists, with the entries of the extracted packages whose info
+    directory changed since they were recorded updated
+    """
+    res = dists
+    for dist, entry in dists.items():
+        if (not entry.get('extracted') or
+                _info_mtime(pkgs_dir, dist) == entry.get('info_mtime')):
+            continue
+        if res is dists:
+            res = dict(dists)
+        entry = dict(entry)
+        entry.update(_manifest_entry(pkgs_dir, dist) or {'extracted': False})
+        if _clean_manifest_entry(entry):
+            res[dist] = entry
+        else:
+            del res[dist]
+    return res
+
+def _scan_pkgs_dir(pkgs_dir, old):
+    """
+    return the dists of pkgs_dir, reusing the entries of old for the
+    directories which are still there
+    """
+    # (the dot entries, such as the .conda_lock-<pid> directories of
+    # conda.lock and the temporary files of the manifest, aren't packages)
+    names = set(fn for fn in os.listdir(pkgs_dir) if not fn.startswith('.'))
+    dists = {}
+    for fn in names:
+        dist = fn[:-8] if fn.endswith('.tar.bz2') else fn
+        if dist in dists or dist == MANIFEST_FN:
+            continue
+        entry = dict(old.get(dist) or {})
+        if dist not in names:
+            entry['extracted'] = False
+        elif not entry.get('extracted'):
+            entry.update(_manifest_entry(pkgs_dir, dist) or
+                         {'extracted': False})
+        entry['fetched'] = dist + '.tar.bz2' in names
+        if entry['fetched'] and 'size' not in entry:
+            entry['size'] = os.path.getsize(join(pkgs_dir, dist + '.tar.bz2'))
+        if _clean_manifest_entry(entry):
+            dists[dist] = entry
+    return dists
+
+def _clean_manifest_entry(entry):
+    """
+    drop the fields of entry which don't apply any more, and return whether
+    it should be kept
+    """
+    if not entry.get('fetched'):
+        for key in 'md5', 'sha256', 'size', 'mtime':
+            entry.pop(key, None)
+    if not entry.get('extracted'):
+        entry.pop('index', None)
+        entry.pop('info_mtime', None)
+    return bool(entry.get('fetched') or entry.get('extracted'))
+
+def _write_manifest(pkgs_dir, dists):
+    path = join(pkgs_dir, MANIFEST_FN)
+    try:
+        fd, tmp = tempfile.mkstemp(prefix='.manifest-', dir=pkgs_dir)
+    except (IOError, OSError) as e:
+        log.debug("could not write the manifest of %s: %s" % (pkgs_dir, e))
+        return
+    try:
+        with os.fdopen(fd, 'w') as fo:
+            json.dump({'version': MANIFEST_VERSION, 'dists': dists}, fo,
+                      sort_keys=True)
+        if on_win and isfile(path):
+            os.unlink(path)
+        os.rename(tmp, path)
+        # The rename changed the mtime of the directory, stamp the manifest
+        # after it.
+        os.utime(path, None)
+    except (IOError, OSError) as e:
+        log.debug("could not write the manifest of %s: %s" % (pkgs_dir, e))
+        rm_rf(tmp)
+
+def load_manifest(pkgs_dir):
+    """
+    return the manifest of pkgs_dir, a dict mapping the dists in it to dicts
+    with the keys 'fetched' and 'extracted' (bools), 'size' (of the tarball,
+    if fetched), 'md5', 'sha256' and 'mtime' (of the tarball, if downloaded
+    by conda) and 'index' (the index.json subset, if extracted).  The
+    returned dict is shared, and must not be modified.
+    """
+    stamp = _manifest_stamp(pkgs_dir)
+    if stamp is None:
+        return {}
+    dir_mtime, mtime = stamp
+    # The manifest may miss a change made in the same clock tick as it was
+    # written, so it is only trusted if it is strictly newer.
+    fresh = mtime is not None and mtime > dir_mtime
+    cached = _manifests.get(pkgs_dir)
+    if cached and cached[:2] == stamp and (fresh or cached[3]):
+        return cached[2]
+    # (for the same reason, a scan is only trusted if the directory was
+    # last changed some time before, the mtimes may be as coarse as 2s)
+    settled = time.time() - 2 > dir_mtime
+
+    with _manifest_lock:
+        old = cached[2] if cached else None
+        if old is None or fresh:
+            try:
+                with open(join(pkgs_dir, MANIFEST_FN)) as fi:
+                    data = json.load(fi)
+                if data['version'] == MANIFEST_VERSION:
+                    old = data['dists']
+            except (IOError, ValueError, KeyError, TypeError):
+                pass
+        if old is None or not fresh:
+            dists = _scan_pkgs_dir(pkgs_dir, old or {})
+        else:
+            dists = old
+        dists = _check_extracted(pkgs_dir, dists)
+        if dists != old:
+            _write_manifest(pkgs_dir, dists)
+        elif not fresh:
+            try:
+                os.utime(join(pkgs_dir, MANIFEST_FN), None)
+            except OSError:
+                pass
+        stamp = _manifest_stamp(pkgs_dir)
+        if stamp:
+            _manifests[pkgs_dir] = stamp + (dists, settled and
+                                            stamp[0] == dir_mtime)
+    return dists
+
+def update_manifest(pkgs_dir, dist, **fields):
+    """
+    update the manifest entry of dist in pkgs_dir with fields (the keys are
+    the ones of the entries returned by load_manifest), e.g.:
+
+        update_manifest(pkgs_dir, dist, fetched=True, md5=md5, size=size)
+
+    This should be called while pkgs_dir is locked, after the change.  It
+    may be called from several threads.
+    """
+    if not isdir(pkgs_dir):
+        return
+    with _manifest_lock:
+        dists = dict(load_manifest(pkgs_dir))
+        entry = dict(dists.get(dist) or
+                     {'fetched': False, 'extracted': False})
+        entry.update(fields)
+        if _clean_manifest_entry(entry):
+            dists[dist] = entry
+        else:
+            dists.pop(dist, None)
+        _write_manifest(pkgs_dir, dists)
+        stamp = _manifest_stamp(pkgs_dir)
+        if stamp:
+            _manifests[pkgs_dir] = stamp + (dists, False)
+
+def stored_digest(pkgs_dir, dist, algorithm='md5'):
+    """
+    return the digest (hex) of the tarball of dist in pkgs_dir computed when
+    it was downloaded, or None if it is unknown or the tarball changed since
+    """
+    entry = load_manifest(pkgs_dir).get(dist)
+    if not entry or algorithm not in entry:
+        return None
+    try:
+        st = os.stat(join(pkgs_dir, dist + '.tar.bz2'))
+    except OSError:
+        return None
+    if (st.st_size, st.st_mtime) != (entry.get('size'), entry.get('mtime')):
+        return None
+    return entry[algorithm]
+
 # ------- package cache ----- fetched
 
 def fetched(pkgs_dir):
-    if not isdir(pkgs_dir):
-        return set()
-    return set(fn[:-8] for fn in os.listdir(pkgs_dir)
-               if fn.endswith('.tar.bz2'))
+    return set(dist for dist, entry in load_manifest(pkgs_dir).items()
+               if entry['fetched'])
 
 def is_fetched(pkgs_dir, dist):
     return isfile(join(pkgs_dir, dist + '.tar.bz2'))
@@ -442,6 +674,7 @@ def rm_fetched(pkgs_dir, dist):
     with Locked(pkgs_dir):
         path = join(pkgs_dir, dist + '.tar.bz2')
         rm_rf(path)
+        update_manifest(pkgs_dir, dist, fetched=False)
 
 # ------- package cache ----- extracted
 
@@ -449,30 +682,53 @@ def extracted(pkgs_dir):
     """
     return the (set of canonical names) of all extracted packages
     """
-    if not isdir(pkgs_dir):
-        return set()
-    return set(dn for dn in os.listdir(pkgs_dir)
-               if (isfile(join(pkgs_dir, dn, 'info', 'files')) and
-                   isfile(join(pkgs_dir, dn, 'info', 'index.json'))))
+    return set(dist for dist, entry in load_manifest(pkgs_dir).items()
+               if entry['extracted'])
 
-def extract(pkgs_dir, dist):
+def extract_tmp(pkgs_dir, dist, fileobj=None, engine=None):
     """
-    Extract a package, i.e. make a package available for linkage.  We assume
-    that the compressed packages is located in the packages directory.
+    Extract the package dist into a new temporary directory of pkgs_dir (see
+    extract), and return its path.  This doesn't lock pkgs_dir, which the
+    caller keeps locked until the directory is committed (see
+    commit_extracted), and may run in another process.  If given, the tarball is read as a stream from the
+    file object fileobj (e.g. while it is being downloaded).  engine is the
+    name of the extraction engine (see get_extract_engine).
+    """
+    tmp = tempfile.mkdtemp(prefix='.extract-%s-' % dist, dir=pkgs_dir)
+    try:
+        get_extract_engine(engine).extract(join(pkgs_dir, dist + '.tar.bz2'),
+                                           tmp, fileobj=fileobj)
+    except:
+        rm_rf(tmp)
+        raise
+    return tmp
+
+def commit_extracted(pkgs_dir, dist, tmp):
+    """
+    Move the package dist extracted into the temporary directory tmp by
+    extract_tmp to its place in pkgs_dir.
     """
     with Locked(pkgs_dir):
         path = join(pkgs_dir, dist)
-        t = tarfile.open(path + '.tar.bz2')
-        t.extractall(path=path)
-        t.close()
-        if sys.platform.startswith('linux') and os.getuid() == 0:
-            # When extracting as root, tarfile will by restore ownership
-            # of extracted files.  However, we want root to be the owner
-            # (our implementation of --no-same-owner).
-            for root, dirs, files in os.walk(path):
-                for fn in files:
-                    p = join(root, fn)
-                    os.lchown(p, 0, 0)
+        if os.path.lexists(path):
+            rm_rf(path)
+        os.rename(tmp, path)
+        update_manifest(pkgs_dir, dist,
+                        **(_manifest_entry(pkgs_dir, dist) or
+                           {'extracted': False}))
+
+def extract(pkgs_dir, dist, engine=None):
+    """
+    Extract a package, i.e. make a package available for linkage.  We assume
+    that the compressed packages is located in the packages directory.  The
+    package is extracted into a temporary directory, which is then renamed,
+    so that a package which is only partly extracted (e.g. by a process
+    which was killed) is never mistaken for an extracted one.  Such a
+    temporary directory is removed by `conda clean --packages`.
+    """
+    with Locked(pkgs_dir):
+        commit_extracted(pkgs_dir, dist, extract_tmp(pkgs_dir, dist,
+                                                     engine=engine))
 
 def is_extracted(pkgs_dir, dist):
     return (isfile(join(pkgs_dir, dist, 'info', 'files')) and
@@ -482,6 +738,254 @@ def rm_extracted(pkgs_dir, dist):
     with Locked(pkgs_dir):
         path = join(pkgs_dir, dist)
         rm_rf(path)
+        update_manifest(pkgs_dir, dist, extracted=False)
+
+# ------- package cache ----- extraction engines
+
+_umask = None
+
+def get_umask():
+    """
+    return the umask of the process (without changing it, when /proc tells)
+    """
+    global _umask
+    if _umask is None:
+        try:
+            with open('/proc/self/status') as fi:
+                for line in fi:
+                    if line.startswith('Umask:'):
+                        _umask = int(line.split()[1], 8)
+        except (IOError, ValueError):
+            pass
+    if _umask is None:
+        _umask = os.umask(0o022)
+        os.umask(_umask)
+    return _umask
+
+class PackageTarFile(tarfile.TarFile):
+    """
+    TarFile extracting packages with fewer system calls: the files are owned
+    by the user extracting them (root when extracting as root, which is our
+    implementation of --no-same-owner), the directories are created once
+    (with their final mode), the modes which are already the ones the
+    files and directories were created with are not set again, and the
+    modification times of the directories (which aren't used) are not set.
+    """
+    def __init__(self, *args, **kwargs):
+        super(PackageTarFile, self).__init__(*args, **kwargs)
+        self.umask = get_umask()
+        # path -> mode the directories were created with
+        self.dirs = {}
+        # path -> mode of the directories of the archive (extractall may
+        # pass a copy of their members with another mode to makedir)
+        self.dir_modes = {}
+        # paths of the files which were extracted
+        self.files = set()
+        # (as root with another group, the files are given to root)
+        self.chown_root = (not on_win and os.geteuid() == 0 and
+                           os.getegid() != 0)
+
+    def extract_package(self, path):
+        """
+        extract all the members into the (new) directory path
+        """
+        self.extractall(path, members=self._make_dirs(path))
+
+    def _make_dirs(self, path):
+        # yield the members, once the directories they are in are created
+        # (remembering which ones are, instead of checking it each time)
+        for m in self:
+            parts = m.name.split('/')
+            if not (m.name.startswith('/') or '..' in parts):
+                parts = [part for part in parts if part not in ('', '.')]
+                for i in range(1, len(parts)):
+                    p = os.path.normpath(join(path, *parts[:i]))
+                    if p in self.dirs:
+                        continue
+                    try:
+                        os.mkdir(p)
+                    except OSError:
+                        # (e.g. a symbolic link to a directory of the
+                        # package, which is extracted before its files)
+                        if not isdir(p):
+                            raise
+                        self.dirs[p] = None
+                    else:
+                        self.dirs[p] = 0o777 & ~self.umask
+                        if self.chown_root:
+                            os.lchown(p, 0, 0)
+                if m.isdir() and m.mode is not None:
+                    self.dir_modes[os.path.normpath(join(path, *parts))] = \
+                        m.mode
+            yield m
+
+    def makedir(self, tarinfo, targetpath):
+        p = os.path.normpath(targetpath)
+        if p in self.dirs:
+            return
+        if tarinfo.mode is None:
+            # (e.g. with the data extraction filter)
+            super(PackageTarFile, self).makedir(tarinfo, targetpath)
+            self.dirs[p] = None
+            return
+        mode = (self.dir_modes.get(p, tarinfo.mode) | 0o700) & 0o777
+        try:
+            os.mkdir(p, mode)
+        except OSError:
+            if not isdir(p):
+                raise
+        else:
+            self.dirs[p] = mode & ~self.umask
+
+    def chown(self, tarinfo, targetpath, *args, **kwargs):
+        if self.chown_root:
+            os.lchown(targetpath, 0, 0)
+
+    def chmod(self, tarinfo, targetpath):
+        if tarinfo.mode is None:
+            return super(PackageTarFile, self).chmod(tarinfo, targetpath)
+        p = os.path.normpath(targetpath)
+        mode = tarinfo.mode & 0o7777
+        if tarinfo.isdir():
+            if self.dirs.get(p) == mode:
+                return
+        elif tarinfo.isreg() and p not in self.files:
+            self.files.add(p)
+            if mode == 0o666 & ~self.umask:
+                return
+        super(PackageTarFile, self).chmod(tarinfo, targetpath)
+
+    def utime(self, tarinfo, targetpath):
+        if not tarinfo.isdir():
+            super(PackageTarFile, self).utime(tarinfo, targetpath)
+
+class TarfileEngine(object):
+    """
+    Extract packages with the tarfile module (see PackageTarFile).
+    """
+    name = 'tarfile'
+
+    def available(self):
+        return True
+
+    def extract(self, path, dst_dir, fileobj=None):
+        """
+        Extract the tarball path into the (new) directory dst_dir, reading
+        it from the file object fileobj instead if given.
+        """
+        if fileobj is None:
+            t = PackageTarFile.open(path)
+        else:
+            t = PackageTarFile.open(fileobj=fileobj, mode='r|bz2')
+        t.extract_package(dst_dir)
+        t.close()
+
+def find_program(names):
+    """
+    return the path of the first of the programs names found in PATH, or
+    None
+    """
+    for name in names:
+        for dir_path in os.environ.get('PATH', '').split(os.pathsep):
+            path = join(dir_path, name)
+            if isfile(path) and os.access(path, os.X_OK):
+                return path
+    return None
+
+class TarEngine(object):
+    """
+    Extract packages with the tar (GNU tar or bsdtar) program, and with GNU
+    tar a parallel bzip2 (lbzip2 or pbzip2) if there is one, or bzip2 (GNU
+    tar isn't used without any).  The files have the owner and the modes
+    they have with the tarfile engine.
+    """
+    name = 'tar'
+    # bytes written at once to tar, when reading from a file object
+    chunk_size = 2 ** 16
+
+    def __init__(self):
+        self.args = None
+
+    def available(self):
+        if self.args is None:
+            self.args = []
+            tar = None if on_win else find_program(['tar', 'bsdtar'])
+            if tar:
+                self.args = [tar, '-x', '--no-same-owner', '-p']
+                try:
+                    version = subprocess.Popen(
+                        [tar, '--version'], stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE).communicate()[0]
+                except OSError:
+                    version = b''
+                if b'GNU tar' in version:
+                    bzip2 = find_program(['lbzip2', 'pbzip2', 'bzip2'])
+                    if bzip2:
+                        self.args.append('--use-compress-program=%s' %
+                                         bzip2)
+                    else:
+                        self.args = []
+                # (bsdtar detects the compression itself)
+        return bool(self.args)
+
+    def extract(self, path, dst_dir, fileobj=None):
+        """
+        Extract the tarball path into the (new) directory dst_dir, reading
+        it from the file object fileobj instead if given.
+        """
+        assert self.available()
+        # (tar reads the tarball from its standard input in both cases)
+        fi = open(path, 'rb') if fileobj is None else None
+        with tempfile.TemporaryFile() as stderr:
+            try:
+                p = subprocess.Popen(self.args + ['-f', '-', '-C', dst_dir],
+                                     stdin=fi or subprocess.PIPE,
+                                     stderr=stderr)
+            finally:
+                if fi is not None:
+                    fi.close()
+            try:
+                if fileobj is not None:
+                    try:
+                        for chunk in iter(
+                                lambda: fileobj.read(self.chunk_size), b''):
+                            p.stdin.write(chunk)
+                    except (IOError, OSError) as e:
+                        # tar stopped reading (an error is reported below)
+                        if e.errno != errno.EPIPE:
+                            raise
+                    try:
+                        p.stdin.close()
+                    except (IOError, OSError):
+                        pass
+            except:
+                p.kill()
+                p.wait()
+                raise
+            if p.wait() != 0:
+                stderr.seek(0)
+                raise RuntimeError("could not extract %s: %s" %
+                                   (path, stderr.read().decode('utf-8',
+                                                               'replace')))
+        if not on_win and os.geteuid() == 0 and os.getegid() != 0:
+            # as root with another group, the files are given to root, as
+            # by PackageTarFile
+            for root, dirs, files in os.walk(dst_dir):
+                for fn in dirs + files:
+                    os.lchown(join(root, fn), 0, 0)
+
+# the extraction engines, the fastest one first
+extract_engines = [TarEngine(), TarfileEngine()]
+
+def get_extract_engine(name=None):
+    """
+    return the extraction engine called name, or if name is None (or
+    'auto') the fastest one which is available
+    """
+    for engine in extract_engines:
+        if name in (None, 'auto', engine.name) and engine.available():
+            return engine
+    raise RuntimeError("extraction engine not available: %s" % name)
 
 # ------- linkage of packages
 
@@ -538,7 +1042,6 @@ def move_path_to_trash(path):
     from conda import config
 
     for pkg_dir in config.pkgs_dirs:
-        import tempfile
         trash_dir = join(pkg_dir, '.trash')
 
         try:
@@ -1,10 +1,20 @@
+from glob import glob
+from itertools import takewhile
 from logging import getLogger
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from os.path import join
 import re
+import threading
 
 from conda import config
 from conda import install
+from conda.compat import urlparse
+from conda.connection import CondaSession
+from conda.lock import Locked
+from conda.utils import fork_context
 from conda.exceptions import InvalidInstruction
-from conda.fetch import fetch_pkg
+from conda.fetch import fetch_pkg, fetch_pkgs
 
 
 log = getLogger(__name__)
@@ -42,14 +52,133 @@ def PRINT_CMD(state, arg):
     getLogger('print').info(arg)
 
 
-def fetch(index, dist):
+def fetch(index, dist, session=None):
     assert index is not None
     fn = dist + '.tar.bz2'
-    fetch_pkg(index[fn])
+    fetch_pkg(index[fn], session=session)
+
+
+def get_session(state, infos=()):
+    """
+    Return the session of the execution of the plan, which is used for all
+    its downloads (of the packages infos, and of their signatures), so that
+    the connections to the hosts of the channels are kept alive between
+    them.  Each host has a connection for each download thread.
+    """
+    if state.get('session') is None:
+        hosts = set(urlparse.urlparse(info['channel'])[:2] for info in infos)
+        state['session'] = CondaSession(pool_maxsize=config.fetch_threads,
+                                        pool_connections=max(10, len(hosts)))
+    return state['session']
+
+
+def fetch_all(index, dists, pipeline=None, session=None, extract=()):
+    assert index is not None
+    fetch_pkgs([index[dist + '.tar.bz2'] for dist in dists],
+               session=session,
+               callback=pipeline and (lambda info: pipeline.add(
+                   '%(name)s-%(version)s-%(build)s' % info)),
+               extract=extract)
+
+
+def streamed_dists(plan, index):
+    """
+    Return the set of the dists which are both fetched and extracted by the
+    plan, and which can be extracted while they are downloaded (i.e. which
+    are not signed, nor removed in between).
+    """
+    if not config.stream_extract:
+        return set()
+    dists = dict((instruction, set()) for instruction in
+                 (FETCH, EXTRACT, RM_EXTRACTED))
+    for instruction, arg in plan:
+        if instruction in dists:
+            dists[instruction].add(arg)
+    return set(dist for dist in dists[FETCH] & dists[EXTRACT]
+               if dist not in dists[RM_EXTRACTED] and
+               not index[dist + '.tar.bz2'].get('sig'))
+
+
+class ExtractPipeline(object):
+    """
+    Extract the packages dists into pkgs_dir in a pool of processes (of
+    config.extract_processes, or as many as there are CPUs, but no more
+    than there are packages), each one as
+    soon as it is added (i.e. as soon as its tarball is available), while
+    the other packages are being downloaded.  Each package is extracted into
+    a temporary directory, which is only moved into pkgs_dir when its
+    EXTRACT instruction waits for it.  The packages directory is locked
+    until close is called.
+    """
+    def __init__(self, pkgs_dir, dists, processes=None):
+        self.pkgs_dir = pkgs_dir
+        self.dists = set(dists)
+        self.results = {}
+        processes = min(processes or config.extract_processes or
+                        cpu_count(), len(self.dists))
+        self.pool = None
+        if processes > 1:
+            self.pool = process_pool(processes)
+        if self.pool is None:
+            self.pool = ThreadPool(1)
+        self.lock = Locked(pkgs_dir)
+        self.lock.__enter__()
+
+    def add(self, dist):
+        if dist in self.dists and dist not in self.results:
+            self.results[dist] = self.pool.apply_async(
+                install.extract_tmp, (self.pkgs_dir, dist, None,
+                                      config.extract_engine))
+
+    def wait(self, dist):
+        """
+        Wait for the extraction of dist, move it into the packages directory
+        and return True, or False if dist was not added to the pipeline.
+        """
+        result = self.results.pop(dist, None)
+        if result is None:
+            return False
+        install.commit_extracted(self.pkgs_dir, dist, result.get())
+        return True
+
+    def close(self):
+        if self.results:
+            # the plan was interrupted, the extractions which are not done
+            # are abandoned
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+        for dist in self.results:
+            for tmp in glob(join(self.pkgs_dir, '.extract-%s-*' % dist)):
+                install.rm_rf(tmp)
+        self.lock.__exit__(None, None, None)
+
+
+def process_pool(processes):
+    """
+    Return a pool of processes forked from this one (see
+    conda.utils.fork_context), or None if that is not possible, or not safe
+    because other threads are running (e.g. a BackgroundRefresh of the
+    index), whose locks a forked process would inherit in whatever state
+    they are.
+    """
+    context = fork_context()
+    if context is None or threading.active_count() > 1:
+        return None
+    return context.Pool(processes)
+
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
 
 
 def FETCH_CMD(state, arg):
-    fetch(state['index'], arg)
+    fetch(state['index'], arg,
+          session=get_session(state, [state['index'][arg + '.tar.bz2']]))
 
 
 def PROGRESS_CMD(state, arg):
@@ -59,7 +188,13 @@ def PROGRESS_CMD(state, arg):
 
 
 def EXTRACT_CMD(state, arg):
-    install.extract(config.pkgs_dirs[0], arg)
+    if arg in (state.get('streamed') or ()):
+        # extracted while it was downloaded
+        return
+    pipeline = state.get('pipeline')
+    if pipeline and pipeline.wait(arg):
+        return
+    install.extract(config.pkgs_dirs[0], arg, engine=config.extract_engine)
 
 
 def RM_EXTRACTED_CMD(state, arg):
@@ -130,9 +265,63 @@ def execute_instructions(plan, index=None, verbose=False, _commands=None):
         from conda.console import setup_verbose_handlers
         setup_verbose_handlers()
 
-    state = {'i': None, 'prefix': config.root_dir, 'index': index}
+    state = {'i': None, 'prefix': config.root_dir, 'index': index,
+             'pipeline': None, 'session': None, 'streamed': None}
 
-    for instruction, arg in plan:
+    plan = list(plan)
+    try:
+        _execute(plan, state, _commands)
+    finally:
+        if state['pipeline']:
+            state['pipeline'].close()
+        if state['session']:
+            state['session'].close()
+
+    install.messages(state['prefix'])
+
+
+def _execute(plan, state, _commands):
+    for i, (instruction, arg) in enumerate(plan):
+
+        if (instruction in (FETCH, EXTRACT) and state['streamed'] is None
+                and _commands.get(EXTRACT) is EXTRACT_CMD):
+            # The packages which can be are extracted while they are
+            # downloaded (with the stream_extract setting)
+            state['streamed'] = set()
+            if _commands.get(FETCH) is FETCH_CMD:
+                state['streamed'] = streamed_dists(plan[i:], state['index'])
+            # The other ones are extracted in a pool of processes (while the
+            # packages are being downloaded), their EXTRACT instructions then
+            # wait for it.  The pool is started before the download threads.
+            # (not the ones removed before, which their EXTRACT instruction
+            # extracts again)
+            removed = set(arg2 for instruction2, arg2 in plan[i:]
+                          if instruction2 == RM_EXTRACTED)
+            extract = [arg2 for instruction2, arg2 in plan[i:]
+                       if instruction2 == EXTRACT and
+                       arg2 not in state['streamed'] and arg2 not in removed]
+            if extract:
+                fetched = set(arg2 for instruction2, arg2 in plan[i:]
+                              if instruction2 == FETCH)
+                pipeline = ExtractPipeline(config.pkgs_dirs[0], extract)
+                state['pipeline'] = pipeline
+                for dist in extract:
+                    if dist not in fetched:
+                        pipeline.add(dist)
+
+        if instruction == FETCH and _commands.get(FETCH) is FETCH_CMD:
+            # The packages of consecutive FETCH instructions are downloaded
+            # concurrently, when the first one is executed
+            if i and plan[i - 1][0] == FETCH:
+                continue
+            dists = [arg2 for instruction2, arg2 in
+                     takewhile(lambda x: x[0] == FETCH, plan[i:])]
+            log.debug(' %s(%r)' % (instruction, dists))
+            session = get_session(state, [state['index'][dist + '.tar.bz2']
+                                          for dist in dists])
+            fetch_all(state['index'], dists, state['pipeline'], session,
+                      extract=state['streamed'] or ())
+            continue
 
         log.debug(' %s(%r)' % (instruction, arg))
 
@@ -151,5 +340,3 @@ def execute_instructions(plan, index=None, verbose=False, _commands=None):
                 and state['maxval'] == state['i']):
             state['i'] = None
             getLogger('progress.stop').info(None)
-
-    install.messages(state['prefix'])
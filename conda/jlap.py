@@ -0,0 +1,210 @@
+# (c) 2012-2015 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+"""
+Incremental repodata updates
+
+A channel can serve a repodata.jlap file next to repodata.json.bz2, which is
+an append-only log of JSON patches (RFC 6902) between versions of
+repodata.json, identified by the SHA-256 hex digest of the repodata.json
+file.  The lines of the file are:
+
+  - a hex digest, the initial value of the running checksum
+  - the patches, as JSON objects {"from": <hash>, "to": <hash>,
+    "patch": [<operation>, ...]}
+  - a JSON object with the metadata, {"latest": <hash of repodata.json>}
+  - the running checksum after the last JSON line, which is the hex digest
+    of sha256(<previous checksum (bytes)> + <line (UTF-8)>)
+
+The checksum lets the client detect a corrupt (or truncated) file.  This is
+modeled on the jlap format, with SHA-256 instead of BLAKE2 (which is not
+available in Python 2).
+
+As the patches are appended to the file (the last two lines being
+rewritten), a client remembers the position of the end of the last patch
+line and the running checksum there, and later only requests the rest of
+the file from that position (an HTTP Range request).
+
+For the patched repodata to be checked against the hashes of the log, the
+channel writes its repodata.json as dumps_repodata() does.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import binascii
+import copy
+import hashlib
+import json
+
+
+def checksum(prev, line):
+    """
+    Return the running checksum (hex) after line, prev being the one before.
+    """
+    h = hashlib.sha256(binascii.unhexlify(prev.encode('ascii')))
+    h.update(line.encode('utf-8'))
+    return h.hexdigest()
+
+
+def dumps(patches, latest, iv='0' * 64):
+    """
+    Return the text of a jlap file with the given patches, for a
+    repodata.json with the hash latest.
+    """
+    lines = [iv]
+    lines.extend(json.dumps(patch, sort_keys=True) for patch in patches)
+    lines.append(json.dumps({'latest': latest}, sort_keys=True))
+    check = iv
+    for line in lines[1:]:
+        check = checksum(check, line)
+    lines.append(check)
+    return '\n'.join(lines) + '\n'
+
+
+def loads(text):
+    """
+    Parse the text of a jlap file and return the list of patches and the
+    metadata.  Raises ValueError if the file is invalid.
+    """
+    return parse(text.encode('utf-8'))[:2]
+
+
+def parse(data, iv=None):
+    """
+    Parse the contents (bytes) of a jlap file and return the list of
+    patches, the metadata, and the position (in bytes) of the end of the
+    last patch line with the running checksum there, from where the file
+    can be read again once more patches are appended.  If iv is given, data
+    is the rest of a jlap file from such a position, iv being the checksum
+    there.  Raises ValueError if the data is invalid.
+    """
+    lines = data.split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    pos = 0
+    if iv is None:
+        if not lines:
+            raise ValueError("Incomplete jlap file")
+        pos = len(lines[0]) + 1
+        iv = lines.pop(0).decode('ascii')
+    if len(lines) < 2:
+        raise ValueError("Incomplete jlap file")
+    lines = [line.decode('utf-8') for line in lines]
+    checks = [iv]
+    try:
+        for line in lines[:-1]:
+            checks.append(checksum(checks[-1], line))
+    except (TypeError, binascii.Error) as e:
+        raise ValueError("Invalid jlap file: %s" % e)
+    if checks[-1] != lines[-1]:
+        raise ValueError("The jlap checksum does not match")
+    patches = [json.loads(line) for line in lines[:-2]]
+    meta = json.loads(lines[-2])
+    if not isinstance(meta, dict) or 'latest' not in meta:
+        raise ValueError("No latest hash in the jlap file")
+    pos += sum(len(line.encode('utf-8')) + 1 for line in lines[:-2])
+    return patches, meta, pos, checks[-2]
+
+
+def dumps_repodata(repodata):
+    """
+    Return the contents of repodata.json (bytes) for repodata, as a channel
+    serving a jlap file writes it.  The keys starting with an underscore
+    (which conda adds to its cache) are left out.
+    """
+    repodata = {key: value for key, value in repodata.items()
+                if not key.startswith('_')}
+    return json.dumps(repodata, indent=2, sort_keys=True,
+                      separators=(',', ': ')).encode('utf-8')
+
+
+def repodata_hash(repodata):
+    """
+    Return the hash identifying repodata in the log.
+    """
+    return hashlib.sha256(dumps_repodata(repodata)).hexdigest()
+
+
+def find_patches(patches, have, want):
+    """
+    Return the patches (in order) to go from the version of repodata.json
+    with the hash have to the one with the hash want.  Raises ValueError if
+    the log does not lead from one to the other.
+    """
+    to = {}
+    for patch in patches:
+        to[patch['to']] = patch
+    res = []
+    while want != have:
+        if want not in to or len(res) > len(patches):
+            raise ValueError("No patches from %s" % have)
+        res.append(to[want])
+        want = to[want]['from']
+    return res[::-1]
+
+
+def _pointer(doc, path):
+    """
+    Return the container and the key (or index) for the JSON pointer path.
+    """
+    if not path.startswith('/'):
+        raise ValueError("Invalid JSON pointer: %r" % path)
+    parts = [part.replace('~1', '/').replace('~0', '~') for part in
+             path.split('/')[1:]]
+    for part in parts[:-1]:
+        doc = doc[int(part) if isinstance(doc, list) else part]
+    key = parts[-1]
+    if isinstance(doc, list):
+        key = len(doc) if key == '-' else int(key)
+    return doc, key
+
+
+def apply_patch(doc, operations):
+    """
+    Apply the JSON patch operations (RFC 6902) to doc in place.  The root of
+    doc can't be replaced.  Raises ValueError if an operation fails (doc may
+    then be partially patched).
+    """
+    for op in operations:
+        try:
+            container, key = _pointer(doc, op['path'])
+            name = op['op']
+            if name == 'add':
+                _add(container, key, op['value'])
+            elif name == 'remove':
+                _pop(container, key)
+            elif name == 'replace':
+                _pop(container, key)
+                _add(container, key, op['value'])
+            elif name == 'move':
+                value = _pop(*_pointer(doc, op['from']))
+                container, key = _pointer(doc, op['path'])
+                _add(container, key, value)
+            elif name == 'copy':
+                source, skey = _pointer(doc, op['from'])
+                _add(container, key, copy.deepcopy(source[skey]))
+            elif name == 'test':
+                if container[key] != op['value']:
+                    raise ValueError("Test failed")
+            else:
+                raise ValueError("Unknown operation")
+        except (KeyError, IndexError, TypeError, ValueError) as e:
+            raise ValueError("Could not apply %r: %s" % (op, e))
+
+
+def _add(container, key, value):
+    if isinstance(container, list):
+        if not 0 <= key <= len(container):
+            raise IndexError(key)
+        container.insert(key, value)
+    else:
+        container[key] = value
+
+
+def _pop(container, key):
+    if isinstance(container, list) and key < 0:
+        raise IndexError(key)
+    return container.pop(key)
@@ -25,7 +25,9 @@
 
 """
 import sys
+import time
 from collections import defaultdict
+from contextlib import contextmanager
 from functools import total_ordering, partial
 from itertools import chain
 import logging
@@ -487,7 +489,65 @@ def generate_constraints(eq, m, rhs, alg='BDD', sorter_cache={}):
 
     return C.clauses | additional_clauses
 
-def bisect_constraints(min_rhs, max_rhs, clauses, func, increment=10, evaluate_func=None):
+class TimeBudget(object):
+    """
+    Keep track of the wall clock time spent solving, against an optional
+    budget given in seconds (None means unlimited).
+
+    The functions in this module that accept a budget check it between SAT
+    calls. When it runs out they stop searching and return the best solution
+    found so far, and set `exhausted`, meaning that the result is valid but
+    not proven to be optimal.
+    """
+    def __init__(self, seconds=None):
+        self.seconds = seconds
+        self.start = time.time()
+        self.phases = []
+        self.exhausted = False
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def remaining(self):
+        """
+        Return the number of seconds left (None if unlimited).
+        """
+        if self.seconds is None:
+            return None
+        return max(0, self.seconds - self.elapsed())
+
+    def expired(self):
+        if self.seconds is None:
+            return False
+        if self.elapsed() >= self.seconds:
+            self.exhausted = True
+        return self.exhausted
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Record the time spent in the with block under the given name.
+        """
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.time() - t0))
+            log.debug("Solver phase %s took %.3fs" % (name, self.phases[-1][1]))
+
+    def report(self):
+        phases = defaultdict(float)
+        for name, t in self.phases:
+            phases[name] += t
+        return {
+            'optimal': not self.exhausted,
+            'time_budget': self.seconds,
+            'elapsed': round(self.elapsed(), 3),
+            'phases': {name: round(t, 3) for name, t in phases.items()},
+        }
+
+def bisect_constraints(min_rhs, max_rhs, clauses, func, increment=10,
+    evaluate_func=None, budget=None):
     """
     Bisect the solution space of a constraint, to minimize it.
 
@@ -500,25 +560,38 @@ def bisect_constraints(min_rhs, max_rhs, clauses, func, increment=10, evaluate_f
 
     If evalaute_func is given, it is used to evaluate solutions to aid in the bisection.
 
+    If budget (a TimeBudget) is given and runs out, the bisection stops and
+    the last satisfiable constraints are returned (an empty set if none was
+    found yet).
+
     """
     lo, hi = [min_rhs, max_rhs]
+    best = set()
     while True:
+        if budget and budget.expired():
+            log.debug("Time budget exhausted while bisecting, using rhs <= %s" % hi)
+            return best
         mid = min([lo + increment, (lo + hi)//2])
         rhs = [lo, mid]
 
         dotlog.debug("Building the constraint with rhs: %s" % rhs)
         constraints = func(*rhs)
-        if false in constraints: # build_BDD returns false if the rhs is
-                                 # too big to be satisfied. XXX: This
-            break                # probably indicates a bug.
-        if true in constraints:
-            constraints = set([])
-
-        dotlog.debug("Checking for solutions with rhs:  %s" % rhs)
-        solution = sat(chain(clauses, constraints))
+        if false in constraints or (false,) in constraints:
+            # No left-hand side value falls in rhs (e.g., the coefficients
+            # have gaps), so there is nothing to check.
+            dotlog.debug("No attainable values with rhs:  %s" % rhs)
+            solution = None
+        else:
+            if true in constraints or (true,) in constraints:
+                constraints = set([])
+            dotlog.debug("Checking for solutions with rhs:  %s" % rhs)
+            solution = sat(chain(clauses, constraints))
         if lo >= hi:
+            if not solution:
+                constraints = best
             break
         if solution:
+            best = constraints
             if lo == mid:
                 break
             # bisect good
@@ -536,7 +609,8 @@ class MaximumIterationsError(Exception):
     pass
 
 # TODO: alg='sorter' can be faster, especially when the main algorithm is sorter
-def min_sat(clauses, max_n=1000, N=None, alg='sorter', raise_on_max_n=False):
+def min_sat(clauses, max_n=1000, N=None, alg='sorter', raise_on_max_n=False,
+    budget=None):
     """
     Calculate the SAT solutions for the `clauses` for which the number of true
     literals from 1 to N is minimal.  Returned is the list of those solutions.
@@ -551,6 +625,10 @@ def min_sat(clauses, max_n=1000, N=None, alg='sorter', raise_on_max_n=False):
     this case, it is possible another minimal solution could be found if max_n
     were larger.
 
+    If budget (a TimeBudget) is given and runs out, the search stops early and
+    the smallest solutions found so far are returned (MaximumIterationsError
+    is not raised in this case).
+
     """
     log.debug("min_sat using alg: %s" % alg)
     try:
@@ -579,6 +657,9 @@ def min_sat(clauses, max_n=1000, N=None, alg='sorter', raise_on_max_n=False):
                 min_tl, solutions = tl, [sol]
             elif tl == min_tl:
                 solutions.append(sol)
+            if budget and budget.expired():
+                log.debug("Time budget exhausted while iterating solutions")
+                return solutions
         log.debug("Iterate ran %s times" % (i + 1))
         if i + 1 == max_n and raise_on_max_n:
             raise MaximumIterationsError("min_sat ran max_n times")
@@ -596,9 +677,14 @@ def func(lo, hi):
         max_val = evaluate_func(solution)
         log.debug("Using max_val %s. N=%s" % (max_val, N))
         constraints = bisect_constraints(0, min(max_val, N), clauses, func,
-            evaluate_func=evaluate_func, increment=1000)
-
-        return min_sat(list(chain(clauses, constraints)), max_n=max_n, N=N, alg='iterate')
+            evaluate_func=evaluate_func, increment=1000, budget=budget)
+        if budget and budget.expired():
+            # The best solution found so far, within the constraints
+            # found by the bisection
+            return [sat(chain(clauses, constraints)) or solution]
+
+        return min_sat(list(chain(clauses, constraints)), max_n=max_n, N=N,
+            alg='iterate', budget=budget)
 
 def sat(clauses):
     """
@@ -0,0 +1,274 @@
+# (c) 2012-2015 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+"""
+Mirrors of channels
+
+The channel_mirrors setting of .condarc maps base URLs of channels to the
+base URLs of their mirrors, e.g.:
+
+    channel_mirrors:
+      https://repo.continuum.io/pkgs/:
+        - https://mirror1.example.com/pkgs/
+        - https://mirror2.example.com/pkgs/
+
+A request of a CondaSession for a URL under such a base URL is sent to the
+best of the channel and its mirrors: the one with the lowest expected time
+for a request (from the averages of its latency and throughput), among the
+ones which didn't fail recently.  If it can't be reached (within TIMEOUT,
+unless the request has a timeout), or if it answers with a server error,
+the next one is tried.  A mirror without statistics is first probed with a
+HEAD request of its base URL.  The statistics are kept in the cache
+directory (mirrors.json), for the next time.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from logging import getLogger
+from os.path import isdir, join
+
+import requests
+
+from conda import config
+from conda.install import on_win
+
+
+log = getLogger(__name__)
+
+MIRRORS_FN = 'mirrors.json'
+# seconds during which a mirror which failed is only used if the others
+# failed too
+FAILURE_TIMEOUT = 300
+# weight of a new measure in the (exponential moving) averages
+ALPHA = 0.3
+# size of a typical request (in bytes), to weigh the latency and the
+# throughput
+REQUEST_SIZE = 2 ** 20
+# seconds to wait for the answer to a probe
+PROBE_TIMEOUT = 5
+# seconds to wait for a mirror to connect or to send data, if the request
+# has no timeout
+TIMEOUT = 30
+# minimum number of seconds between two saves of the statistics (except
+# after a failure, and at exit)
+SAVE_INTERVAL = 10
+
+
+class MirrorStats(object):
+    """
+    The statistics of mirrors (by base URL), saved in the JSON file path:
+    the averages of their latency (in seconds) and throughput (in bytes per
+    second), and the time of their last failure.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.saved = 0  # time of the last save
+        self.pending = False  # whether there are changes to save
+        try:
+            with open(path) as fi:
+                self.stats = json.load(fi)
+        except (IOError, ValueError):
+            self.stats = {}
+
+    def _update(self, mirror, key, value):
+        with self.lock:
+            stats = self.stats.setdefault(mirror, {})
+            if key == 'failed' or stats.get(key) is None:
+                stats[key] = value
+            else:
+                stats[key] = ALPHA * value + (1 - ALPHA) * stats[key]
+            self.pending = True
+            if key == 'failed' or time.time() - self.saved >= SAVE_INTERVAL:
+                self.save()
+
+    def record(self, mirror, latency):
+        self._update(mirror, 'latency', latency)
+
+    def record_transfer(self, mirror, nbytes, seconds):
+        if nbytes and seconds > 0:
+            self._update(mirror, 'throughput', nbytes / seconds)
+
+    def record_failure(self, mirror):
+        log.debug("mirror failed: %s" % mirror)
+        self._update(mirror, 'failed', time.time())
+
+    def measured(self, mirror):
+        return self.stats.get(mirror, {}).get('latency') is not None
+
+    def key(self, mirror):
+        """
+        The sort key of mirror, the best mirror first.
+        """
+        stats = self.stats.get(mirror, {})
+        failed = time.time() - stats.get('failed', 0) < FAILURE_TIMEOUT
+        expected = stats.get('latency') or 0
+        if stats.get('throughput'):
+            expected += REQUEST_SIZE / stats['throughput']
+        return failed, expected
+
+    def save(self):
+        # Write a temporary file which then replaces the file, so that a
+        # concurrent conda never reads a partial file
+        cache_dir = os.path.dirname(self.path)
+        self.saved = time.time()
+        self.pending = False
+        try:
+            if not isdir(cache_dir):
+                os.makedirs(cache_dir)
+            fd, tmp = tempfile.mkstemp(prefix=MIRRORS_FN + '.', dir=cache_dir)
+        except (IOError, OSError) as e:
+            log.debug("could not save the mirror statistics: %s" % e)
+            return
+        try:
+            with os.fdopen(fd, 'w') as fo:
+                json.dump(self.stats, fo, indent=2, sort_keys=True)
+            if on_win and os.path.isfile(self.path):
+                os.unlink(self.path)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            log.debug("could not save the mirror statistics: %s" % e)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+
+    def flush(self):
+        """
+        Save the changes which were not saved yet.
+        """
+        with self.lock:
+            if self.pending:
+                self.save()
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+def get_stats():
+    """
+    Return the MirrorStats kept in the cache directory.
+    """
+    path = join(config.pkgs_dirs[0], 'cache', MIRRORS_FN)
+    with _stats_lock:
+        if path not in _stats:
+            _stats[path] = MirrorStats(path)
+            atexit.register(_stats[path].flush)
+        return _stats[path]
+
+
+class MirrorAdapter(requests.adapters.BaseAdapter):
+    """
+    Send the requests for the URLs under base to the best of base and its
+    mirrors, using the other adapters of session.
+    """
+    def __init__(self, session, base, mirrors, stats=None):
+        super(MirrorAdapter, self).__init__()
+        self.session = session
+        self.base = base
+        self.mirrors = [base] + [m for m in mirrors if m != base]
+        self.stats = stats or get_stats()
+        self.probed = False
+        self.lock = threading.Lock()
+
+    def _adapter(self, url):
+        for prefix, adapter in self.session.adapters.items():
+            if (url.lower().startswith(prefix.lower()) and
+                    not isinstance(adapter, MirrorAdapter)):
+                return adapter
+        raise requests.exceptions.InvalidSchema(
+            "No connection adapters were found for '%s'" % url)
+
+    def _probe(self, kwargs):
+        def probe(mirror):
+            request = requests.Request('HEAD', mirror).prepare()
+            t0 = time.time()
+            try:
+                resp = self._adapter(mirror).send(
+                    request, **dict(kwargs, timeout=PROBE_TIMEOUT))
+                resp.close()
+            except requests.exceptions.RequestException:
+                self.stats.record_failure(mirror)
+            else:
+                self.stats.record(mirror, time.time() - t0)
+
+        threads = [threading.Thread(target=probe, args=(mirror,))
+                   for mirror in self.mirrors
+                   if not self.stats.measured(mirror)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def ranked(self, kwargs=None):
+        """
+        Return the mirrors, the best one first.
+        """
+        with self.lock:
+            if not self.probed:
+                self._probe(kwargs or {})
+                self.probed = True
+        return sorted(self.mirrors, key=self.stats.key)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            # Don't wait forever for a mirror when the others could answer
+            kwargs['timeout'] = TIMEOUT
+        path = request.url[len(self.base):]
+        error = failed = None
+        for mirror in self.ranked(kwargs):
+            req = request.copy()
+            req.url = mirror + path
+            t0 = time.time()
+            try:
+                resp = self._adapter(req.url).send(req, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                self.stats.record_failure(mirror)
+                error = e
+                continue
+            if failed is not None:
+                failed.close()
+            if resp.status_code >= 500:
+                self.stats.record_failure(mirror)
+                failed = resp
+                continue
+            self.stats.record(mirror, time.time() - t0)
+            resp.mirror = (self.stats, mirror)
+            return resp
+        # All the mirrors failed
+        if failed is not None:
+            return failed
+        raise error
+
+    def close(self):
+        pass
+
+
+def record_transfer(resp, nbytes, seconds):
+    """
+    Record the throughput of the mirror which sent the response resp (if
+    any) for a transfer of nbytes in seconds.
+    """
+    if getattr(resp, 'mirror', None):
+        stats, mirror = resp.mirror
+        stats.record_transfer(mirror, nbytes, seconds)
+
+
+def record_failure(resp):
+    """
+    Record the failure of the mirror which sent the response resp (if any)
+    while reading it, so that the next request goes to another one.
+    """
+    if getattr(resp, 'mirror', None):
+        stats, mirror = resp.mirror
+        stats.record_failure(mirror)
@@ -237,7 +237,8 @@ def plan_from_actions(actions):
 
 def extracted_where(dist):
     for pkgs_dir in config.pkgs_dirs:
-        if install.is_extracted(pkgs_dir, dist):
+        entry = install.load_manifest(pkgs_dir).get(dist)
+        if entry and entry['extracted']:
             return pkgs_dir
     return None
 
@@ -299,7 +300,9 @@ def force_linked_actions(dists, index, prefix):
         pkg_path = join(config.pkgs_dirs[0], fn)
         if isfile(pkg_path):
             try:
-                if md5_file(pkg_path) != index[fn]['md5']:
+                md5 = (install.stored_digest(config.pkgs_dirs[0], dist) or
+                       md5_file(pkg_path))
+                if md5 != index[fn]['md5']:
                     actions[inst.RM_FETCHED].append(dist)
                     actions[inst.FETCH].append(dist)
             except KeyError:
@@ -388,7 +391,11 @@ def get_pinned_specs(prefix):
 
 
 def install_actions(prefix, index, specs, force=False, only_names=None,
-                    pinned=True, minimal_hint=False, update_deps=True):
+                    pinned=True, minimal_hint=False, update_deps=True,
+                    time_budget=None, neighborhood=False, partition=False):
+    if hasattr(index, 'refresh'):
+        # Use the repodata refreshed in the background if it is ready
+        index.refresh()
     r = Resolve(index)
     linked = install.linked(prefix)
 
@@ -405,7 +412,8 @@ def install_actions(prefix, index, specs, force=False, only_names=None,
     must_have = {}
     for fn in r.solve(specs, [d + '.tar.bz2' for d in linked],
                       config.track_features, minimal_hint=minimal_hint,
-                      update_deps=update_deps):
+                      update_deps=update_deps, time_budget=time_budget,
+                      neighborhood=neighborhood, partition=partition):
         dist = fn[:-8]
         name = install.name_dist(dist)
         if only_names and name not in only_names:
@@ -445,6 +453,11 @@ def install_actions(prefix, index, specs, force=False, only_names=None,
         if name in must_have and dist != must_have[name]:
             add_unlink(actions, dist)
 
+    if time_budget is not None and r.solve_stats is not None:
+        # Not an instruction, but reported with the actions (e.g., in the
+        # --json output) so that callers know whether the plan is optimal.
+        actions['SOLVER'] = r.solve_stats.report()
+
     return actions
 
 
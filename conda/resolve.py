@@ -6,11 +6,11 @@
 from collections import defaultdict
 from functools import partial
 
-from conda.utils import memoize
+from conda.utils import memoize, fork_context
 from conda.compat import itervalues, iteritems, string_types, zip_longest
 from conda.logic import (false, true, sat, min_sat, generate_constraints,
     bisect_constraints, evaluate_eq, minimal_unsatisfiable_subset,
-    MaximumIterationsError)
+    MaximumIterationsError, TimeBudget)
 from conda.console import setup_handlers
 from conda import config
 from conda.toposort import toposort
@@ -413,14 +413,91 @@ def __repr__(self):
 
 class Resolve(object):
 
-    def __init__(self, index):
+    def __init__(self, index, groups=None):
         self.index = index
         self.groups = defaultdict(list)  # map name to list of filenames
-        for fn, info in iteritems(index):
-            self.groups[info['name']].append(fn)
+        if groups is None:
+            # The index of fetch_index knows the filenames of each name
+            # without loading all the packages
+            groups = getattr(index, 'groups', None)
+        if groups is None:
+            for fn, info in iteritems(index):
+                self.groups[info['name']].append(fn)
+        else:
+            for name, fns in iteritems(groups):
+                self.groups[name].extend(fns)
+        # The names whose packages were loaded, when the index only has the
+        # packages it was asked for (sharded channels, see load_names)
+        self.loaded_names = None
+        if hasattr(index, 'load_names') and groups is getattr(index, 'groups',
+                                                              None):
+            self.loaded_names = set()
         self.msd_cache = {}
+        self.solve_stats = None
+
+    def load_names(self, names):
+        """
+        Load the packages of names, and of the names they depend on (level
+        by level), when the index only has the packages it was asked for.
+        """
+        if self.loaded_names is None:
+            return
+        names = set(names) - self.loaded_names
+        while names:
+            self.index.load_names(names)
+            self.loaded_names.update(names)
+            deps = set()
+            for name in names:
+                self.groups[name] = list(self.index.groups.get(name, []))
+                for fn in self.groups[name]:
+                    deps.update(dep.split()[0] for dep in
+                                self.index[fn].get('depends', []))
+            names = deps - self.loaded_names
+
+    def load_all(self):
+        """
+        Load all the packages of the index (the full repodata and all the
+        shards), for the commands which show all the packages (conda search).
+        """
+        self.load_full()
+        if self.loaded_names is not None:
+            self.load_names(self.index.names())
+
+    def load_full(self):
+        """
+        Load all the packages of the channels of which the index only has
+        the current repodata (the latest versions, see
+        conda.fetch.PackageIndex.load_full).  Returns True if it did.
+        """
+        if not getattr(self.index, 'current', None):
+            return False
+        self.index.load_full()
+        self.groups = defaultdict(list)
+        for name, fns in iteritems(self.index.groups):
+            self.groups[name].extend(fns)
+        self.msd_cache = {}
+        memoize.clear(self)
+        return True
+
+    def older_versions(self, specs):
+        """
+        Return whether some of the specs ask for a version older than the
+        latest version of the package (or for a package which is not in the
+        index at all).
+        """
+        for spec in specs:
+            ms = MatchSpec(spec)
+            try:
+                pkgs = self.get_pkgs(MatchSpec(ms.name), max_only=True)
+            except NoPackagesFound:
+                return True
+            if not any(ms.match(pkg.fn) for pkg in pkgs):
+                return True
+        return False
 
     def find_matches(self, ms):
+        if self.loaded_names is not None and ms.name not in self.loaded_names:
+            self.load_names([ms.name])
         for fn in sorted(self.groups[ms.name]):
             if ms.match(fn):
                 yield fn
@@ -446,7 +523,14 @@ def track_features(self, fn):
         return set(self.index[fn].get('track_features', '').split())
 
     @memoize
-    def get_pkgs(self, ms, max_only=False):
+    def get_pkgs(self, ms, max_only=False, top_k=None, installed=()):
+        """
+        Return the packages matching ms.  If max_only is True, only the
+        packages with the highest version and build number are returned.
+        If top_k is given, only the packages with one of the top_k highest
+        (version, build number) pairs, and those at least as new as the
+        version of one of the `installed` filenames, are returned.
+        """
         pkgs = [Package(fn, self.index[fn]) for fn in self.find_matches(ms)]
         if not pkgs:
             raise NoPackagesFound("No packages found in current %s channels matching: %s" % (config.subdir, ms), [ms.spec])
@@ -463,6 +547,22 @@ def get_pkgs(self, ms, max_only=False):
                     pass
             return ret
 
+        if top_k:
+            inst = [Package(fn, self.index[fn]) for fn in installed
+                    if fn in self.index and self.index[fn]['name'] == ms.name]
+            ret = []
+            i = 0
+            prev = None
+            for pkg in sorted(pkgs, reverse=True):
+                if prev is not None and (pkg.norm_version, pkg.build_number) != \
+                        (prev.norm_version, prev.build_number):
+                    i += 1
+                prev = pkg
+                if i < top_k or any(pkg.norm_version >= p.norm_version
+                                    for p in inst):
+                    ret.append(pkg)
+            return ret
+
         return pkgs
 
     def get_max_dists(self, ms):
@@ -472,14 +572,15 @@ def get_max_dists(self, ms):
         for pkg in pkgs:
             yield pkg.fn
 
-    def all_deps(self, root_fn, max_only=False):
+    def all_deps(self, root_fn, max_only=False, top_k=None, installed=()):
         res = {}
 
         def add_dependents(fn1, max_only=False):
             for ms in self.ms_depends(fn1):
                 found = False
                 notfound = []
-                for pkg2 in self.get_pkgs(ms, max_only=max_only):
+                for pkg2 in self.get_pkgs(ms, max_only=max_only, top_k=top_k,
+                                          installed=installed):
                     if pkg2.fn in res:
                         found = True
                         continue
@@ -504,6 +605,19 @@ def add_dependents(fn1, max_only=False):
         return res
 
     def gen_clauses(self, v, dists, specs, features):
+        for clause in self.gen_conflicts(v, dists):
+            yield clause
+        for clause in self.gen_requires(v, dists, specs, features):
+            yield clause
+
+    def gen_conflicts(self, v, dists, done=None):
+        """
+        Generate the clauses ensuring that packages with the same name
+        conflict.  If done (a set of filenames) is given, the clauses between
+        the filenames in it are assumed to have been generated already (e.g.,
+        for a smaller candidate set), and done is updated with dists.
+        """
+        done = set() if done is None else done
         groups = defaultdict(list)  # map name to list of filenames
         for fn in dists:
             groups[self.index[fn]['name']].append(fn)
@@ -514,12 +628,26 @@ def gen_clauses(self, v, dists, specs, features):
                 v1 = v[fn1]
                 for fn2 in filenames:
                     v2 = v[fn2]
-                    if v1 < v2:
+                    if v1 < v2 and not (fn1 in done and fn2 in done):
                         # NOT (fn1 AND fn2)
                         # e.g. NOT (numpy-1.6 AND numpy-1.7)
                         yield (-v1, -v2)
+        done.update(dists)
+
+    def gen_requires(self, v, dists, specs, features, only=None):
+        """
+        Generate the clauses ensuring that the specs and the dependencies of
+        the packages are satisfied, taking the features into account.
 
-        for fn1 in dists:
+        If only is given, the clauses for the dependencies of the other
+        packages in dists are left out, i.e., the caller has to ensure that
+        those packages are not installed.
+        """
+        groups = defaultdict(list)  # map name to list of filenames
+        for fn in dists:
+            groups[self.index[fn]['name']].append(fn)
+
+        for fn1 in (dists if only is None else only):
             for ms in self.ms_depends(fn1):
                 # ensure dependencies are installed
                 # e.g. numpy-1.7 IMPLIES (python-2.7.3 OR python-2.7.4 OR ...)
@@ -610,17 +738,21 @@ def generate_version_eq(self, v, dists, installed_dists, specs,
 
         return eq, max_rhs
 
-    def get_dists(self, specs, max_only=False):
+    def get_dists(self, specs, max_only=False, top_k=None, installed=()):
+        # Fetch the shards of the whole dependency closure at once
+        self.load_names([MatchSpec(spec).name for spec in specs])
         dists = {}
         for spec in specs:
             found = False
             notfound = []
-            for pkg in self.get_pkgs(MatchSpec(spec), max_only=max_only):
+            for pkg in self.get_pkgs(MatchSpec(spec), max_only=max_only,
+                                     top_k=top_k, installed=installed):
                 if pkg.fn in dists:
                     found = True
                     continue
                 try:
-                    dists.update(self.all_deps(pkg.fn, max_only=max_only))
+                    dists.update(self.all_deps(pkg.fn, max_only=max_only,
+                                               top_k=top_k, installed=installed))
                 except NoPackagesFound as e:
                     # Ignore any package that has nonexisting dependencies.
                     for pkg in e.pkgs:
@@ -634,6 +766,45 @@ def get_dists(self, specs, max_only=False):
 
         return dists
 
+    def collapse_builds(self, dists, specs, installed=()):
+        """
+        Return the subset of dists with only one representative of the
+        builds which are interchangeable for the solver: same name, version,
+        build number, dependencies and features, and matched by the same of
+        the specs and the dependencies of dists (e.g., the same package in
+        mirrored channels).  The representative is the installed build if
+        there is one, and otherwise the greatest build according to the
+        Package ordering.
+        """
+        mss = defaultdict(set)  # map name to the match specs with that name
+        for spec in specs:
+            ms = MatchSpec(spec)
+            mss[ms.name].add(ms)
+        for fn in dists:
+            for ms in self.ms_depends(fn):
+                mss[ms.name].add(ms)
+        mss = {name: sorted(ms_set, key=lambda ms: ms.spec) for name, ms_set
+               in iteritems(mss)}
+
+        classes = defaultdict(list)
+        for fn, pkg in iteritems(dists):
+            key = (pkg.name, pkg.version, pkg.build_number,
+                   frozenset(ms.spec for ms in self.ms_depends(fn)),
+                   frozenset(self.features(fn)),
+                   frozenset(self.track_features(fn)),
+                   tuple(ms.match(fn) for ms in mss.get(pkg.name, ())))
+            classes[key].append(pkg)
+
+        res = {}
+        for pkgs in itervalues(classes):
+            inst = [pkg for pkg in pkgs if pkg.fn in installed]
+            pkg = inst[0] if inst else max(pkgs)
+            res[pkg.fn] = pkg
+        if len(res) < len(dists):
+            log.debug("Collapsed %d interchangeable builds" %
+                      (len(dists) - len(res)))
+        return res
+
     def graph_sort(self, must_have):
 
         def lookup(value):
@@ -660,11 +831,16 @@ def lookup(value):
 
     def solve2(self, specs, features, installed=(), guess=True, alg='BDD',
         returnall=False, minimal_hint=False, unsat_only=False, update_deps=True,
-        try_max_only=None):
+        try_max_only=None, time_budget=None, top_k=3, budget=None):
         log.debug("Solving for %s" % str(specs))
         log.debug("Features: %s" % str(features))
         log.debug("Installed: %s" % str(installed))
 
+        # (the budget of the whole solve, if this is one of its steps)
+        budget = budget or TimeBudget(time_budget)
+        if not unsat_only:
+            self.solve_stats = budget
+
         # This won't packages that aren't in the index, but there isn't much
         # we can do with such packages here anyway.
         installed_dists = {pkg: Package(pkg, self.index[pkg]) for pkg in
@@ -675,15 +851,20 @@ def solve2(self, specs, features, installed=(), guess=True, alg='BDD',
                 try_max_only = False
             else:
                 try_max_only = True
+        if not try_max_only and self.load_full():
+            installed_dists = {pkg: Package(pkg, self.index[pkg]) for pkg in
+                installed if pkg in self.index}
 
         if try_max_only:
             try:
-                dists = self.get_dists(specs, max_only=True)
+                with budget.phase('get_dists'):
+                    dists = self.get_dists(specs, max_only=True)
             except NoPackagesFound:
                 # Handle packages that are not included because some dependencies
                 # couldn't be found.
                 pass
             else:
+                dists = self.collapse_builds(dists, specs, installed_dists)
                 v = {}  # map fn to variable number
                 w = {}  # map variable number to fn
                 i = -1  # in case the loop doesn't run
@@ -693,20 +874,28 @@ def solve2(self, specs, features, installed=(), guess=True, alg='BDD',
                 m = i + 1
 
                 dotlog.debug("Solving using max dists only")
-                clauses = set(self.gen_clauses(v, dists, specs, features))
-                try:
-                    solutions = min_sat(clauses, alg='iterate',
-                        raise_on_max_n=True)
-                except MaximumIterationsError:
-                    pass
-                else:
-                    if len(solutions) == 1:
-                        ret = [w[lit] for lit in solutions.pop(0) if 0 < lit <= m]
-                        if returnall:
-                            return [ret]
-                        return ret
-
-        dists = self.get_dists(specs)
+                with budget.phase('max_only'):
+                    clauses = set(self.gen_clauses(v, dists, specs, features))
+                    try:
+                        solutions = min_sat(clauses, alg='iterate',
+                            raise_on_max_n=True)
+                    except MaximumIterationsError:
+                        solutions = []
+                if len(solutions) == 1:
+                    ret = [w[lit] for lit in solutions.pop(0) if 0 < lit <= m]
+                    if returnall:
+                        return [ret]
+                    return ret
+
+        if self.load_full():
+            # The max-only solve failed with the current repodata only
+            dotlog.debug("Using the full repodata")
+            installed_dists = {pkg: Package(pkg, self.index[pkg]) for pkg in
+                installed if pkg in self.index}
+
+        with budget.phase('get_dists'):
+            dists = self.get_dists(specs)
+            dists = self.collapse_builds(dists, specs, installed_dists)
 
         v = {}  # map fn to variable number
         w = {}  # map variable number to fn
@@ -716,35 +905,139 @@ def solve2(self, specs, features, installed=(), guess=True, alg='BDD',
             w[i + 1] = fn
         m = i + 1
 
-        clauses = set(self.gen_clauses(v, dists, specs, features))
-        if not clauses:
-            if returnall:
-                return [[]]
-            return []
         eq, max_rhs = self.generate_version_eq(v, dists, installed_dists,
             specs, update_deps=update_deps)
 
+        # Before generating the clauses for all the candidates, try to solve
+        # with only the top_k newest versions of each package, and then also
+        # with the versions at least as new as the installed ones, all other
+        # candidates being excluded.  Such a solution is the one we would get
+        # from all the candidates if its version cost (eq) is lower than the
+        # cost of any of the excluded candidates.  The variables and the
+        # conflict clauses are shared by the stages and the final solve.
+        # Only the clause generation is saved this way: the candidates and
+        # their version costs above are computed for all of them, as the
+        # costs of the excluded candidates are what bounds a stage.
+        coeffs = {w[lit]: c for c, lit in eq}
+        conflicts = set()
+        done = set()
+        solutions = None
+        stages = []
+        if top_k:
+            stages.append(('top_k', ()))
+            if installed_dists:
+                stages.append(('installed', tuple(sorted(installed_dists))))
+        for name, stage_installed in stages:
+            try:
+                with budget.phase('get_dists'):
+                    sdists = self.get_dists(specs, top_k=top_k,
+                                            installed=stage_installed)
+            except NoPackagesFound:
+                continue
+            sdists = {fn: pkg for fn, pkg in iteritems(sdists) if fn in dists}
+            if len(sdists) <= len(done) or len(sdists) >= len(dists):
+                # Not a smaller problem than the previous or the last one
+                continue
+            excluded = [fn for fn in dists if fn not in sdists]
+            bound = min(coeffs.get(fn, 0) for fn in excluded)
+            if not bound and not unsat_only:
+                # Excluding a candidate with no cost, the solution could not
+                # be proven to be optimal.
+                continue
+
+            dotlog.debug("Solving using the %s candidates only" % name)
+            with budget.phase(name):
+                conflicts |= set(self.gen_conflicts(v, sdists, done))
+                clauses = conflicts | set(self.gen_requires(v, dists, specs,
+                    features, only=sdists))
+                clauses |= {(-v[fn],) for fn in excluded}
+                solution = sat(clauses)
+                if not solution:
+                    continue
+                if unsat_only:
+                    return True
+                seq = [(c, lit) for c, lit in eq if w[lit] in sdists]
+                smax = defaultdict(int)
+                for c, lit in seq:
+                    pkg_name = self.index[w[lit]]['name']
+                    smax[pkg_name] = max(smax[pkg_name], c)
+                ssolutions = self.minimize(clauses, seq, sum(smax.values()),
+                    m, solution, alg=alg, budget=budget)
+            if budget.exhausted or evaluate_eq(seq, ssolutions[0]) < bound:
+                log.debug("Solved using the %s candidates only" % name)
+                solutions = ssolutions
+                break
+
+        if solutions is None:
+            with budget.phase('gen_clauses'):
+                conflicts |= set(self.gen_conflicts(v, dists, done))
+                clauses = conflicts | set(self.gen_requires(v, dists, specs,
+                    features))
+            if not clauses:
+                if returnall:
+                    return [[]]
+                return []
+
+            # Second common case, check if it's unsatisfiable
+            dotlog.debug("Checking for unsatisfiability")
+            with budget.phase('sat'):
+                solution = sat(clauses)
+
+            if not solution:
+                if guess:
+                    if minimal_hint:
+                        stderrlog.info('\nError: Unsatisfiable package '
+                            'specifications.\nGenerating minimal hint: \n')
+                        sys.exit(self.minimal_unsatisfiable_subset(clauses, v,
+                w))
+                    else:
+                        stderrlog.info('\nError: Unsatisfiable package '
+                            'specifications.\nGenerating hint: \n')
+                        sys.exit(self.guess_bad_solve(specs, features))
+                raise RuntimeError("Unsatisfiable package specifications")
+
+            if unsat_only:
+                return True
 
-        # Second common case, check if it's unsatisfiable
-        dotlog.debug("Checking for unsatisfiability")
-        solution = sat(clauses)
+            solutions = self.minimize(clauses, eq, max_rhs, m, solution,
+                alg=alg, budget=budget)
+        assert solutions, (specs, features)
 
-        if not solution:
-            if guess:
-                if minimal_hint:
-                    stderrlog.info('\nError: Unsatisfiable package '
-                        'specifications.\nGenerating minimal hint: \n')
-                    sys.exit(self.minimal_unsatisfiable_subset(clauses, v,
-            w))
-                else:
-                    stderrlog.info('\nError: Unsatisfiable package '
-                        'specifications.\nGenerating hint: \n')
-                    sys.exit(self.guess_bad_solve(specs, features))
-            raise RuntimeError("Unsatisfiable package specifications")
+        if budget.exhausted:
+            stderrlog.info('\nWarning: the solver time budget of %ss was '
+                'exhausted, the package resolution found may not be '
+                'optimal.\n' % budget.seconds)
+            # Any of the solutions found so far is valid, so don't warn about
+            # them differing, but drop the packages nothing asked for (an
+            # unminimized solution can contain arbitrary extra packages).
+            needed = self.reachable(specs,
+                [w[lit] for lit in solutions[0] if 0 < lit <= m])
+            solutions = [[lit for lit in solutions[0] if lit < 0 or lit > m or
+                w[lit] in needed]]
 
-        if unsat_only:
-            return True
+        if len(solutions) > 1:
+            stdoutlog.info('\nWarning: %s possible package resolutions (only showing differing packages):\n' % len(solutions))
+            pretty_solutions = [{w[lit] for lit in sol if 0 < lit <= m} for
+                sol in solutions]
+            common  = set.intersection(*pretty_solutions)
+            for sol in pretty_solutions:
+                stdoutlog.info('\t%s,\n' % sorted(sol - common))
 
+        log.debug("Older versions in the solution(s):")
+        for sol in solutions:
+            log.debug([(i, w[j]) for i, j in eq if j in sol])
+        if returnall:
+            return [[w[lit] for lit in sol if 0 < lit <= m] for sol in solutions]
+        return [w[lit] for lit in solutions.pop(0) if 0 < lit <= m]
+
+    def minimize(self, clauses, eq, max_rhs, m, solution, alg='BDD',
+        budget=None):
+        """
+        Return the solutions of the clauses (given one of them) which are
+        minimal in the version equation eq, and then in the number of
+        packages (the variables up to m).
+        """
+        budget = budget or TimeBudget()
         log.debug("Using alg %s" % alg)
 
         def version_constraints(lo, hi):
@@ -752,8 +1045,10 @@ def version_constraints(lo, hi):
 
         log.debug("Bisecting the version constraint")
         evaluate_func = partial(evaluate_eq, eq)
-        constraints = bisect_constraints(0, max_rhs, clauses,
-            version_constraints, evaluate_func=evaluate_func)
+        with budget.phase('bisect'):
+            constraints = bisect_constraints(0, max_rhs, clauses,
+                version_constraints, evaluate_func=evaluate_func,
+                budget=budget)
 
         # Only relevant for build_BDD
         if constraints and false in constraints:
@@ -766,27 +1061,194 @@ def version_constraints(lo, hi):
                 constraints = set([])
 
         dotlog.debug("Finding the minimal solution")
+        with budget.phase('min_sat'):
+            if budget.expired():
+                # The best solution found so far, within the version
+                # constraints found by the bisection
+                return [sat(clauses | constraints) or solution]
+            try:
+                return min_sat(clauses | constraints, N=m + 1, alg='iterate',
+                    raise_on_max_n=True, budget=budget)
+            except MaximumIterationsError:
+                return min_sat(clauses | constraints, N=m + 1, alg='sorter',
+                    budget=budget)
+
+    def reachable(self, specs, fns):
+        """
+        Return the set of filenames in `fns` (a valid solution) which are
+        reachable from the specs through the dependencies.  Removing the other
+        packages from a solution keeps it valid.
+        """
+        by_name = {self.index[fn]['name']: fn for fn in fns}
+        res = set()
+        names = [MatchSpec(spec).name for spec in specs]
+        while names:
+            fn = by_name.get(names.pop())
+            if fn is None or fn in res:
+                continue
+            res.add(fn)
+            names.extend(ms.name for ms in self.ms_depends(fn))
+        return res
+
+    def solve_neighborhood(self, specs, installed, features, **kwargs):
+        """
+        Solve for specs changing as few of the installed packages as
+        possible.  The installed packages are first fixed to their installed
+        builds (all their other builds are left out of the problem), except
+        those conflicting directly with the specs which the installed
+        packages don't satisfy already (the new specs).  While that is
+        unsatisfiable, the installed packages in the dependency closure of
+        the new specs, and then the installed packages depending on the
+        unlocked ones, are unlocked as well.  Returns None if no such
+        restricted problem is satisfiable (or there are no new specs), in
+        which case the full problem has to be solved.
+        """
+        inst = {}
+        for fn in installed:
+            if fn in self.index:
+                inst[self.index[fn]['name']] = fn
+        new = []
+        for spec in specs:
+            ms = MatchSpec(spec)
+            if not (ms.name in inst and ms.match(inst[ms.name])):
+                new.append(spec)
+        if not new or not inst:
+            return None
         try:
-            solutions = min_sat(clauses | constraints, N=m + 1, alg='iterate',
-                raise_on_max_n=True)
-        except MaximumIterationsError:
-            solutions = min_sat(clauses | constraints, N=m + 1, alg='sorter')
-        assert solutions, (specs, features)
+            closure = {self.index[fn]['name'] for fn in self.get_dists(new)}
+        except NoPackagesFound:
+            return None
 
-        if len(solutions) > 1:
-            stdoutlog.info('\nWarning: %s possible package resolutions (only showing differing packages):\n' % len(solutions))
-            pretty_solutions = [{w[lit] for lit in sol if 0 < lit <= m} for
-                sol in solutions]
-            common  = set.intersection(*pretty_solutions)
-            for sol in pretty_solutions:
-                stdoutlog.info('\t%s,\n' % sorted(sol - common))
+        conflicts = set()
+        for spec in new:
+            # An installed package conflicts directly with a new spec if the
+            # spec or a dependency of each of its candidates rejects it.
+            ms = MatchSpec(spec)
+            if ms.name in inst:
+                conflicts.add(ms.name)
+                continue
+            pkg_conflicts = [{ms.name for ms in self.ms_depends(pkg.fn)
+                              if ms.name in inst and not ms.match(inst[ms.name])}
+                             for pkg in self.get_pkgs(ms)]
+            conflicts.update(set.intersection(*pkg_conflicts))
+        rdeps = defaultdict(set)  # map name to the installed names needing it
+        for name, fn in iteritems(inst):
+            for ms in self.ms_depends(fn):
+                rdeps[ms.name].add(name)
+
+        unlocked = None
+        widenings = [conflicts, closure & set(inst)]
+        while True:
+            if widenings:
+                wider = (unlocked or set()) | widenings.pop(0)
+            else:
+                wider = unlocked.union(*[rdeps[name] for name in unlocked])
+            if wider == unlocked:
+                if widenings:
+                    continue
+                return None
+            unlocked = wider
+            if not set(inst) - unlocked:
+                return None
+            log.debug("Solving with installed packages fixed except: %s" %
+                      sorted(unlocked))
+            groups = {name: fns if name in unlocked or name not in inst else
+                      [inst[name]] for name, fns in iteritems(self.groups)}
+            r = Resolve(self.index, groups)
+            r.msd_cache = self.msd_cache
+            try:
+                return r.solve2(specs, features, installed, guess=False,
+                                **kwargs)
+            except (RuntimeError, NoPackagesFound):
+                dotlog.debug("Unlocking more installed packages")
+            finally:
+                self.solve_stats = r.solve_stats
+
+    def components(self, specs):
+        """
+        Partition the specs into components which can be solved
+        independently, i.e., such that the candidates of the specs (and
+        their dependencies) of different components have no names in
+        common.  Returns a list of (specs, names) pairs, names being the
+        package names the specs of the component can pull in.
+        """
+        comps = []
+        for spec in specs:
+            names = {self.index[fn]['name'] for fn in self.get_dists([spec])}
+            cspecs = [spec]
+            rest = []
+            for specs1, names1 in comps:
+                if names1 & names:
+                    cspecs = specs1 + cspecs
+                    names |= names1
+                else:
+                    rest.append((specs1, names1))
+            comps = rest + [(cspecs, names)]
+        return comps
 
-        log.debug("Older versions in the solution(s):")
-        for sol in solutions:
-            log.debug([(i, w[j]) for i, j in eq if j in sol])
-        if returnall:
-            return [[w[lit] for lit in sol if 0 < lit <= m] for sol in solutions]
-        return [w[lit] for lit in solutions.pop(0) if 0 < lit <= m]
+    def solve_components(self, specs, features, installed=(), **kwargs):
+        """
+        Solve for specs by solving each of its components (see components())
+        independently, in parallel processes.  As the components don't
+        interact, the merged solution is the same as the one of the whole
+        problem.  Returns None if the specs can't be partitioned.
+        """
+        comps = self.components(specs)
+        if len(comps) < 2:
+            return None
+        log.debug("Solving %d independent components" % len(comps))
+        budget = kwargs.pop('budget', None) or TimeBudget(
+            kwargs.get('time_budget'))
+        # (the components are solved in other processes, with the time left)
+        kwargs['time_budget'] = budget.remaining()
+
+        jobs = []
+        for cspecs, names in comps:
+            # Only send the part of the index the component can use
+            index = {fn: self.index[fn] for name in names
+                     for fn in self.groups[name]}
+            msd_cache = {fn: list(self.msd_cache[fn]) for fn in index
+                         if fn in self.msd_cache}
+            cinstalled = [fn for fn in installed if fn in index]
+            jobs.append((index, msd_cache, cspecs, features, cinstalled,
+                         kwargs))
+
+        context = fork_context()
+        try:
+            import concurrent.futures
+        except ImportError:
+            # concurrent.futures is only available in Python 3
+            context = None
+        if context is None:
+            # (the workers of other start methods import __main__ again,
+            # see conda.utils.fork_context)
+            results = [solve_component(*job) for job in jobs]
+        else:
+            try:
+                executor = concurrent.futures.ProcessPoolExecutor(
+                    mp_context=context)
+            except TypeError:
+                # Python < 3.7, whose default on POSIX is to fork
+                executor = concurrent.futures.ProcessPoolExecutor()
+            with executor:
+                futures = [executor.submit(solve_component, *job)
+                           for job in jobs]
+                try:
+                    results = [future.result() for future in futures]
+                except SystemExit as e:
+                    # A component is unsatisfiable: cancel the other ones,
+                    # and exit with its hint as solve2 does
+                    for future in futures:
+                        future.cancel()
+                    sys.exit(e.code)
+
+        res = []
+        for fns, stats in results:
+            res.extend(fns)
+            budget.phases.extend(stats.phases)
+            budget.exhausted |= stats.exhausted
+        self.solve_stats = budget
+        return sorted(res)
 
     @staticmethod
     def clause_pkg_name(i, w):
@@ -933,9 +1395,17 @@ def update_with_features(self, fn, features):
         self.msd_cache[fn] = d.values()
 
     def solve(self, specs, installed=None, features=None, max_only=False,
-              minimal_hint=False, update_deps=True):
+              minimal_hint=False, update_deps=True, time_budget=None,
+              neighborhood=False, partition=False):
         if installed is None:
             installed = []
+        self.load_names([MatchSpec(spec).name for spec in specs] +
+                        [fn.rsplit('-', 2)[0] for fn in installed])
+        if getattr(self.index, 'current', None) and (
+                neighborhood or partition or self.older_versions(specs)):
+            # The latest versions only (current repodata) are not enough
+            self.load_full()
+        self.solve_stats = None
         if features is None:
             features = self.installed_features(installed)
         for spec in specs:
@@ -950,14 +1420,35 @@ def solve(self, specs, installed=None, features=None, max_only=False,
                 self.update_with_features(fn, features)
 
         stdoutlog.info("Solving package specifications: ")
+        # One budget for all the solves below
+        budget = TimeBudget(time_budget)
         try:
-            return self.explicit(specs) or self.solve2(specs, features,
-                installed, minimal_hint=minimal_hint, update_deps=update_deps)
+            res = self.explicit(specs)
+            if not res and neighborhood:
+                res = self.solve_neighborhood(specs, installed, features,
+                    update_deps=update_deps, budget=budget)
+            if not res and partition:
+                res = self.solve_components(specs, features, installed,
+                    minimal_hint=minimal_hint, update_deps=update_deps,
+                    budget=budget)
+            return res or self.solve2(specs, features, installed,
+                minimal_hint=minimal_hint, update_deps=update_deps,
+                budget=budget)
         except RuntimeError:
             stdoutlog.info('\n')
             raise
 
 
+def solve_component(index, msd_cache, specs, features, installed, kwargs):
+    """
+    Solve one of the components of Resolve.solve_components() (in a separate
+    process).  Returns the solution and the solver statistics.
+    """
+    r = Resolve(index)
+    r.msd_cache = msd_cache
+    return r.solve2(specs, features, installed, **kwargs), r.solve_stats
+
+
 if __name__ == '__main__':
     import json
     from pprint import pprint
@@ -29,14 +29,36 @@ def hash_file(path):
     return h
 
 
+class Digest(object):
+    """
+    A SHA256 hash object of which only the digest is known (given as hex),
+    for the signature verifier
+    """
+    digest_size = SHA256.digest_size
+
+    def __init__(self, hexdigest):
+        self._digest = base64.b16decode(hexdigest.upper())
+
+    def digest(self):
+        return self._digest
+
+    def hexdigest(self):
+        return base64.b16encode(self._digest).decode('ascii').lower()
+
+    def new(self, data=None):
+        return SHA256.new(data)
+
+
 class SignatureError(Exception):
     pass
 
 
-def verify(path):
+def verify(path, sha256=None):
     """
     Verify the file `path`, with signature `path`.sig, against the key
-    found under ~/.conda/keys/<key_name>.pub.  This function returns:
+    found under ~/.conda/keys/<key_name>.pub.  If given, sha256 is the
+    hex digest of the file (e.g. computed while downloading it), which is
+    then not read again.  This function returns:
       - True, if the signature is valid
       - False, if the signature is invalid
     It raises SignatureError when the signature file, or the public key
@@ -54,4 +76,5 @@ def verify(path):
         KEYS[key_name] = RSA.importKey(open(key_path).read())
     key = KEYS[key_name]
     verifier = PKCS1_PSS.new(key)
-    return verifier.verify(hash_file(path), base64.b64decode(sig))
+    h = Digest(sha256) if sha256 else hash_file(path)
+    return verifier.verify(h, base64.b64decode(sig))
@@ -92,6 +92,26 @@ def human_bytes(n):
     return '%.2f GB' % g
 
 
+def fork_context():
+    """
+    Return the multiprocessing context whose worker processes are forked
+    from this one, or None if there is none (on Windows).  The workers of
+    the spawn and forkserver contexts import __main__ again, which runs the
+    command again when it is an entry point script without a
+    `if __name__ == '__main__'` guard (like bin/conda).  On Python 2, where
+    there are no contexts, the multiprocessing module itself is returned.
+    """
+    if sys.platform == 'win32':
+        return None
+    import multiprocessing
+    try:
+        return multiprocessing.get_context('fork')
+    except AttributeError:
+        return multiprocessing
+    except ValueError:
+        return None
+
+
 class memoized(object):
     """Decorator. Caches a function's return value each time it is called.
     If called later with the same arguments, the cached value is returned
@@ -141,3 +161,13 @@ def __call__(self, *args, **kw):
         except KeyError:
             res = cache[key] = self.func(*args, **kw)
         return res
+
+    @staticmethod
+    def clear(obj):
+        """
+        Forget the cached results of the memoized methods of obj.
+        """
+        try:
+            del obj.__cache
+        except AttributeError:
+            pass
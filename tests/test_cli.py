@@ -1,10 +1,17 @@
+import os
+import shutil
+import tempfile
 import unittest
+from os.path import join
 
 import pytest
 
+from conda import config
+from conda.cli import main_clean
 from conda.cli.common import arg2spec, spec_from_line
 
 from conda.compat import text_type
+from conda.lock import Locked
 
 from tests.helpers import capture_json_with_argv
 
@@ -55,6 +62,29 @@ def test_pip_style(self):
         self.assertEqual(spec_from_line('foo >=1.0 , < 2.0'), 'foo >=1.0,<2.0')
 
 
+class TestClean(unittest.TestCase):
+
+    def setUp(self):
+        self.pkgs_dir = tempfile.mkdtemp()
+        self.pkgs_dirs = config.pkgs_dirs
+        config.pkgs_dirs = [self.pkgs_dir]
+        for path in ('foo-1.0-0', '.extract-bar-1.0-0-x1y2z3', '.trash'):
+            os.makedirs(join(self.pkgs_dir, path, 'info'))
+
+    def tearDown(self):
+        config.pkgs_dirs = self.pkgs_dirs
+        shutil.rmtree(self.pkgs_dir)
+
+    def test_find_pkgs(self):
+        # The temporary directory of an interrupted extraction is removed
+        # with the unused packages
+        rmlist = main_clean.find_pkgs()[1]
+        self.assertEqual(rmlist, ['foo-1.0-0', '.extract-bar-1.0-0-x1y2z3'])
+        # unless another conda could be using it
+        with Locked(self.pkgs_dir):
+            self.assertEqual(main_clean.find_pkgs()[1], ['foo-1.0-0'])
+
+
 class TestJson(unittest.TestCase):
     def assertJsonSuccess(self, res):
         self.assertIsInstance(res, dict)
@@ -0,0 +1,1026 @@
+import os
+import bz2
+import json
+import hashlib
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from os.path import dirname, exists, isdir, join
+
+import requests
+
+from conda import config, fetch, install, jlap
+from conda.fetch import (fetch_repodata, cache_fn_url, binary_cache_path,
+                         read_cache, read_cache_header, write_cache,
+                         stream_repodata, LazyPackages, PackageIndex,
+                         add_pip_dependency, cache_age, get_max_age,
+                         fetch_index, ChannelFetcher, SHARDS_MANIFEST,
+                         CURRENT_REPODATA, update_repodata)
+from conda.lock import LOCKFN
+from conda.resolve import Resolve
+
+from .test_install import make_package
+
+
+with open(join(dirname(__file__), 'index.json')) as fi:
+    index = json.load(fi)
+
+
+def make_channel(path, packages):
+    data = jlap.dumps_repodata({'packages': packages, 'info': {}})
+    with open(join(path, 'repodata.json.bz2'), 'wb') as fo:
+        fo.write(bz2.compress(data))
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_sharded_channel(path, packages):
+    names = {}
+    for fn, info in packages.items():
+        names.setdefault(info['name'], {})[fn] = info
+    shards = {}
+    os.mkdir(join(path, 'shards'))
+    for name, pkgs in names.items():
+        data = bz2.compress(json.dumps({'packages': pkgs}).encode('utf-8'))
+        shards[name] = hashlib.sha256(data).hexdigest()
+        with open(join(path, 'shards', shards[name] + '.json.bz2'),
+                  'wb') as fo:
+            fo.write(data)
+    with open(join(path, SHARDS_MANIFEST), 'w') as fo:
+        json.dump({'info': {}, 'shards': shards}, fo)
+
+
+class ChannelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.channel = join(self.tmpdir, 'channel')
+        self.cache_dir = join(self.tmpdir, 'cache')
+        for path in self.channel, self.cache_dir:
+            os.mkdir(path)
+        self.url = 'file://%s/' % self.channel
+        self.packages = {fn: info for fn, info in index.items()
+                         if info['name'] in ('numpy', 'python')}
+        self.hash = make_channel(self.channel, self.packages)
+        self.cache_path = join(self.cache_dir, cache_fn_url(self.url))
+        # The default cache directory is <pkgs dir>/cache
+        self.pkgs_dirs = config.pkgs_dirs
+        config.pkgs_dirs = [self.tmpdir]
+
+    def tearDown(self):
+        config.pkgs_dirs = self.pkgs_dirs
+        shutil.rmtree(self.tmpdir)
+
+
+class TestRepodataCache(ChannelTestCase):
+
+    def test_fetch(self):
+        repodata = fetch_repodata(self.url, cache_dir=self.cache_dir)
+        self.assertEqual(repodata['packages'], self.packages)
+        self.assertEqual(repodata['_url'], self.url)
+        self.assertTrue(exists(binary_cache_path(self.cache_path)))
+        self.assertFalse(exists(self.cache_path))
+
+        meta = read_cache_header(self.cache_path)
+        self.assertEqual(sorted(meta), ['_hash', '_mod', '_url'])
+        self.assertEqual(meta['_hash'], self.hash)
+        self.assertEqual(read_cache(self.cache_path), repodata)
+        self.assertEqual(fetch_repodata(self.url, cache_dir=self.cache_dir,
+                                        use_cache=True), repodata)
+
+    def test_header_only(self):
+        write_cache(self.cache_path, {'packages': self.packages,
+                                      '_etag': '"abc"', '_url': self.url})
+        with open(binary_cache_path(self.cache_path), 'rb') as fi:
+            lines = fi.readlines()
+        # Corrupt the repodata, the metadata is still readable
+        with open(binary_cache_path(self.cache_path), 'wb') as fo:
+            fo.writelines(lines[:2] + [b'garbage'])
+        self.assertEqual(read_cache_header(self.cache_path),
+                         {'_etag': '"abc"', '_url': self.url})
+        self.assertRaises(IOError, read_cache, self.cache_path)
+
+    def test_json_cache(self):
+        # The cache of older versions of conda is used and replaced
+        with open(self.cache_path, 'w') as fo:
+            json.dump({'packages': {}, '_url': self.url}, fo)
+        self.assertEqual(fetch_repodata(self.url, cache_dir=self.cache_dir,
+                                        use_cache=True)['packages'], {})
+        repodata = fetch_repodata(self.url, cache_dir=self.cache_dir)
+        self.assertEqual(repodata['packages'], self.packages)
+        self.assertFalse(exists(self.cache_path))
+        self.assertEqual(read_cache(self.cache_path), repodata)
+
+
+class TestRepodataTTL(ChannelTestCase):
+
+    def setUp(self):
+        super(TestRepodataTTL, self).setUp()
+        self.local_repodata_ttl = config.local_repodata_ttl
+
+    def tearDown(self):
+        config.local_repodata_ttl = self.local_repodata_ttl
+        super(TestRepodataTTL, self).tearDown()
+
+    def age_cache(self, seconds):
+        path = binary_cache_path(self.cache_path)
+        t = os.path.getmtime(path) - seconds
+        os.utime(path, (t, t))
+
+    def test_ttl(self):
+        self.assertIsNone(cache_age(self.cache_path))
+        repodata = fetch_repodata(self.url, cache_dir=self.cache_dir)
+        self.assertLess(cache_age(self.cache_path), 60)
+        self.age_cache(100)
+        self.assertGreaterEqual(cache_age(self.cache_path), 100)
+
+        # Within the TTL the channel is not asked at all
+        os.unlink(join(self.channel, 'repodata.json.bz2'))
+        config.local_repodata_ttl = 600
+        self.assertEqual(fetch_repodata(self.url, cache_dir=self.cache_dir),
+                         repodata)
+        # Expired
+        self.age_cache(600)
+        new_hash = make_channel(self.channel, {})
+        self.assertEqual(fetch_repodata(self.url,
+                                        cache_dir=self.cache_dir)['packages'],
+                         {})
+        self.assertEqual(read_cache_header(self.cache_path)['_hash'], new_hash)
+
+        # 0: always ask, 1: the server's max-age (which file:// doesn't give)
+        for ttl in 0, 1:
+            config.local_repodata_ttl = ttl
+            make_channel(self.channel, self.packages)
+            self.assertEqual(fetch_repodata(self.url, cache_dir=self.cache_dir),
+                             repodata)
+            make_channel(self.channel, {})
+
+    def test_max_age(self):
+        write_cache(self.cache_path, {'packages': self.packages,
+                                      '_max_age': 300})
+        os.unlink(join(self.channel, 'repodata.json.bz2'))
+        config.local_repodata_ttl = 1
+        self.assertEqual(fetch_repodata(self.url,
+                                        cache_dir=self.cache_dir)['packages'],
+                         self.packages)
+        config.local_repodata_ttl = 0
+        self.assertRaises(RuntimeError, fetch_repodata, self.url,
+                          cache_dir=self.cache_dir)
+
+    def test_get_max_age(self):
+        class Response(object):
+            def __init__(self, cache_control):
+                self.headers = {'Cache-Control': cache_control}
+
+        for cache_control, max_age in [('', None), ('max-age=60', 60),
+                                       ('public, max-age=1200', 1200),
+                                       ('no-cache', 0),
+                                       ('s-maxage=5', None)]:
+            self.assertEqual(get_max_age(Response(cache_control)), max_age)
+
+
+class TestPackageIndex(ChannelTestCase):
+
+    def test_lazy(self):
+        write_cache(self.cache_path, {'packages': self.packages,
+                                      'info': {'arch': 'x86_64'},
+                                      '_url': self.url})
+        repodata = read_cache(self.cache_path, lazy=True)
+        packages = repodata['packages']
+        self.assertIsInstance(packages, LazyPackages)
+        self.assertEqual(repodata['info'], {'arch': 'x86_64'})
+        self.assertEqual(sorted(packages), sorted(self.packages))
+        fn = 'numpy-1.7.1-py27_0.tar.bz2'
+        self.assertEqual(packages.name(fn), 'numpy')
+        self.assertEqual(packages[fn], self.packages[fn])
+        self.assertNotIn('nothere', packages)
+        self.assertRaises(KeyError, packages.__getitem__, 'nothere')
+        self.assertEqual(read_cache(self.cache_path), repodata)
+
+    def test_lazy_windows(self):
+        # On Windows, the cache file is read instead of being memory mapped,
+        # so that it can be replaced while the packages are used
+        write_cache(self.cache_path, {'packages': self.packages})
+        on_win, install.on_win = install.on_win, True
+        try:
+            packages = read_cache(self.cache_path, lazy=True)['packages']
+        finally:
+            install.on_win = on_win
+        self.assertIsInstance(packages._mm, bytes)
+        write_cache(self.cache_path, {'packages': {}})
+        self.assertEqual(dict(packages), self.packages)
+
+    def test_index(self):
+        others = {fn: info for fn, info in index.items()
+                  if info['name'] != 'scipy'}
+        write_cache(self.cache_path, {'packages': others})
+        packages = read_cache(self.cache_path, lazy=True)['packages']
+        scipy = {fn: dict(info) for fn, info in index.items()
+                 if info['name'] == 'scipy'}
+        numpy = 'numpy-1.7.1-py27_0.tar.bz2'
+        scipy[numpy] = dict(index[numpy])
+
+        idx = PackageIndex()
+        idx.add_channel('http://a/', packages)
+        idx.add_channel('http://b/', scipy)
+        self.assertEqual(len(idx), len(index))
+        self.assertEqual(sorted(idx.groups['python']),
+                         sorted(fn for fn in index
+                                if fn.startswith('python-')))
+        self.assertEqual(idx[numpy]['channel'], 'http://b/')
+        python = 'python-2.7.5-0.tar.bz2'
+        self.assertEqual(idx[python]['channel'], 'http://a/')
+        # The loaded info dicts are kept (and can be modified)
+        self.assertIs(idx[python], idx[python])
+
+        idx['foo-1.0-0.tar.bz2'] = {'name': 'foo', 'depends': []}
+        self.assertEqual(idx.groups['foo'], ['foo-1.0-0.tar.bz2'])
+        del idx['foo-1.0-0.tar.bz2']
+        self.assertNotIn('foo', idx.groups)
+        self.assertNotIn('foo-1.0-0.tar.bz2', idx)
+
+        add_pip_dependency(idx)
+        self.assertIn('pip', idx[python]['depends'])
+
+        # Resolve uses the groups of the index
+        specs = ['scipy', 'numpy 1.7*', 'python 2.7*']
+        self.assertEqual(Resolve(idx).solve(specs),
+                         Resolve(dict(idx)).solve(specs))
+
+
+class TestChannelFetcher(ChannelTestCase):
+
+    def test_fetch(self):
+        urls = []
+        for i in range(4):
+            path = join(self.tmpdir, 'channel%d' % i)
+            os.mkdir(path)
+            make_channel(path, {fn: info for fn, info in index.items()
+                                if info['name'] == 'python'
+                                and info['version'].startswith('2.%d' % i)})
+            urls.append('file://%s/' % path)
+        fetcher = ChannelFetcher()
+        for url, repodata in fetcher.fetch(urls):
+            self.assertEqual(repodata['_url'], url)
+            self.assertEqual(repodata['packages'],
+                             fetch_repodata(url)['packages'])
+        # All the channels are on the same host
+        self.assertIs(fetcher.session(urls[0]), fetcher.session(urls[3]))
+        self.assertIsNot(fetcher.session(urls[0]),
+                         fetcher.session('http://example.com/'))
+
+        self.assertRaises(RuntimeError, fetcher.fetch,
+                          [self.url, self.url + 'nothere/'])
+
+    def test_limits(self):
+        active = {'all': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def fetch_repodata(url, use_cache=False, session=None,
+                           current=False):
+            with lock:
+                active['all'] += 1
+                active['max'] = max(active['max'], active['all'])
+            time.sleep(0.05)
+            with lock:
+                active['all'] -= 1
+            return {'packages': {}, '_url': url}
+
+        saved = fetch.fetch_repodata
+        fetch.fetch_repodata = fetch_repodata
+        try:
+            urls = ['http://host%d/%d/' % (i % 2, i) for i in range(8)]
+            res = ChannelFetcher(3, 5).fetch(urls)
+            self.assertEqual([url for url, repodata in res], urls)
+            self.assertEqual(active['max'], 3)
+            active['max'] = 0
+            ChannelFetcher(10, 2).fetch(urls)
+            self.assertEqual(active['max'], 4)
+        finally:
+            fetch.fetch_repodata = saved
+
+
+class TestShardedRepodata(ChannelTestCase):
+
+    def setUp(self):
+        super(TestShardedRepodata, self).setUp()
+        self.sharded_repodata = config.sharded_repodata
+        config.sharded_repodata = True
+        self.sharded = join(self.tmpdir, 'sharded')
+        os.mkdir(self.sharded)
+        make_sharded_channel(self.sharded, index)
+        self.sharded_url = 'file://%s/' % self.sharded
+
+    def tearDown(self):
+        config.sharded_repodata = self.sharded_repodata
+        super(TestShardedRepodata, self).tearDown()
+
+    def test_solve(self):
+        specs = ['scipy', 'numpy 1.7*', 'python 2.7*']
+        full = json.loads(json.dumps(index))
+        if config.add_pip_as_python_dependency:
+            add_pip_dependency(full)
+        expected = Resolve(full).solve(specs)
+        for i in range(2):
+            idx = fetch_index.func((self.sharded_url,))
+            self.assertEqual(len(idx), 0)
+            self.assertEqual(Resolve(idx).solve(specs), expected)
+            # Only the shards of the dependencies were loaded
+            self.assertIn('mkl', idx.groups)
+            self.assertNotIn('anaconda', idx.groups)
+            self.assertEqual(idx['python-2.7.5-0.tar.bz2'],
+                             dict(full['python-2.7.5-0.tar.bz2'],
+                                  channel=self.sharded_url))
+            if i == 0:
+                # The second time, the shards are in the cache
+                shutil.rmtree(join(self.sharded, 'shards'))
+
+    def test_names(self):
+        idx = fetch_index.func((self.sharded_url,))
+        names = {info['name'] for info in index.values()}
+        self.assertEqual(idx.groups, {})
+        self.assertEqual(idx.names(), names)
+        # (as conda search does)
+        r = Resolve(idx)
+        r.load_all()
+        self.assertEqual(set(r.groups), names)
+        self.assertEqual(len(idx), len(index))
+
+    def test_priority(self):
+        # The channel with the highest priority comes first
+        idx = fetch_index.func((self.url, self.sharded_url))
+        r = Resolve(idx)
+        r.load_names(['numpy'])
+        for fn in idx.groups['numpy']:
+            self.assertEqual(idx[fn]['channel'], self.url)
+        self.assertEqual(len(idx.groups['numpy']), len(
+            [fn for fn in index if index[fn]['name'] == 'numpy']))
+        # The channel is not sharded
+        os.unlink(join(self.sharded, SHARDS_MANIFEST))
+        make_channel(self.sharded, index)
+        idx = fetch_index.func((self.sharded_url,))
+        self.assertEqual(len(idx), len(index))
+
+    def test_bad_shard(self):
+        with open(join(self.sharded, SHARDS_MANIFEST)) as fi:
+            manifest = json.load(fi)
+        shard = join(self.sharded, 'shards',
+                     manifest['shards']['numpy'] + '.json.bz2')
+        with open(shard, 'wb') as fo:
+            fo.write(bz2.compress(b'{"packages": {}}'))
+        idx = fetch_index.func((self.sharded_url,))
+        self.assertRaises(RuntimeError, idx.load_names, ['numpy'])
+
+
+class TestCurrentRepodata(ChannelTestCase):
+
+    def setUp(self):
+        super(TestCurrentRepodata, self).setUp()
+        self.use_current_repodata = config.use_current_repodata
+        config.use_current_repodata = True
+        self.full = json.loads(json.dumps(index))
+        make_channel(self.channel, self.full)
+        if config.add_pip_as_python_dependency:
+            add_pip_dependency(self.full)
+        # The latest versions of some packages and their dependencies
+        self.current = {fn: index[fn] for fn in Resolve(self.full).get_dists(
+            ['sqlite', 'zlib', 'python'], max_only=True)}
+        with open(join(self.channel, CURRENT_REPODATA), 'w') as fo:
+            json.dump({'packages': self.current, 'info': {}}, fo)
+
+    def tearDown(self):
+        config.use_current_repodata = self.use_current_repodata
+        super(TestCurrentRepodata, self).tearDown()
+
+    def test_max_only(self):
+        idx = fetch_index.func((self.url,))
+        self.assertEqual(sorted(idx), sorted(self.current))
+        r = Resolve(idx)
+        self.assertEqual(r.solve(['sqlite', 'zlib'], update_deps=False),
+                         Resolve(self.full).solve(['sqlite', 'zlib'],
+                                                  update_deps=False))
+        # The current repodata was enough
+        self.assertEqual(list(idx.current), [self.url])
+        self.assertEqual(len(idx), len(self.current))
+
+    def test_full(self):
+        for specs, kwargs in [(['numpy 1.6*'], {'update_deps': False}),
+                              (['scipy'], {}),
+                              (['anaconda'], {'update_deps': False})]:
+            idx = fetch_index.func((self.url,))
+            r = Resolve(idx)
+            self.assertEqual(r.solve(specs, **kwargs),
+                             Resolve(self.full).solve(specs, **kwargs))
+            self.assertEqual(idx.current, {})
+            self.assertEqual(len(idx), len(index))
+
+        # conda search shows all the builds
+        idx = fetch_index.func((self.url,))
+        r = Resolve(idx)
+        r.load_all()
+        self.assertEqual(len(r.groups['numpy']), len(
+            [fn for fn in index if index[fn]['name'] == 'numpy']))
+
+        # Without current_repodata.json
+        os.unlink(join(self.channel, CURRENT_REPODATA))
+        idx = fetch_index.func((self.url,))
+        self.assertEqual(idx.current, {})
+        self.assertEqual(len(idx), len(index))
+
+
+class TestBackgroundRefresh(ChannelTestCase):
+
+    def setUp(self):
+        super(TestBackgroundRefresh, self).setUp()
+        self.saved = (config.background_repodata_refresh,
+                      config.local_repodata_ttl)
+        config.background_repodata_refresh = True
+        config.local_repodata_ttl = 0
+
+    def tearDown(self):
+        (config.background_repodata_refresh,
+         config.local_repodata_ttl) = self.saved
+        super(TestBackgroundRefresh, self).tearDown()
+
+    def test_refresh(self):
+        # Not memoized
+        fetch = fetch_index.func
+        # Nothing cached yet
+        index1 = fetch((self.url,))
+        self.assertEqual(index1.pending, [])
+        self.assertEqual(sorted(index1), sorted(self.packages))
+
+        scipy = {fn: info for fn, info in index.items()
+                 if info['name'] == 'scipy'}
+        make_channel(self.channel, scipy)
+        index2 = fetch((self.url,))
+        # The cached repodata, which is being refreshed
+        self.assertEqual(sorted(index2), sorted(self.packages))
+        index2['foo-1.0-0.tar.bz2'] = {'name': 'foo'}
+        for refresh in index2.pending:
+            refresh.join()
+        index2.refresh()
+        self.assertEqual(index2.pending, [])
+        self.assertEqual(sorted(index2),
+                         sorted(list(scipy) + ['foo-1.0-0.tar.bz2']))
+        self.assertEqual(read_cache(self.cache_path)['packages'], scipy)
+
+    def test_noninteractive(self):
+        class ProxySession(object):
+            # The proxy requires a password
+            proxies = {}
+
+            def get(self, url, **kwargs):
+                resp = requests.Response()
+                resp.status_code = 407
+                return resp
+
+        calls = []
+        saved = fetch.handle_proxy_407, fetch.dotlog.debug
+        fetch.handle_proxy_407 = lambda *args: calls.append(args)
+        fetch.dotlog.debug = lambda *args: calls.append(args)
+        try:
+            refresh = fetch.BackgroundRefresh(self.url, ProxySession())
+            self.assertTrue(refresh.daemon)
+            refresh.start()
+            refresh.join()
+        finally:
+            fetch.handle_proxy_407, fetch.dotlog.debug = saved
+        self.assertIsNone(refresh.repodata)
+        self.assertEqual(calls, [])
+
+    def test_atomic_write(self):
+        write_cache(self.cache_path, {'packages': self.packages})
+        packages = read_cache(self.cache_path, lazy=True)['packages']
+        write_cache(self.cache_path, {'packages': {}})
+        # The memory mapped file is still the old one
+        self.assertEqual(packages, self.packages)
+        self.assertEqual(os.listdir(self.cache_dir),
+                         [os.path.basename(binary_cache_path(self.cache_path))])
+
+
+class TestIncrementalRepodata(ChannelTestCase):
+
+    def setUp(self):
+        super(TestIncrementalRepodata, self).setUp()
+        self.incremental_repodata = config.incremental_repodata
+        config.incremental_repodata = True
+
+    def tearDown(self):
+        config.incremental_repodata = self.incremental_repodata
+        super(TestIncrementalRepodata, self).tearDown()
+
+    def write_jlap(self, patches, latest):
+        with open(join(self.channel, 'repodata.jlap'), 'w') as fo:
+            fo.write(jlap.dumps(patches, latest))
+
+    def make_patches(self):
+        fn1 = 'numpy-1.7.1-py27_0.tar.bz2'
+        fn2 = 'scipy-0.12.0-np17py27_0.tar.bz2'
+        packages = dict(self.packages)
+        del packages[fn1]
+        hash1 = jlap.repodata_hash({'packages': packages, 'info': {}})
+        packages[fn2] = index[fn2]
+        hash2 = jlap.repodata_hash({'packages': packages, 'info': {}})
+        patches = [
+            {'from': '0' * 64, 'to': self.hash, 'patch': []},
+            {'from': self.hash, 'to': hash1,
+             'patch': [{'op': 'remove', 'path': '/packages/' + fn1}]},
+            {'from': hash1, 'to': hash2,
+             'patch': [{'op': 'add', 'path': '/packages/' + fn2,
+                        'value': index[fn2]}]},
+        ]
+        return patches, packages
+
+    def test_patches(self):
+        fetch_repodata(self.url, cache_dir=self.cache_dir)
+
+        patches, packages = self.make_patches()
+        latest = patches[-1]['to']
+        self.write_jlap(patches, latest)
+        # Only the patches can be used
+        os.unlink(join(self.channel, 'repodata.json.bz2'))
+        repodata = fetch_repodata(self.url, cache_dir=self.cache_dir)
+        self.assertEqual(repodata['_hash'], latest)
+        self.assertEqual(repodata['packages'], packages)
+        self.assertEqual(read_cache(self.cache_path), repodata)
+        # Up to date
+        self.assertEqual(fetch_repodata(self.url, cache_dir=self.cache_dir),
+                         repodata)
+
+    def test_fallback(self):
+        fetch_repodata(self.url, cache_dir=self.cache_dir)
+        packages = {fn: info for fn, info in index.items()
+                    if info['name'] == 'scipy'}
+        new_hash = make_channel(self.channel, packages)
+
+        # The patches don't start from the cached repodata
+        self.write_jlap([{'from': '1' * 64, 'to': new_hash, 'patch': []}],
+                        new_hash)
+        repodata = fetch_repodata(self.url, cache_dir=self.cache_dir)
+        self.assertEqual(repodata['packages'], packages)
+        self.assertEqual(repodata['_hash'], new_hash)
+
+        # A patch doesn't apply
+        self.write_jlap([{'from': new_hash, 'to': '1' * 64, 'patch': [
+            {'op': 'remove', 'path': '/packages/nothere'}]}], '1' * 64)
+        repodata = fetch_repodata(self.url, cache_dir=self.cache_dir)
+        self.assertEqual(repodata['packages'], packages)
+        self.assertEqual(repodata['_hash'], new_hash)
+
+        # The patched repodata doesn't match the latest hash
+        fn = next(iter(packages))
+        self.write_jlap([{'from': new_hash, 'to': '1' * 64, 'patch': [
+            {'op': 'remove', 'path': '/packages/' + fn}]}], '1' * 64)
+        repodata = fetch_repodata(self.url, cache_dir=self.cache_dir)
+        self.assertEqual(repodata['packages'], packages)
+        self.assertEqual(repodata['_hash'], new_hash)
+
+        # No repodata.jlap
+        os.unlink(join(self.channel, 'repodata.jlap'))
+        repodata = fetch_repodata(self.url, cache_dir=self.cache_dir)
+        self.assertEqual(repodata['packages'], packages)
+
+    def test_range(self):
+        fetch_repodata(self.url, cache_dir=self.cache_dir)
+        patches, packages = self.make_patches()
+        path = join(self.channel, 'repodata.jlap')
+        session = RangeSession()
+
+        self.write_jlap(patches[:2], patches[1]['to'])
+        repodata = update_repodata(self.url, self.cache_path, session)
+        self.assertEqual(session.ranges, [None])
+        self.assertEqual(repodata['_hash'], patches[1]['to'])
+        with open(path, 'rb') as fi:
+            data = fi.read()
+        offset = repodata['_jlap']['offset']
+        self.assertEqual(data[offset:].count(b'\n'), 2)
+
+        # Only the end of the file is fetched once more patches are added
+        self.write_jlap(patches, patches[2]['to'])
+        repodata = update_repodata(self.url, self.cache_path, session)
+        self.assertEqual(session.ranges, [None, offset])
+        self.assertEqual(repodata['_hash'], patches[2]['to'])
+        self.assertEqual(repodata['packages'], packages)
+        self.assertEqual(read_cache(self.cache_path), repodata)
+
+        # Up to date
+        offset = repodata['_jlap']['offset']
+        self.assertEqual(update_repodata(self.url, self.cache_path, session),
+                         repodata)
+        self.assertEqual(session.ranges[-1], offset)
+
+        # The file was rewritten, longer, and then shorter
+        self.write_jlap([{'from': '1' * 64, 'to': '2' * 64,
+                          'patch': []}] * 10, patches[2]['to'])
+        repodata = update_repodata(self.url, self.cache_path, session)
+        self.assertEqual(session.ranges[-2:], [offset, None])
+        self.assertEqual(repodata['packages'], packages)
+        offset = repodata['_jlap']['offset']
+        self.write_jlap([], patches[2]['to'])
+        repodata = update_repodata(self.url, self.cache_path, session)
+        self.assertEqual(session.ranges[-2:], [offset, None])
+        self.assertEqual(repodata['packages'], packages)
+        self.assertEqual(repodata['_jlap']['offset'], 65)
+
+
+class RangeSession(object):
+    """
+    A session for file:// URLs which supports Range requests
+    """
+    proxies = {}
+
+    def __init__(self):
+        self.ranges = []
+
+    def get(self, url, stream=False, proxies=None, headers=None):
+        offset = None
+        if headers and 'Range' in headers:
+            offset = int(headers['Range'][len('bytes='):-1])
+        self.ranges.append(offset)
+        with open(url[len('file://'):], 'rb') as fi:
+            data = fi.read()
+        if offset is None:
+            resp = FakeResponse(200, {}, None)
+        elif offset >= len(data):
+            resp = FakeResponse(416, {}, None)
+            data = b''
+        else:
+            resp = FakeResponse(206, {}, None)
+            data = data[offset:]
+        resp.content = data
+        return resp
+
+
+
+class RecordHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.name, record.msg))
+
+
+class TestFetchPkgs(ChannelTestCase):
+
+    def setUp(self):
+        super(TestFetchPkgs, self).setUp()
+        self.pkgs_dir = join(self.tmpdir, 'pkgs')
+        os.mkdir(self.pkgs_dir)
+        self.infos = []
+        for i in range(8):
+            data = os.urandom(1000 * (i + 1))
+            info = {'name': 'pkg%d' % i, 'version': '1.0', 'build': '0',
+                    'channel': self.url, 'size': len(data),
+                    'md5': hashlib.md5(data).hexdigest()}
+            with open(join(self.channel, 'pkg%d-1.0-0.tar.bz2' % i),
+                      'wb') as fo:
+                fo.write(data)
+            self.infos.append(info)
+        self.handler = RecordHandler()
+        self.levels = {}
+        for name in 'fetch.start', 'fetch.update', 'fetch.stop':
+            logger = logging.getLogger(name)
+            self.levels[name] = logger.level
+            logger.setLevel(logging.INFO)
+            logger.addHandler(self.handler)
+
+    def tearDown(self):
+        for name, level in self.levels.items():
+            logger = logging.getLogger(name)
+            logger.setLevel(level)
+            logger.removeHandler(self.handler)
+        super(TestFetchPkgs, self).tearDown()
+
+    def test_fetch(self):
+        fetch.fetch_pkgs(self.infos, self.pkgs_dir, threads=3)
+        dists = set('pkg%d-1.0-0' % i for i in range(8))
+        self.assertEqual(set(os.listdir(self.pkgs_dir)),
+                         set([dist + '.tar.bz2' for dist in dists] +
+                             ['urls.txt', install.MANIFEST_FN]))
+        with open(join(self.pkgs_dir, 'urls.txt')) as fi:
+            self.assertEqual(sorted(fi.read().split()),
+                             sorted(self.url + dist + '.tar.bz2'
+                                    for dist in dists))
+        manifest = install.load_manifest(self.pkgs_dir)
+        for info in self.infos:
+            entry = manifest[info['name'] + '-1.0-0']
+            self.assertEqual((entry['md5'], entry['size']),
+                             (info['md5'], info['size']))
+            with open(join(self.channel, info['name'] + '-1.0-0.tar.bz2'),
+                      'rb') as fi:
+                sha256 = hashlib.sha256(fi.read()).hexdigest()
+            self.assertEqual(entry['sha256'], sha256)
+            self.assertEqual(install.stored_digest(
+                self.pkgs_dir, info['name'] + '-1.0-0', 'sha256'), sha256)
+
+        # The digests of a tarball which changed are not used
+        with open(join(self.pkgs_dir, 'pkg0-1.0-0.tar.bz2'), 'ab') as fo:
+            fo.write(b'x')
+        self.assertEqual(install.stored_digest(self.pkgs_dir, 'pkg0-1.0-0'),
+                         None)
+        self.assertEqual(install.stored_digest(self.pkgs_dir, 'pkg1-1.0-0'),
+                         self.infos[1]['md5'])
+
+        # A single progress bar for all the packages
+        total = sum(info['size'] for info in self.infos)
+        records = self.handler.records
+        self.assertEqual(records[0], ('fetch.start', ('8 packages', total)))
+        self.assertEqual(records[-2:], [('fetch.update', total),
+                                        ('fetch.stop', None)])
+        updates = [n for name, n in records[1:-1]]
+        self.assertEqual(updates, sorted(updates))
+
+    def test_error(self):
+        self.infos[2]['md5'] = '0' * 32
+        self.infos[5]['name'] = 'missing'
+        backoff, fetch.BACKOFF = fetch.BACKOFF, 0
+        try:
+            self.assertRaises(RuntimeError, fetch.fetch_pkgs, self.infos,
+                              self.pkgs_dir, threads=3)
+            # No download is started after an error (the largest first)
+            shutil.rmtree(self.pkgs_dir)
+            os.mkdir(self.pkgs_dir)
+            self.assertRaises(RuntimeError, fetch.fetch_pkgs, self.infos,
+                              self.pkgs_dir, threads=1)
+        finally:
+            fetch.BACKOFF = backoff
+        self.assertEqual(install.fetched(self.pkgs_dir),
+                         set(['pkg7-1.0-0', 'pkg6-1.0-0']))
+        self.assertFalse(exists(join(self.pkgs_dir, 'pkg2-1.0-0.tar.bz2')))
+
+    def test_interrupt(self):
+        # The downloads which were started are finished before the
+        # directory is unlocked, the others are not started
+        started = threading.Event()
+        fetch_pkg = fetch.fetch_pkg
+        names = []
+
+        def slow_fetch_pkg(info, *args, **kwargs):
+            names.append(info['name'])
+            if len(names) == 2:
+                started.set()
+            time.sleep(0.2)
+            fetch_pkg(info, *args, **kwargs)
+
+        join = threading.Thread.join
+        calls = []
+
+        def interrupted_join(thread, *args):
+            if not calls:
+                calls.append(thread)
+                started.wait(5)
+                raise KeyboardInterrupt
+            join(thread, *args)
+
+        fetch.fetch_pkg = slow_fetch_pkg
+        threading.Thread.join = interrupted_join
+        try:
+            self.assertRaises(KeyboardInterrupt, fetch.fetch_pkgs,
+                              self.infos, self.pkgs_dir, threads=2)
+        finally:
+            fetch.fetch_pkg = fetch_pkg
+            threading.Thread.join = join
+        self.assertEqual(install.fetched(self.pkgs_dir),
+                         set(['pkg7-1.0-0', 'pkg6-1.0-0']))
+        self.assertEqual(names, ['pkg7', 'pkg6'])
+        self.assertFalse(any(fn.startswith(LOCKFN)
+                             for fn in os.listdir(self.pkgs_dir)))
+
+
+class FakeRaw(object):
+
+    def __init__(self, data, fail_at=None):
+        self.data = data
+        self.pos = 0
+        self.fail_at = fail_at
+
+    def read(self, size):
+        if self.fail_at is not None and self.pos >= self.fail_at:
+            raise IOError(104, 'Connection reset by peer')
+        end = self.pos + size
+        if self.fail_at is not None:
+            end = min(end, self.fail_at)
+        chunk = self.data[self.pos:end]
+        self.pos += len(chunk)
+        return chunk
+
+    def tell(self):
+        return self.pos
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, headers, raw):
+        self.status_code = status_code
+        self.headers = headers
+        self.raw = raw
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeServer(object):
+    """
+    A session serving data, which supports ranges if ranges is true, and
+    breaks the connection once after fail_at bytes if given
+    """
+    proxies = {}
+
+    def __init__(self, data, etag='"1"', ranges=True, fail_at=None):
+        self.data = data
+        self.etag = etag
+        self.ranges = ranges
+        self.fail_at = fail_at
+        self.requests = []
+
+    def get(self, url, stream=False, proxies=None, headers=None):
+        headers = headers or {}
+        self.requests.append(headers)
+        data = self.data
+        resp_headers = {'ETag': self.etag}
+        status = 200
+        if (self.ranges and 'Range' in headers and
+                headers.get('If-Range') == self.etag):
+            start = int(headers['Range'][len('bytes='):-1])
+            resp_headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, len(data) - 1, len(data))
+            data = data[start:]
+            status = 206
+        resp_headers['Content-Length'] = str(len(data))
+        fail_at, self.fail_at = self.fail_at, None
+        return FakeResponse(status, resp_headers, FakeRaw(data, fail_at))
+
+
+class TestResumeDownload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = join(self.tmpdir, 'foo-1.0-0.tar.bz2')
+        self.pp = self.path + '.part'
+        self.data = os.urandom(100000)
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        self.url = 'http://example.com/foo-1.0-0.tar.bz2'
+        self.backoff, fetch.BACKOFF = fetch.BACKOFF, 0
+
+    def tearDown(self):
+        fetch.BACKOFF = self.backoff
+        shutil.rmtree(self.tmpdir)
+
+    def write_partial(self, size, etag='"1"', url=None):
+        with open(self.pp, 'wb') as fo:
+            fo.write(self.data[:size])
+        with open(self.pp + '.json', 'w') as fo:
+            json.dump({'url': url or self.url, 'validator': etag}, fo)
+
+    def check_download(self, server):
+        digests = fetch.download(self.url, self.path, session=server,
+                                 md5=self.md5)
+        self.assertEqual(digests, {
+            'md5': self.md5,
+            'sha256': hashlib.sha256(self.data).hexdigest()})
+        with open(self.path, 'rb') as fi:
+            self.assertEqual(fi.read(), self.data)
+        self.assertEqual(os.listdir(self.tmpdir), ['foo-1.0-0.tar.bz2'])
+
+    def test_resume(self):
+        self.write_partial(30000)
+        server = FakeServer(self.data)
+        self.check_download(server)
+        self.assertEqual(server.requests,
+                         [{'Range': 'bytes=30000-', 'If-Range': '"1"'}])
+
+    def test_refused(self):
+        # The file changed, or the server doesn't support ranges
+        for server in FakeServer(self.data, etag='"2"'), FakeServer(
+                self.data, ranges=False):
+            self.write_partial(30000)
+            self.check_download(server)
+            os.unlink(self.path)
+        # The partial download of another url is not resumed
+        self.write_partial(30000, url='http://example.com/other')
+        server = FakeServer(self.data)
+        self.check_download(server)
+        self.assertEqual(server.requests, [{}])
+
+    def test_connection_reset(self):
+        server = FakeServer(self.data, fail_at=40000)
+        self.check_download(server)
+        self.assertEqual(server.requests,
+                         [{}, {'Range': 'bytes=40000-', 'If-Range': '"1"'}])
+
+    def test_md5_mismatch(self):
+        # A corrupt partial download is downloaded again
+        self.write_partial(30000)
+        with open(self.pp, 'r+b') as fo:
+            fo.write(b'x')
+        server = FakeServer(self.data)
+        self.check_download(server)
+        self.assertEqual(server.requests,
+                         [{'Range': 'bytes=30000-', 'If-Range': '"1"'}, {}])
+
+
+class TestStreamExtract(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        make_package(self.tmpdir, 'foo-1.0-0', {'name': 'foo'})
+        self.path = join(self.tmpdir, 'foo-1.0-0.tar.bz2')
+        with open(self.path, 'rb') as fi:
+            self.data = fi.read()
+        os.unlink(self.path)
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        self.url = 'http://example.com/foo-1.0-0.tar.bz2'
+        self.backoff, fetch.BACKOFF = fetch.BACKOFF, 0
+
+    def tearDown(self):
+        fetch.BACKOFF = self.backoff
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def download(self, server, md5=None, keep_tarball=False):
+        return fetch.download(self.url, self.path, session=server,
+                              md5=md5 or self.md5, extract=True,
+                              keep_tarball=keep_tarball)
+
+    def test_stream(self):
+        server = FakeServer(self.data)
+        digests = self.download(server)
+        self.assertEqual(digests['md5'], self.md5)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['foo-1.0-0', install.MANIFEST_FN])
+        self.assertEqual(install.extracted(self.tmpdir), set(['foo-1.0-0']))
+        self.assertEqual(install.fetched(self.tmpdir), set())
+
+        install.rm_extracted(self.tmpdir, 'foo-1.0-0')
+        self.download(server, keep_tarball=True)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['foo-1.0-0', 'foo-1.0-0.tar.bz2',
+                          install.MANIFEST_FN])
+        with open(self.path, 'rb') as fi:
+            self.assertEqual(fi.read(), self.data)
+
+    def test_connection_reset(self):
+        # Without the tarball, the download is started again
+        server = FakeServer(self.data, fail_at=100)
+        self.download(server)
+        self.assertEqual(server.requests, [{}, {}])
+        self.assertEqual(install.extracted(self.tmpdir), set(['foo-1.0-0']))
+
+    def test_corrupt(self):
+        # Nothing is extracted from a download with the wrong md5, nor from
+        # a download which isn't a package
+        server = FakeServer(self.data)
+        self.assertRaises(RuntimeError, self.download, server, md5='0' * 32)
+        self.assertEqual(len(server.requests), fetch.RETRIES + 1)
+        server = FakeServer(b'x' * 1000)
+        self.assertRaises(RuntimeError, self.download, server,
+                          md5=hashlib.md5(b'x' * 1000).hexdigest())
+        # (the lock removes the directory if it is empty)
+        self.assertFalse(isdir(self.tmpdir) and os.listdir(self.tmpdir))
+
+
+class ChunkedResponse(object):
+
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.data), self.size):
+            yield self.data[i:i + self.size]
+
+
+class TestStreamRepodata(unittest.TestCase):
+
+    def test_chunks(self):
+        repodata = {
+            'info': {'arch': 'x86_64', 'n': 12345678, 'x': [1.5e10, None]},
+            'packages': {
+                'a-1.0-0.tar.bz2': {'name': 'a', 'summary': u'\xe9\u6f22\u5b57',
+                                    'size': -0.25, 'depends': []},
+                'b-1.0-0.tar.bz2': {},
+            },
+        }
+        for obj in {}, {'packages': {}}, repodata:
+            text = json.dumps(obj, indent=1, ensure_ascii=False).encode('utf-8')
+            data = bz2.compress(text)
+            for size in 1, 3, 7, len(data):
+                repodata = stream_repodata(ChunkedResponse(data, size))
+                self.assertEqual(repodata.pop('_hash'),
+                                 hashlib.sha256(text).hexdigest())
+                self.assertEqual(repodata, obj)
+
+    def test_invalid(self):
+        for text in (b'', b'{"packages": {}', b'{"a" 1}', b'{"a": 1} x',
+                     b'[1]', b'{"packages": {"a": {},}}'):
+            for size in 1, 5, 100:
+                self.assertRaises(ValueError, stream_repodata,
+                                  ChunkedResponse(bz2.compress(text), size))
+
+
+if __name__ == '__main__':
+    unittest.main()
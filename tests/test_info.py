@@ -32,3 +32,13 @@ def test_info():
     assert conda_info_out in conda_info_all_out
     assert conda_info_e_out in conda_info_all_out
     assert conda_info_s_out in conda_info_all_out
+
+
+def test_pretty_age():
+    from conda.cli.main_info import pretty_age
+    assert pretty_age(None) == 'not cached'
+    assert pretty_age(0.5) == 'cached 0 seconds ago'
+    assert pretty_age(1) == 'cached 1 second ago'
+    assert pretty_age(150) == 'cached 2 minutes ago'
+    assert pretty_age(3600) == 'cached 1 hour ago'
+    assert pretty_age(3 * 86400 + 5) == 'cached 3 days ago'
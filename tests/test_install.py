@@ -1,7 +1,11 @@
 from contextlib import contextmanager
+import io
+import json
+import os
 import random
 import shutil
 import stat
+import tarfile
 import tempfile
 import unittest
 from os.path import join
@@ -9,6 +13,7 @@
 
 from conda import install
 from conda.install import PaddingError, binary_replace, update_prefix
+from conda.lock import Locked
 
 from .decorators import skip_if_no_mock
 from .helpers import mock
@@ -349,5 +354,340 @@ def test_tries_extra_kwarg_on_windows(self):
         self.assertEqual(2, mocks['rmtree'].call_count)
 
 
+def make_package(pkgs_dir, dist, info):
+    """
+    write the tarball of a package with the given index.json to pkgs_dir
+    """
+    src = tempfile.mkdtemp()
+    try:
+        os.mkdir(join(src, 'info'))
+        with open(join(src, 'info', 'index.json'), 'w') as fo:
+            json.dump(info, fo)
+        with open(join(src, 'info', 'files'), 'w') as fo:
+            fo.write('info/index.json\n')
+        t = tarfile.open(join(pkgs_dir, dist + '.tar.bz2'), 'w:bz2')
+        t.add(join(src, 'info'), 'info')
+        t.close()
+    finally:
+        shutil.rmtree(src)
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.pkgs_dir = tempfile.mkdtemp()
+        self.info = {'name': 'foo', 'version': '1.0', 'build': '0',
+                     'build_number': 0, 'depends': ['bar'],
+                     'license': 'BSD', 'files': ['info/index.json']}
+        make_package(self.pkgs_dir, 'foo-1.0-0', self.info)
+
+    def tearDown(self):
+        shutil.rmtree(self.pkgs_dir)
+
+    def test_incremental(self):
+        pkgs_dir = self.pkgs_dir
+        self.assertEqual(install.fetched(pkgs_dir), set(['foo-1.0-0']))
+        self.assertEqual(install.extracted(pkgs_dir), set())
+        install.extract(pkgs_dir, 'foo-1.0-0')
+        self.assertEqual(install.extracted(pkgs_dir), set(['foo-1.0-0']))
+
+        entry = install.load_manifest(pkgs_dir)['foo-1.0-0']
+        self.assertTrue(entry['fetched'])
+        self.assertTrue(entry['extracted'])
+        self.assertEqual(entry['size'],
+                         os.path.getsize(join(pkgs_dir, 'foo-1.0-0.tar.bz2')))
+        info = dict(self.info)
+        del info['files']
+        self.assertEqual(entry['index'], info)
+        with open(join(pkgs_dir, install.MANIFEST_FN)) as fi:
+            self.assertEqual(json.load(fi)['dists'],
+                             install.load_manifest(pkgs_dir))
+
+        install.rm_fetched(pkgs_dir, 'foo-1.0-0')
+        self.assertEqual(install.fetched(pkgs_dir), set())
+        self.assertEqual(install.extracted(pkgs_dir), set(['foo-1.0-0']))
+        self.assertNotIn('size', install.load_manifest(pkgs_dir)['foo-1.0-0'])
+        install.rm_extracted(pkgs_dir, 'foo-1.0-0')
+        self.assertEqual(install.load_manifest(pkgs_dir), {})
+
+    def test_validation(self):
+        pkgs_dir = self.pkgs_dir
+        install.extract(pkgs_dir, 'foo-1.0-0')
+        self.assertEqual(install.extracted(pkgs_dir), set(['foo-1.0-0']))
+        # Changes behind conda's back are picked up, the entries of the
+        # packages which are still there are reused
+        os.unlink(join(pkgs_dir, 'foo-1.0-0.tar.bz2'))
+        with open(join(pkgs_dir, 'foo-1.0-0', 'info', 'index.json'), 'w'):
+            pass
+        make_package(pkgs_dir, 'bar-2.0-1', {'name': 'bar'})
+        manifest = install.load_manifest(pkgs_dir)
+        self.assertEqual(sorted(manifest), ['bar-2.0-1', 'foo-1.0-0'])
+        self.assertFalse(manifest['foo-1.0-0']['fetched'])
+        self.assertEqual(manifest['foo-1.0-0']['index']['name'], 'foo')
+        self.assertEqual(install.fetched(pkgs_dir), set(['bar-2.0-1']))
+
+        # The manifest is also used by a new process
+        install._manifests.clear()
+        self.assertEqual(install.load_manifest(pkgs_dir), manifest)
+        install._manifests.clear()
+        shutil.rmtree(join(pkgs_dir, 'foo-1.0-0'))
+        self.assertEqual(install.extracted(pkgs_dir), set())
+        self.assertEqual(install.load_manifest('/does/not/exist'), {})
+
+    def test_package_changed(self):
+        pkgs_dir = self.pkgs_dir
+        install.extract(pkgs_dir, 'foo-1.0-0')
+        self.assertEqual(install.extracted(pkgs_dir), set(['foo-1.0-0']))
+        # A change inside the package directory is noticed by a new process
+        os.unlink(join(pkgs_dir, 'foo-1.0-0', 'info', 'files'))
+        install._manifests.clear()
+        self.assertEqual(install.extracted(pkgs_dir), set())
+        self.assertEqual(install.fetched(pkgs_dir), set(['foo-1.0-0']))
+
+    @skip_if_no_mock
+    def test_read_only(self):
+        pkgs_dir = self.pkgs_dir
+        os.utime(pkgs_dir, (1000000000, 1000000000))
+        # The manifest can't be written, the directory is only scanned again
+        # once it changed
+        with patch.object(install, '_write_manifest'):
+            with patch.object(install, '_scan_pkgs_dir',
+                              wraps=install._scan_pkgs_dir) as scan:
+                for i in range(3):
+                    self.assertEqual(install.fetched(pkgs_dir),
+                                     set(['foo-1.0-0']))
+                self.assertEqual(scan.call_count, 1)
+                make_package(pkgs_dir, 'bar-2.0-1', {'name': 'bar'})
+                self.assertEqual(install.fetched(pkgs_dir),
+                                 set(['foo-1.0-0', 'bar-2.0-1']))
+                self.assertEqual(scan.call_count, 2)
+        self.assertFalse(os.path.exists(join(pkgs_dir, install.MANIFEST_FN)))
+
+    @skip_if_no_mock
+    def test_lock(self):
+        pkgs_dir = self.pkgs_dir
+        install.extract(pkgs_dir, 'foo-1.0-0')
+        manifest = install.load_manifest(pkgs_dir)
+        # A lock is ignored by the rescan, which doesn't read the packages
+        # again, and leaves the manifest as it was
+        with open(join(pkgs_dir, install.MANIFEST_FN)) as fi:
+            data = fi.read()
+        with patch.object(install, '_manifest_entry') as manifest_entry:
+            with Locked(pkgs_dir):
+                self.assertEqual(install.load_manifest(pkgs_dir), manifest)
+            self.assertEqual(install.load_manifest(pkgs_dir), manifest)
+        self.assertFalse(manifest_entry.called)
+        with open(join(pkgs_dir, install.MANIFEST_FN)) as fi:
+            self.assertEqual(fi.read(), data)
+
+
+
+class TestPackageTarFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        src = join(self.tmpdir, 'src')
+        os.makedirs(join(src, 'info'))
+        os.makedirs(join(src, 'bin'))
+        os.makedirs(join(src, 'lib', 'python', 'site-packages'))
+        files = [('info/index.json', 0o644), ('info/files', 0o600),
+                 ('bin/foo', 0o755), ('lib/python/site-packages/foo.py',
+                                      0o644)]
+        for path, mode in files:
+            with open(join(src, path), 'w') as fo:
+                fo.write(path)
+            os.chmod(join(src, path), mode)
+            os.utime(join(src, path), (1000000000, 1000000000))
+        os.symlink('foo', join(src, 'bin', 'bar'))
+        os.chmod(join(src, 'bin'), 0o750)
+        self.tarball = join(self.tmpdir, 'foo-1.0-0.tar.bz2')
+        t = tarfile.open(self.tarball, 'w:bz2')
+        # (the lib directory is not in the archive)
+        for path in ['info', 'bin', 'bin/bar'] + [path for path, mode in files
+                                                  if path != 'info/files']:
+            t.add(join(src, path), path, recursive=False)
+        t.add(join(src, 'info', 'files'), 'info/files')
+        t.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def tree(self, path):
+        res = {}
+        for root, dirs, files in os.walk(path):
+            for fn in dirs + files:
+                p = join(root, fn)
+                st = os.lstat(p)
+                res[os.path.relpath(p, path)] = (
+                    stat.S_IMODE(st.st_mode), st.st_uid, st.st_gid,
+                    os.path.islink(p) or os.path.isdir(p) or st.st_mtime)
+        return res
+
+    def test_extract(self):
+        # The same tree as with tarfile (except for the owner)
+        install.extract(self.tmpdir, 'foo-1.0-0')
+        ref = join(self.tmpdir, 'ref')
+        t = tarfile.open(self.tarball)
+        t.extractall(ref)
+        t.close()
+        tree = self.tree(join(self.tmpdir, 'foo-1.0-0'))
+        self.assertEqual(
+            dict((p, (mode, mtime)) for p, (mode, uid, gid, mtime)
+                 in tree.items()),
+            dict((p, (mode, mtime)) for p, (mode, uid, gid, mtime)
+                 in self.tree(ref).items()))
+        self.assertEqual(tree['bin/foo'][0], 0o755)
+        self.assertEqual(tree['bin'][0], 0o750)
+        for p, (mode, uid, gid, mtime) in tree.items():
+            self.assertEqual(uid, os.geteuid())
+            if os.geteuid() == 0:
+                self.assertEqual(gid, 0)
+
+        # When streaming, the directories are created as needed
+        shutil.rmtree(join(self.tmpdir, 'foo-1.0-0'))
+        with open(self.tarball, 'rb') as fi:
+            tmp = install.extract_tmp(self.tmpdir, 'foo-1.0-0', fileobj=fi)
+        self.assertEqual(self.tree(tmp), tree)
+
+    def test_directory_modes(self):
+        # The directories are created with their final mode, even when
+        # extractall passes a copy of their members with the mode 0o700
+        # to makedir (as up to Python 3.11)
+        import copy
+
+        class OldTarFile(install.PackageTarFile):
+            def makedir(self, tarinfo, targetpath):
+                tarinfo = copy.copy(tarinfo)
+                tarinfo.mode = 0o700
+                super(OldTarFile, self).makedir(tarinfo, targetpath)
+
+        umask = os.umask(0o022)
+        try:
+            with patch('os.chmod', wraps=os.chmod) as chmod:
+                t = OldTarFile.open(self.tarball)
+                t.extract_package(join(self.tmpdir, 'out'))
+                t.close()
+        finally:
+            os.umask(umask)
+        paths = [call[0][0] for call in chmod.call_args_list]
+        # (only the files which aren't rw-r--r--)
+        self.assertEqual(sorted(paths),
+                         [join(self.tmpdir, 'out', 'bin', 'foo'),
+                          join(self.tmpdir, 'out', 'info', 'files')])
+        self.assertEqual(stat.S_IMODE(os.stat(join(self.tmpdir, 'out',
+                                                   'bin')).st_mode), 0o750)
+
+    def test_symlinked_directory(self):
+        # A member in a directory which is a symbolic link to another one
+        t = tarfile.open(self.tarball, 'w:bz2')
+        for name, data in [('lib/libfoo.so', b'foo'), ('lib64', None),
+                           ('lib64/libbar.so', b'bar')]:
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.SYMTYPE
+                info.linkname = 'lib'
+                t.addfile(info)
+            else:
+                info.size = len(data)
+                t.addfile(info, io.BytesIO(data))
+        t.close()
+        install.extract(self.tmpdir, 'foo-1.0-0', engine='tarfile')
+        out = join(self.tmpdir, 'foo-1.0-0')
+        self.assertEqual(os.readlink(join(out, 'lib64')), 'lib')
+        self.assertEqual(sorted(os.listdir(join(out, 'lib'))),
+                         ['libbar.so', 'libfoo.so'])
+
+    def test_data_filter(self):
+        # The directory members have no mode with the data filter (the
+        # default from Python 3.14 on)
+        if not hasattr(tarfile, 'data_filter'):
+            return
+        install.PackageTarFile.extraction_filter = staticmethod(
+            tarfile.data_filter)
+        try:
+            install.extract(self.tmpdir, 'foo-1.0-0', engine='tarfile')
+        finally:
+            del install.PackageTarFile.extraction_filter
+        self.assertTrue(install.is_extracted(self.tmpdir, 'foo-1.0-0'))
+
+    def extract_trees(self, engines):
+        trees = []
+        for engine in engines:
+            for stream in False, True:
+                with open(self.tarball, 'rb') as fi:
+                    tmp = install.extract_tmp(self.tmpdir, 'foo-1.0-0',
+                                              fileobj=fi if stream else None,
+                                              engine=engine.name)
+                tree = self.tree(tmp)
+                for p in tree:
+                    path = join(tmp, p)
+                    if os.path.islink(path):
+                        tree[p] += (os.readlink(path),)
+                    elif os.path.isfile(path):
+                        with open(path, 'rb') as fi:
+                            tree[p] += (fi.read(),)
+                trees.append(tree)
+                shutil.rmtree(tmp)
+        return trees
+
+    def test_engines(self):
+        # All the engines extract the same tree (with the same owners),
+        # from a file or a stream
+        engines = [e for e in install.extract_engines if e.available()]
+        self.assertTrue('tarfile' in [e.name for e in engines])
+        trees = self.extract_trees(engines)
+        for tree in trees[1:]:
+            self.assertEqual(tree, trees[0])
+        if os.geteuid() == 0:
+            # also as root with another group
+            os.setegid(1)
+            try:
+                trees = self.extract_trees(engines)
+            finally:
+                os.setegid(0)
+            for tree in trees:
+                self.assertEqual(tree, trees[0])
+                for p, info in tree.items():
+                    self.assertEqual(info[1:3], (0, 0))
+
+        self.assertEqual(install.get_extract_engine('tarfile').name,
+                         'tarfile')
+        self.assertEqual(install.get_extract_engine().name, engines[0].name)
+        self.assertRaises(RuntimeError, install.get_extract_engine, 'nope')
+
+    def test_no_bzip2(self):
+        # GNU tar isn't used without a bzip2 program
+        tar = install.find_program(['tar'])
+        if not tar:
+            return
+        bin_dir = join(self.tmpdir, 'bin')
+        os.mkdir(bin_dir)
+        os.symlink(tar, join(bin_dir, 'tar'))
+        path = os.environ['PATH']
+        engines = install.extract_engines
+        os.environ['PATH'] = bin_dir
+        install.extract_engines = [install.TarEngine(),
+                                   install.TarfileEngine()]
+        try:
+            self.assertEqual(install.get_extract_engine().name, 'tarfile')
+            install.extract(self.tmpdir, 'foo-1.0-0')
+        finally:
+            os.environ['PATH'] = path
+            install.extract_engines = engines
+        self.assertTrue(install.is_extracted(self.tmpdir, 'foo-1.0-0'))
+
+    def test_corrupt(self):
+        with open(self.tarball, 'r+b') as fo:
+            fo.seek(100)
+            fo.write(b'x' * 100)
+        for engine in install.extract_engines:
+            if engine.available():
+                self.assertRaises(Exception, install.extract_tmp,
+                                  self.tmpdir, 'foo-1.0-0',
+                                  engine=engine.name)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['foo-1.0-0.tar.bz2', 'src'])
+
+
 if __name__ == '__main__':
     unittest.main()
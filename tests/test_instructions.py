@@ -1,11 +1,22 @@
 from logging import getLogger, Handler, DEBUG
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+from multiprocessing.pool import ThreadPool
+from os.path import dirname, join
 
-
-from conda import exceptions
+from conda import config, exceptions, install
 from conda import instructions
+from conda.connection import CondaSession
 from conda.instructions import execute_instructions, commands, PROGRESS_CMD
 
+from .test_install import make_package
+
 
 def test_expected_operation_order():
     """Ensure expected order of operations"""
@@ -115,5 +126,286 @@ def cmd(state, arg):
 
         self.assertEqual(h.records, expected)
 
+    def test_fetch(self):
+        index = {'a-1.0-0.tar.bz2': {'name': 'a', 'channel': 'http://a/'},
+                 'b-1.0-0.tar.bz2': {'name': 'b', 'channel': 'http://b/'}}
+        calls = []
+        sessions = []
+
+        def simple_cmd(state, arg):
+            calls.append(arg)
+
+        def fetch_pkgs(infos, session=None, callback=None, extract=()):
+            calls.append([info['name'] for info in infos])
+            sessions.append(session)
+
+        commands['SIMPLE'] = simple_cmd
+        plan = [('SIMPLE', 1),
+                ('FETCH', 'a-1.0-0'),
+                ('FETCH', 'b-1.0-0'),
+                ('SIMPLE', 2)]
+
+        orig, instructions.fetch_pkgs = instructions.fetch_pkgs, fetch_pkgs
+        try:
+            execute_instructions(plan, index, verbose=False)
+        finally:
+            instructions.fetch_pkgs = orig
+        # The packages are downloaded together, with a session which keeps
+        # a connection per download thread
+        self.assertEqual(calls, [1, ['a', 'b'], 2])
+        self.assertIsInstance(sessions[0], CondaSession)
+        self.assertEqual(sessions[0].get_adapter('http://a/')._pool_maxsize,
+                         config.fetch_threads)
+
+    def test_pipeline(self):
+        index = {'a-1.0-0.tar.bz2': {'name': 'a', 'version': '1.0',
+                                     'build': '0', 'channel': 'http://a/'},
+                 'b-1.0-0.tar.bz2': {'name': 'b', 'version': '1.0',
+                                     'build': '0', 'channel': 'http://a/'}}
+        extracted = []
+        overlap = threading.Event()
+
+        def fetch_pkgs(infos, session=None, callback=None, extract=()):
+            for info in infos:
+                callback(info)
+            # The extraction starts before the downloads are done
+            overlap.wait(5)
+            extracted.append('fetched')
+
+        def extract_tmp(pkgs_dir, dist, fileobj=None, engine=None):
+            extracted.append(dist)
+            if dist == 'b-1.0-0':
+                overlap.set()
+            return dist
+
+        def commit_extracted(pkgs_dir, dist, tmp):
+            # (in the order of the EXTRACT instructions)
+            extracted.append('commit ' + tmp)
+
+        plan = [('FETCH', 'a-1.0-0'),
+                ('FETCH', 'b-1.0-0'),
+                ('PROGRESS', '3'),
+                ('EXTRACT', 'c-1.0-0'),
+                ('EXTRACT', 'a-1.0-0'),
+                ('EXTRACT', 'b-1.0-0')]
+
+        tmpdir = tempfile.mkdtemp()
+        pkgs_dirs, config.pkgs_dirs = config.pkgs_dirs, [tmpdir]
+        processes, config.extract_processes = config.extract_processes, 1
+        orig = (instructions.fetch_pkgs, install.extract_tmp,
+                install.commit_extracted)
+        (instructions.fetch_pkgs, install.extract_tmp,
+         install.commit_extracted) = fetch_pkgs, extract_tmp, commit_extracted
+        try:
+            execute_instructions(plan, index, verbose=False)
+        finally:
+            (instructions.fetch_pkgs, install.extract_tmp,
+             install.commit_extracted) = orig
+            config.pkgs_dirs = pkgs_dirs
+            config.extract_processes = processes
+            # (the lock removes the directory if it is empty)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        self.assertEqual(extracted,
+                         ['c-1.0-0', 'a-1.0-0', 'b-1.0-0', 'fetched',
+                          'commit c-1.0-0', 'commit a-1.0-0',
+                          'commit b-1.0-0'])
+
+    def test_pipeline_removed(self):
+        # A package removed before it is extracted again isn't extracted in
+        # the pool (which could extract it before it is removed)
+        index = {'b-1.0-0.tar.bz2': {'name': 'b', 'version': '1.0',
+                                     'build': '0', 'channel': 'http://a/'}}
+        calls = []
+
+        def fetch_pkgs(infos, session=None, callback=None, extract=()):
+            for info in infos:
+                callback(info)
+
+        def extract_tmp(pkgs_dir, dist, fileobj=None, engine=None):
+            calls.append('tmp ' + dist)
+            return dist
+
+        def commit_extracted(pkgs_dir, dist, tmp):
+            calls.append('commit ' + dist)
+
+        def extract(pkgs_dir, dist, engine=None):
+            calls.append('extract ' + dist)
+
+        def rm_extracted(pkgs_dir, dist):
+            calls.append('rm ' + dist)
+
+        plan = [('FETCH', 'b-1.0-0'),
+                ('RM_EXTRACTED', 'a-1.0-0'),
+                ('EXTRACT', 'a-1.0-0'),
+                ('EXTRACT', 'b-1.0-0')]
+
+        tmpdir = tempfile.mkdtemp()
+        pkgs_dirs, config.pkgs_dirs = config.pkgs_dirs, [tmpdir]
+        processes, config.extract_processes = config.extract_processes, 1
+        orig = (instructions.fetch_pkgs, install.extract_tmp,
+                install.commit_extracted, install.extract,
+                install.rm_extracted)
+        (instructions.fetch_pkgs, install.extract_tmp,
+         install.commit_extracted, install.extract,
+         install.rm_extracted) = (fetch_pkgs, extract_tmp, commit_extracted,
+                                  extract, rm_extracted)
+        try:
+            execute_instructions(plan, index, verbose=False)
+        finally:
+            (instructions.fetch_pkgs, install.extract_tmp,
+             install.commit_extracted, install.extract,
+             install.rm_extracted) = orig
+            config.pkgs_dirs = pkgs_dirs
+            config.extract_processes = processes
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        self.assertEqual(sorted(calls), ['commit b-1.0-0', 'extract a-1.0-0',
+                                         'rm a-1.0-0', 'tmp b-1.0-0'])
+        self.assertLess(calls.index('rm a-1.0-0'),
+                        calls.index('extract a-1.0-0'))
+
+    def test_stream_extract(self):
+        index = {'a-1.0-0.tar.bz2': {'name': 'a', 'version': '1.0',
+                                     'build': '0', 'channel': 'http://a/'},
+                 'b-1.0-0.tar.bz2': {'name': 'b', 'version': '1.0',
+                                     'build': '0', 'channel': 'http://a/',
+                                     'sig': '.'}}
+        calls = []
+
+        def fetch_pkgs(infos, session=None, callback=None, extract=()):
+            calls.append(sorted(extract))
+            for info in infos:
+                callback(info)
+
+        def extract_tmp(pkgs_dir, dist, fileobj=None, engine=None):
+            return dist
+
+        def commit_extracted(pkgs_dir, dist, tmp):
+            calls.append(dist)
+
+        # The signed package is extracted after its download
+        plan = [('FETCH', 'a-1.0-0'),
+                ('FETCH', 'b-1.0-0'),
+                ('EXTRACT', 'a-1.0-0'),
+                ('EXTRACT', 'b-1.0-0')]
+
+        tmpdir = tempfile.mkdtemp()
+        pkgs_dirs, config.pkgs_dirs = config.pkgs_dirs, [tmpdir]
+        processes, config.extract_processes = config.extract_processes, 1
+        stream, config.stream_extract = config.stream_extract, True
+        orig = (instructions.fetch_pkgs, install.extract_tmp,
+                install.commit_extracted)
+        (instructions.fetch_pkgs, install.extract_tmp,
+         install.commit_extracted) = fetch_pkgs, extract_tmp, commit_extracted
+        try:
+            execute_instructions(plan, index, verbose=False)
+        finally:
+            (instructions.fetch_pkgs, install.extract_tmp,
+             install.commit_extracted) = orig
+            config.pkgs_dirs = pkgs_dirs
+            config.extract_processes = processes
+            config.stream_extract = stream
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        self.assertEqual(calls, [['a-1.0-0'], 'b-1.0-0'])
+
+    def test_process_pool(self):
+        pkgs_dir = tempfile.mkdtemp()
+        dists = ['foo-1.0-%d' % i for i in range(4)]
+        for dist in dists:
+            make_package(pkgs_dir, dist, {'name': 'foo'})
+        os.unlink(join(pkgs_dir, 'foo-1.0-3.tar.bz2'))
+        try:
+            pipeline = instructions.ExtractPipeline(pkgs_dir, dists,
+                                                    processes=2)
+            try:
+                for dist in dists:
+                    pipeline.add(dist)
+                for dist in dists[:2]:
+                    self.assertTrue(pipeline.wait(dist))
+                self.assertRaises(IOError, pipeline.wait, 'foo-1.0-3')
+            finally:
+                pipeline.close()
+            # Only the packages which were waited for were moved in place,
+            # no temporary directories are left behind
+            self.assertEqual(install.extracted(pkgs_dir),
+                             set(['foo-1.0-0', 'foo-1.0-1']))
+            self.assertEqual(sorted(fn for fn in os.listdir(pkgs_dir)
+                                    if not fn.endswith('.tar.bz2')),
+                             ['foo-1.0-0',
+                              'foo-1.0-1', 'manifest.json'])
+        finally:
+            shutil.rmtree(pkgs_dir)
+
+    def test_process_pool_threads(self):
+        # The workers are forked, but not while another thread is running
+        event = threading.Event()
+        t = threading.Thread(target=event.wait)
+        t.daemon = True
+        t.start()
+        try:
+            self.assertIsNone(instructions.process_pool(2))
+        finally:
+            event.set()
+            t.join()
+        pool = instructions.process_pool(2)
+        if pool is None:
+            # (no fork on Windows)
+            return
+        try:
+            self.assertEqual(pool.apply(os.getppid), os.getpid())
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_pool_size(self):
+        pkgs_dir = tempfile.mkdtemp()
+        try:
+            # No processes are started for a single package
+            pipeline = instructions.ExtractPipeline(pkgs_dir, ['foo-1.0-0'],
+                                                    processes=4)
+            self.assertIsInstance(pipeline.pool, ThreadPool)
+            pipeline.close()
+        finally:
+            shutil.rmtree(pkgs_dir, ignore_errors=True)
+
+    def test_unguarded_script(self):
+        # The pipeline works from an entry point script without a
+        # `if __name__ == '__main__'` guard, which its workers don't run
+        pkgs_dir = tempfile.mkdtemp()
+        try:
+            dists = ['foo-1.0-%d' % i for i in range(2)]
+            for dist in dists:
+                make_package(pkgs_dir, dist, {'name': 'foo'})
+            script = join(pkgs_dir, 'script.py')
+            with open(script, 'w') as fo:
+                fo.write(UNGUARDED_SCRIPT % (pkgs_dir, dists))
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(
+                [dirname(dirname(instructions.__file__))] +
+                [p for p in [env.get('PYTHONPATH')] if p])
+            # (the workers running the script again would never end)
+            kwargs = {'timeout': 60} if sys.version_info[0] >= 3 else {}
+            output = subprocess.check_output([sys.executable, script],
+                                             env=env, **kwargs)
+            self.assertEqual(output.decode('utf-8').count('run'), 1)
+            self.assertEqual(install.extracted(pkgs_dir), set(dists))
+        finally:
+            shutil.rmtree(pkgs_dir)
+
+
+UNGUARDED_SCRIPT = """\
+import sys
+from conda import instructions
+print('run')
+sys.stdout.flush()
+pipeline = instructions.ExtractPipeline(%r, %r, processes=2)
+try:
+    for dist in pipeline.dists:
+        pipeline.add(dist)
+    for dist in sorted(pipeline.dists):
+        pipeline.wait(dist)
+finally:
+    pipeline.close()
+"""
+
 if __name__ == '__main__':
     unittest.main()
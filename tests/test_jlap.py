@@ -0,0 +1,79 @@
+import hashlib
+import json
+import unittest
+
+from conda import jlap
+
+
+class TestJlap(unittest.TestCase):
+
+    def test_roundtrip(self):
+        patches = [{'from': 'a' * 64, 'to': 'b' * 64, 'patch': []},
+                   {'from': 'b' * 64, 'to': 'c' * 64,
+                    'patch': [{'op': 'remove', 'path': '/x'}]}]
+        text = jlap.dumps(patches, 'c' * 64)
+        self.assertEqual(jlap.loads(text), (patches, {'latest': 'c' * 64}))
+
+        lines = text.splitlines()
+        for bad in (lines[:-1], lines[:2] + lines[3:],
+                    lines[:1] + [lines[2], lines[1]] + lines[3:]):
+            self.assertRaises(ValueError, jlap.loads, '\n'.join(bad))
+
+    def test_parse(self):
+        patches = [{'from': 'a' * 64, 'to': 'b' * 64, 'patch': []},
+                   {'from': 'b' * 64, 'to': 'c' * 64, 'patch': []}]
+        data = jlap.dumps(patches[:1], 'b' * 64).encode('utf-8')
+        res, meta, pos, check = jlap.parse(data)
+        self.assertEqual((res, meta), (patches[:1], {'latest': 'b' * 64}))
+        self.assertEqual(data[pos:].count(b'\n'), 2)
+
+        # The rest of the file once a patch is appended
+        data = jlap.dumps(patches, 'c' * 64).encode('utf-8')
+        res, meta, end, end_check = jlap.parse(data[pos:], check)
+        self.assertEqual((res, meta), (patches[1:], {'latest': 'c' * 64}))
+        self.assertEqual((pos + end, end_check), jlap.parse(data)[2:])
+        self.assertRaises(ValueError, jlap.parse, data[pos + 1:], check)
+        self.assertRaises(ValueError, jlap.parse, data[pos:], 'd' * 64)
+
+    def test_repodata_hash(self):
+        repodata = {'packages': {'a': {'name': u'\xe9'}}, 'info': {}}
+        data = jlap.dumps_repodata(repodata)
+        self.assertEqual(json.loads(data.decode('utf-8')), repodata)
+        repodata['_hash'] = 'x'
+        self.assertEqual(jlap.repodata_hash(repodata),
+                         hashlib.sha256(data).hexdigest())
+
+    def test_find_patches(self):
+        patches = [{'from': '1', 'to': '2'}, {'from': '0', 'to': '1'},
+                   {'from': '2', 'to': '3'}]
+        self.assertEqual(jlap.find_patches(patches, '1', '3'),
+                         [{'from': '1', 'to': '2'}, {'from': '2', 'to': '3'}])
+        self.assertEqual(jlap.find_patches(patches, '3', '3'), [])
+        self.assertRaises(ValueError, jlap.find_patches, patches, '4', '3')
+
+    def test_apply_patch(self):
+        doc = {'packages': {'a/b': {'depends': ['x']}, 'c~': 1}, 'info': {}}
+        jlap.apply_patch(doc, [
+            {'op': 'add', 'path': '/packages/d', 'value': {'depends': []}},
+            {'op': 'add', 'path': '/packages/a~1b/depends/-', 'value': 'y'},
+            {'op': 'add', 'path': '/packages/a~1b/depends/0', 'value': 'w'},
+            {'op': 'remove', 'path': '/packages/c~0'},
+            {'op': 'replace', 'path': '/info', 'value': {'arch': 'x86'}},
+            {'op': 'copy', 'from': '/packages/d', 'path': '/packages/e'},
+            {'op': 'move', 'from': '/packages/d', 'path': '/packages/f'},
+            {'op': 'test', 'path': '/packages/f', 'value': {'depends': []}},
+        ])
+        self.assertEqual(doc, {'packages': {'a/b': {'depends': ['w', 'x', 'y']},
+                                            'e': {'depends': []},
+                                            'f': {'depends': []}},
+                               'info': {'arch': 'x86'}})
+        for op in ({'op': 'remove', 'path': '/nothere'},
+                   {'op': 'replace', 'path': '/nothere', 'value': 1},
+                   {'op': 'test', 'path': '/info', 'value': 1},
+                   {'op': 'add', 'path': '/info/arch/x', 'value': 1},
+                   {'op': 'frobnicate', 'path': '/info'}):
+            self.assertRaises(ValueError, jlap.apply_patch, doc, [op])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,7 +5,7 @@
 
 from conda.compat import log2, ceil
 from conda.logic import (Linear, Clauses, true, false, sat, min_sat,
-    minimal_unsatisfiable_subset)
+    minimal_unsatisfiable_subset, TimeBudget)
 
 from tests.helpers import raises
 
@@ -832,3 +832,64 @@ def test_minimal_unsatisfiable_subset():
         res = minimal_unsatisfiable_subset(perm)
         assert sorted(res) in [[[-1], [1]], [[-2], [2]]]
         assert not sat(res)
+
+def test_min_sat_time_budget():
+    clauses = [(1, 2, 3), (-1, -2), (-2, -3), (-1, -3)]
+    for alg in ['iterate', 'sorter']:
+        budget = TimeBudget(None)
+        assert min_sat(clauses, alg=alg, budget=budget)
+        assert not budget.exhausted
+        assert budget.report()['optimal']
+
+        # With no time left, a valid solution is still returned
+        budget = TimeBudget(0)
+        solutions = min_sat(clauses, alg=alg, budget=budget)
+        assert budget.exhausted
+        assert not budget.report()['optimal']
+        assert len(solutions) >= 1
+        for sol in solutions:
+            assert all(any(lit in sol for lit in clause) for clause in clauses)
+
+def test_min_sat_time_budget_constraints():
+    class CountdownBudget(TimeBudget):
+        # A budget which expires after a number of checks
+        def __init__(self, checks):
+            TimeBudget.__init__(self)
+            self.checks = checks
+
+        def expired(self):
+            self.checks -= 1
+            if self.checks < 0:
+                self.exhausted = True
+            return self.exhausted
+
+    clauses = [(1, 2, 3, 4, 5, 6), (-1, 2), (-2, 3), (-3, 4)]
+    tl = lambda sol: sum(lit > 0 for lit in sol[:6])
+    first = tl(sat(clauses))
+    # The solutions returned when the budget runs out during or after the
+    # bisection are within the constraints found so far
+    for checks in range(6):
+        solutions = min_sat(clauses, budget=CountdownBudget(checks))
+        assert solutions
+        for sol in solutions:
+            assert all(any(lit in sol for lit in clause) for clause in clauses)
+            assert tl(sol) <= first
+    assert tl(min_sat(clauses, budget=CountdownBudget(1))[0]) < first
+
+def test_TimeBudget_remaining():
+    assert TimeBudget().remaining() is None
+    assert TimeBudget(0).remaining() == 0
+    assert 0 < TimeBudget(100).remaining() <= 100
+
+def test_TimeBudget_phases():
+    budget = TimeBudget(100)
+    with budget.phase('a'):
+        pass
+    with budget.phase('b'):
+        pass
+    with budget.phase('a'):
+        pass
+    assert not budget.expired()
+    report = budget.report()
+    assert sorted(report['phases']) == ['a', 'b']
+    assert report['time_budget'] == 100
@@ -0,0 +1,192 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from os.path import exists, join
+
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+import requests
+
+from conda import config, fetch, mirrors
+from conda.connection import CondaSession
+
+
+class Server(object):
+    """
+    A local HTTP server of the files in root, which waits delay seconds
+    before answering each request
+    """
+    def __init__(self, root, delay=0):
+        server = self
+
+        class Handler(SimpleHTTPRequestHandler):
+
+            def translate_path(self, path):
+                return join(root, path.split('?')[0].lstrip('/'))
+
+            def send_head(self):
+                time.sleep(delay)
+                server.requests.append(self.path)
+                return SimpleHTTPRequestHandler.send_head(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.requests = []
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/' % self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestMirrors(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = join(self.tmpdir, 'root')
+        os.mkdir(self.root)
+        self.data = os.urandom(50000)
+        with open(join(self.root, 'foo-1.0-0.tar.bz2'), 'wb') as fo:
+            fo.write(self.data)
+        self.slow = Server(self.root, delay=0.3)
+        self.fast = Server(self.root)
+        self.channel = self.slow.url
+
+        self.pkgs_dirs = config.pkgs_dirs
+        config.pkgs_dirs = [self.tmpdir]
+        self.rc_mirrors = config.rc.get('channel_mirrors')
+        config.rc['channel_mirrors'] = {self.channel: [self.fast.url]}
+
+    def tearDown(self):
+        for server in self.slow, self.fast:
+            server.stop()
+        config.pkgs_dirs = self.pkgs_dirs
+        if self.rc_mirrors is None:
+            del config.rc['channel_mirrors']
+        else:
+            config.rc['channel_mirrors'] = self.rc_mirrors
+        mirrors._stats.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def session(self):
+        session = CondaSession()
+        # (the tests may have loaded the proxy servers of tests/condarc)
+        session.proxies = {}
+        return session
+
+    def download(self, session):
+        path = join(self.tmpdir, 'foo-1.0-0.tar.bz2')
+        if exists(path):
+            os.unlink(path)
+        fetch.download(self.channel + 'foo-1.0-0.tar.bz2', path,
+                       session=session,
+                       md5=hashlib.md5(self.data).hexdigest())
+        with open(path, 'rb') as fi:
+            self.assertEqual(fi.read(), self.data)
+
+    def test_fastest(self):
+        self.download(self.session())
+        # Both were probed, the package was downloaded from the fast one
+        self.assertEqual(self.slow.requests, ['/'])
+        self.assertEqual(self.fast.requests, ['/', '/foo-1.0-0.tar.bz2'])
+
+        stats = mirrors.get_stats()
+        self.assertTrue(stats.stats[self.fast.url]['throughput'] > 0)
+        self.assertTrue(stats.stats[self.slow.url]['latency'] >= 0.3)
+        # The statistics are kept for the next time (saved at exit)
+        stats.flush()
+        mirrors._stats.clear()
+        self.assertEqual(mirrors.get_stats().stats, stats.stats)
+        self.download(self.session())
+        self.assertEqual(len(self.slow.requests), 1)
+        self.assertEqual(len(self.fast.requests), 3)
+
+    def test_failover(self):
+        session = self.session()
+        self.download(session)
+        self.fast.stop()
+        self.download(session)
+        self.assertEqual(self.slow.requests, ['/', '/foo-1.0-0.tar.bz2'])
+        self.assertTrue('failed' in mirrors.get_stats().stats[self.fast.url])
+        # The failed mirror is not tried again for a while
+        self.download(self.session())
+        self.assertEqual(len(self.slow.requests), 3)
+
+    def test_not_found(self):
+        # Only connection and server errors fail over to the next mirror
+        os.unlink(join(self.root, 'foo-1.0-0.tar.bz2'))
+        self.assertRaises(RuntimeError, self.download, self.session())
+        self.assertEqual(self.fast.requests, ['/', '/foo-1.0-0.tar.bz2'])
+        self.assertEqual(self.slow.requests, ['/'])
+
+
+class FakeAdapter(object):
+
+    def __init__(self):
+        self.timeouts = []
+
+    def send(self, request, **kwargs):
+        self.timeouts.append(kwargs.get('timeout'))
+        resp = requests.Response()
+        resp.status_code = 200
+        return resp
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.adapters = {'http://': FakeAdapter()}
+
+
+class TestMirrorAdapter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = join(self.tmpdir, 'cache', mirrors.MIRRORS_FN)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_timeout(self):
+        session = FakeSession()
+        stats = mirrors.MirrorStats(self.path)
+        adapter = mirrors.MirrorAdapter(session, 'http://a/', ['http://b/'],
+                                        stats=stats)
+        request = requests.Request('GET', 'http://a/foo').prepare()
+        adapter.send(request)
+        adapter.send(request, timeout=1)
+        # The probes of the two mirrors, and the requests
+        self.assertEqual(session.adapters['http://'].timeouts,
+                         [mirrors.PROBE_TIMEOUT] * 2 + [mirrors.TIMEOUT, 1])
+
+    def test_save(self):
+        stats = mirrors.MirrorStats(self.path)
+        stats.record('http://a/', 1)
+        # Saved right away, then at most every SAVE_INTERVAL seconds
+        self.assertEqual(mirrors.MirrorStats(self.path).stats, stats.stats)
+        stats.record('http://b/', 1)
+        self.assertNotIn('http://b/', mirrors.MirrorStats(self.path).stats)
+        stats.flush()
+        self.assertEqual(mirrors.MirrorStats(self.path).stats, stats.stats)
+        # Failures are saved right away
+        stats.record_failure('http://a/')
+        self.assertEqual(mirrors.MirrorStats(self.path).stats, stats.stats)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)),
+                         [mirrors.MIRRORS_FN])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@
 
 import pytest
 
+import conda.resolve
 from conda.resolve import ver_eval, VersionSpec, MatchSpec, Package, Resolve, NoPackagesFound, VersionOrder, normalized_version
 
 from tests.helpers import raises
@@ -828,6 +829,156 @@ def test_unsat():
     assert raises((RuntimeError, SystemExit), lambda: r.solve(['numpy 1.5*', 'python 3*']), 'conflict')
     assert raises((RuntimeError, SystemExit), lambda: r.solve(['numpy 1.5*', 'numpy 1.6*']), 'conflict')
 
+def test_time_budget():
+    r.msd_cache = {}
+
+    specs = ['numpy', 'scipy', 'python 2.7*']
+    optimal = r.solve(specs, time_budget=100)
+    assert r.solve_stats.report()['optimal']
+
+    # With no time, the solution is valid but possibly not the optimal one
+    res = r.solve(specs, time_budget=0)
+    report = r.solve_stats.report()
+    assert not report['optimal']
+    assert report['time_budget'] == 0
+    assert 'get_dists' in report['phases']
+    names = {fn.rsplit('-', 2)[0] for fn in res}
+    assert {'numpy', 'scipy', 'python'} <= names
+    assert len(names) == len(res)
+    for fn in res:
+        for ms in r.ms_depends(fn):
+            assert any(ms.match(fn2) for fn2 in res), (fn, ms)
+    assert names == {fn.rsplit('-', 2)[0] for fn in optimal}
+
+def test_time_budget_shared(monkeypatch):
+    # All the solves of one r.solve() call use the same budget
+    budgets = []
+    solve2 = Resolve.solve2
+    def record_solve2(self, *args, **kwargs):
+        budgets.append(kwargs.get('budget'))
+        return solve2(self, *args, **kwargs)
+    monkeypatch.setattr(Resolve, 'solve2', record_solve2)
+
+    r.msd_cache = {}
+    installed = r.solve(['numpy 1.6*', 'python 2.7*'])
+    r.solve(['scipy', 'python 2.7*'], installed=installed, time_budget=100)
+    assert budgets[-1] is r.solve_stats
+    assert r.solve_stats.seconds == 100
+    assert all(budget is r.solve_stats for budget in budgets[1:])
+
+def test_get_pkgs_top_k():
+    r.msd_cache = {}
+
+    ms = MatchSpec('numpy')
+    versions = set(pkg.version for pkg in r.get_pkgs(ms, top_k=1))
+    assert versions == {'1.7.1'}
+    assert len(r.get_pkgs(ms, top_k=2)) > len(r.get_pkgs(ms, top_k=1))
+    # Packages at least as new as the installed one are always kept
+    pkgs = r.get_pkgs(ms, top_k=1, installed=('numpy-1.6.2-py27_4.tar.bz2',))
+    assert set(pkg.version for pkg in pkgs) == {'1.6.2', '1.7.0b2', '1.7.0rc1',
+                                                '1.7.0', '1.7.1'}
+
+def test_progressive_widening():
+    r.msd_cache = {}
+
+    installed = r.solve(['numpy 1.6*', 'python 2.7*', 'scipy'])
+    for specs in [['numpy', 'scipy', 'python 2.7*'],
+                  ['anaconda 1.5.0', 'python 2.7*', 'numpy 1.7*'],
+                  ['iopro', 'python 2.6*'], ['pandas', 'numpy 1.6*']]:
+        for update_deps in [True, False]:
+            kwargs = dict(installed=installed, update_deps=update_deps,
+                          try_max_only=False, returnall=True)
+            staged = r.solve2(specs, set(), **kwargs)
+            full = r.solve2(specs, set(), top_k=None, **kwargs)
+            assert sorted(map(sorted, staged)) == sorted(map(sorted, full))
+
+def test_neighborhood():
+    r.msd_cache = {}
+
+    installed = r.solve(['numpy 1.6*', 'python 2.7*', 'scipy', 'nose'])
+    assert 'numpy-1.6.2-py27_4.tar.bz2' in installed
+
+    # pandas is available for numpy 1.6, so numpy and scipy are kept
+    specs = ['pandas', 'python 2.7*']
+    res = r.solve(specs, installed)
+    assert 'numpy-1.7.1-py27_0.tar.bz2' in res
+    res = r.solve(specs, installed, neighborhood=True)
+    assert 'numpy-1.6.2-py27_4.tar.bz2' in res
+    assert 'pandas-0.11.0-np16py27_1.tar.bz2' in res
+
+    # Unlocking numpy is not enough, as the installed scipy needs numpy 1.6
+    specs = ['numpy 1.7*', 'scipy', 'python 2.7*']
+    assert (sorted(r.solve(specs, installed, neighborhood=True)) ==
+            sorted(r.solve(specs, installed)))
+
+    # Nothing new to install
+    assert r.solve_neighborhood(['numpy', 'python 2.7*'], installed,
+                                set()) is None
+
+def test_collapse_builds():
+    # Mirror every package with a different build string
+    index2 = dict(index)
+    for fn, info in index.items():
+        info2 = dict(info, build=info['build'] + 'm')
+        index2[fn[:-8] + 'm.tar.bz2'] = info2
+    r2 = Resolve(index2)
+
+    specs = ['pandas', 'python 3*']
+    dists = r2.get_dists(specs)
+    collapsed = r2.collapse_builds(dists, specs)
+    assert len(collapsed) * 2 == len(dists)
+    assert 'pandas-0.11.0-np17py33_1.tar.bz2' in collapsed
+    assert 'pandas-0.11.0-np17py33_1m.tar.bz2' not in collapsed
+    collapsed = r2.collapse_builds(dists, specs,
+                                   ['pandas-0.11.0-np17py33_1m.tar.bz2'])
+    assert 'pandas-0.11.0-np17py33_1m.tar.bz2' in collapsed
+    assert 'pandas-0.11.0-np17py33_1.tar.bz2' not in collapsed
+
+    # A spec for one of the builds keeps them apart
+    specs = ['pandas', 'python 3.3.2 0m']
+    collapsed = r2.collapse_builds(r2.get_dists(specs), specs)
+    assert {'python-3.3.2-0.tar.bz2', 'python-3.3.2-0m.tar.bz2'} <= set(collapsed)
+
+    r.msd_cache = {}
+    assert r2.solve(['pandas', 'python 3*']) == r.solve(['pandas', 'python 3*'])
+
+def test_components():
+    r.msd_cache = {}
+
+    specs = ['numpy 1.6*', 'zeromq 2*', 'python 2.7*', 'hdf5', 'scipy',
+             'libpng']
+    comps = r.components(specs)
+    assert sorted(sorted(cspecs) for cspecs, names in comps) == [
+        ['hdf5'], ['libpng'], ['numpy 1.6*', 'python 2.7*', 'scipy'],
+        ['zeromq 2*']]
+    for cspecs, names in comps:
+        if 'zeromq 2*' in cspecs:
+            assert names == {'zeromq', 'util-linux'}
+
+    installed = r.solve(specs)
+    for update_deps in [True, False]:
+        res = r.solve(specs, installed, update_deps=update_deps,
+                      partition=True)
+        assert res == r.solve(specs, installed, update_deps=update_deps)
+    assert r.solve_components(['numpy', 'scipy'], set()) is None
+
+def test_components_unsatisfiable():
+    r.msd_cache = {}
+
+    specs = ['numpy 1.5*', 'python 3*', 'zeromq 2*']
+    assert raises(SystemExit, lambda: r.solve_components(specs, set()),
+                  'conflict')
+    # (without a fork context, the components are solved serially)
+    fork_context = conda.resolve.fork_context
+    conda.resolve.fork_context = lambda: None
+    try:
+        assert raises(SystemExit, lambda: r.solve_components(specs, set()),
+                      'conflict')
+        assert r.solve_components(['zeromq 2*', 'libpng'], set()) == \
+            r.solve(['zeromq 2*', 'libpng'])
+    finally:
+        conda.resolve.fork_context = fork_context
+
 def test_nonexistent():
     r.msd_cache = {}
 
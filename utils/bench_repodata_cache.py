@@ -0,0 +1,111 @@
+"""
+Benchmark reading and writing the repodata cache of a channel with 50000
+packages, in the binary format and in the indented JSON of older versions
+of conda, and opening it lazily (only loading the packages of one name).
+
+    python utils/bench_repodata_cache.py [number of packages]
+"""
+from __future__ import print_function
+
+import json
+import random
+import sys
+import time
+from os.path import getsize, join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from conda.fetch import (binary_cache_path, read_cache, read_cache_header,
+                         write_cache)
+
+
+def make_repodata(n):
+    random.seed(0)
+    packages = {}
+    for i in range(n):
+        name = 'pkg%d' % (i // 20)
+        version = '1.%d' % (i % 20)
+        build = 'py27_%d' % (i % 3)
+        packages['%s-%s-%s.tar.bz2' % (name, version, build)] = {
+            'name': name,
+            'version': version,
+            'build': build,
+            'build_number': i % 3,
+            'depends': ['python 2.7*', 'numpy 1.%d*' % (i % 10),
+                        'dep%d' % (i % 500)],
+            'license': 'BSD',
+            'md5': '%032x' % random.getrandbits(128),
+            'size': random.randint(1000, 10000000),
+        }
+    return {'packages': packages, 'info': {}, '_etag': '"0123456789"',
+            '_mod': 'Mon, 01 Jun 2015 00:00:00 GMT',
+            '_url': 'https://repo.continuum.io/pkgs/free/linux-64/'}
+
+
+def timeit(f, repeat=3):
+    best = None
+    for i in range(repeat):
+        t0 = time.time()
+        f()
+        t = time.time() - t0
+        best = t if best is None else min(best, t)
+    return best
+
+
+def write_json(path, cache):
+    with open(path, 'w') as fo:
+        json.dump(cache, fo, indent=2, sort_keys=True)
+
+
+def read_json(path):
+    with open(path) as fi:
+        return json.load(fi)
+
+
+def lazy_open(path):
+    repodata = read_cache(path, lazy=True)
+    packages = repodata['packages']
+    return repodata, [packages[fn] for fn in packages
+                      if packages.name(fn) == 'pkg7']
+
+
+def memory(f):
+    try:
+        import tracemalloc
+    except ImportError:
+        return float('nan')
+    tracemalloc.start()
+    res = f()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del res
+    return size / 1e6
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    cache = make_repodata(n)
+    tmpdir = mkdtemp()
+    try:
+        path = join(tmpdir, 'cache.json')
+        print("%d packages" % n)
+        print("JSON   write: %.3fs" % timeit(lambda: write_json(path, cache)))
+        print("JSON   read:  %.3fs" % timeit(lambda: read_json(path)))
+        print("JSON   size:  %.1f MB" % (getsize(path) / 1e6))
+        print("binary write: %.3fs" % timeit(lambda: write_cache(path, cache)))
+        assert read_cache(path) == cache
+        print("binary read:  %.3fs" % timeit(lambda: read_cache(path)))
+        print("binary metadata only: %.6fs" %
+              timeit(lambda: read_cache_header(path)))
+        print("binary size:  %.1f MB" %
+              (getsize(binary_cache_path(path)) / 1e6))
+        print("binary read memory: %.1f MB" %
+              memory(lambda: read_cache(path)))
+        print("lazy   open:  %.3fs" % timeit(lambda: lazy_open(path)))
+        print("lazy   open memory: %.1f MB" % memory(lambda: lazy_open(path)))
+    finally:
+        rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()